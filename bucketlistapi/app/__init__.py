@@ -2,11 +2,29 @@
 Initializing the flask app
 '''
 from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
 from config import config
+from .pool import SQLAlchemy
+from .cache import TokenCache, CredentialCache, ResponseCache
+from .jobs import JobRunner
+from .passwords import PasswordHasher
+from .profiling import Profiler
+from .ratelimit import RateLimiter
+from .replicas import replica_router
+from .serializers import JSONSerializer
+from .shards import shard_router
+from .urls import URLTemplates
 
 
 db = SQLAlchemy()
+token_cache = TokenCache()
+credential_cache = CredentialCache()
+response_cache = ResponseCache()
+password_hasher = PasswordHasher()
+profiler = Profiler()
+json_serializer = JSONSerializer()
+url_templates = URLTemplates()
+rate_limiter = RateLimiter()
+job_runner = JobRunner()
 
 
 # application factory
@@ -16,9 +34,28 @@ def create_app(config_name):
     config[config_name].init_app(app)
 
     db.init_app(app)
+    # adds the replicas and shards to SQLALCHEMY_BINDS before any engine exists
+    replica_router.init_app(app)
+    shard_router.init_app(app)
+    token_cache.init_app(app)
+    credential_cache.init_app(app)
+    response_cache.init_app(app)
+    password_hasher.init_app(app)
+    profiler.init_app(app)
+    json_serializer.init_app(app)
+    url_templates.init_app(app)
+    rate_limiter.init_app(app)
+    job_runner.init_app(app)
+
+    # commit once per request
+    from .unit_of_work import unit_of_work
+    unit_of_work.init_app(app)
 
     # registering api_1 app
     from .api_1 import api_1 as api_1_blueprint
     app.register_blueprint(api_1_blueprint, url_prefix='/api/v1')
 
+    # registers the handlers of the background jobs
+    from . import tasks
+
     return app
@@ -3,16 +3,66 @@ Handles all authentication for API
 '''
 from . import api_1
 from . import errors
-from ..models import User
-from flask import request, url_for, g, jsonify, session
+from .. import token_cache, credential_cache, rate_limiter, url_templates
+from ..models import User, AuthPrincipal
+from ..shards import shard_router
+from ..serializers import jsonify
+from flask import request, g, session
 from datetime import datetime
+from functools import wraps
+from sqlalchemy import event
 
 from flask.ext.httpauth import HTTPBasicAuth
-auth = HTTPBasicAuth()
+
+
+class HTTPBasicOrBearerAuth(HTTPBasicAuth):
+
+    '''Basic auth that also accepts an "Authorization: Bearer <token>"
+    header. Bearer requests are checked against the token only and never
+    reach the password hash.
+    '''
+
+    def login_required(self, f):
+        # limits apply per user, once the request is authenticated, as
+        # does refusing the writes of users being moved
+        f = rate_limiter.limit()(shard_router.writable(f))
+        basic_login_required = super(
+            HTTPBasicOrBearerAuth, self).login_required(f)
+
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            token = bearer_token()
+            if token is None or request.method == 'OPTIONS':
+                return basic_login_required(*args, **kwargs)
+            if not verify_token(token):
+                return self.auth_error_callback()
+            return f(*args, **kwargs)
+        return decorated
+
+
+auth = HTTPBasicOrBearerAuth()
+
+
+# returns the token of a bearer authorization header, if any
+def bearer_token():
+    header = request.headers.get('Authorization', '')
+    scheme, _, token = header.partition(' ')
+    if scheme.lower() != 'bearer':
+        return None
+    return token.strip()
+
+
+# returns the token the request authenticated with, if any
+def request_token():
+    token = bearer_token()
+    if token is None and request.authorization:
+        token = request.authorization.username
+    return token
 
 
 # registration endpoint
 @api_1.route('/auth/register/', methods=['POST'])
+@rate_limiter.limit()
 def new_user():
     '''Register a new user'''
     username = request.json.get('username')
@@ -28,13 +78,14 @@ def new_user():
     user.save()
     return jsonify({
         'username': user.username,
-        'user_url': url_for('api_1.get_user', username=user.username,
-                            _external=True)
+        'user_url': url_templates.url_for(
+            'api_1.get_user', username=user.username)
     })
 
 
 # login endpoint
 @api_1.route('/auth/login/', methods=['POST'])
+@rate_limiter.limit()
 def login():
     '''Logins a user'''
     username = request.json.get('username')
@@ -60,6 +111,7 @@ def login():
 def logout():
     '''loguts a user'''
     session.clear()
+    token_cache.invalidate(request_token())
     return jsonify({'status': 'Logged Out'})
 
 
@@ -70,14 +122,42 @@ def verify_password(username_or_token, password):
     # first try to authenticate by token
     user = User.verify_auth_token(username_or_token)
     if not user:
+        # recently verified credentials skip the password hash
+        user = credential_cache.get(username_or_token, password)
+    if not user:
+        if not username_or_token:
+            return False  # no credentials sent
+        # guesses are limited per username and address before reaching the
+        # hash
+        rate_limiter.check_password(username_or_token)
         # try to authenticate with username/password
         user = User.query.filter_by(username=username_or_token).first()
         if not user or not user.verify_password(password):
             return False
+        credential_cache.set(
+            username_or_token, password,
+            AuthPrincipal(user.id, user.username))
     g.user = user
     return True
 
 
+# verify bearer tokens
+def verify_token(token):
+    '''verifies user based on a generated token only'''
+    user = User.verify_auth_token(token)
+    if not user:
+        return False
+    g.user = user
+    return True
+
+
+# cached tokens must not outlive their user
+@event.listens_for(User, 'after_delete')
+def forget_user_tokens(mapper, connection, target):
+    token_cache.invalidate_user(target.id)
+    credential_cache.invalidate(target.username)
+
+
 # request for token
 # to renew token, the user has to log in again
 def get_auth_token():
@@ -0,0 +1,272 @@
+'''
+Batch endpoints for bucketlist items
+
+Each batch runs in the request's transaction using bulk INSERT/UPDATE/DELETE
+statements and reports a result for every entry it was sent.
+'''
+from flask import request, g, current_app
+
+from . import api_1
+from . import errors
+from .authentication import auth
+from .. import db
+from ..models import BucketList, BucketItem, chunked
+from ..serializers import jsonify, http_date
+from ..shards import shard_router
+from datetime import datetime
+
+
+ERRORS = {
+    400: 'Bad Request',
+    404: 'Not found',
+    409: 'Conflict',
+}
+
+
+# result reported for an entry that could not be applied
+def failed(status):
+    return {'status': status, 'error': ERRORS[status]}
+
+
+def is_name(value):
+    return isinstance(value, (type(u''), str)) and value.strip() != ''
+
+
+def is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+# returns the list of entries sent, either as an array or under "items"
+def batch_entries():
+    payload = request.get_json(silent=True)
+    if isinstance(payload, dict):
+        payload = payload.get('items')
+    if not isinstance(payload, list):
+        return None
+    if len(payload) > current_app.config['MAX_BATCH_SIZE']:
+        return None
+    return payload
+
+
+# maps the names already in use onto the ids of their items
+def names_in_use(names):
+    in_use = {}
+    for chunk in chunked(names):
+        in_use.update(db.session.query(
+            BucketItem.name, BucketItem.id).filter(
+                BucketItem.name.in_(chunk)))
+    return in_use
+
+
+@api_1.route('/bucketlists/<int:bucketlist_id>/items/batch/',
+             methods=['POST', 'PATCH', 'DELETE'])
+@auth.login_required
+def bucketitems_batch(bucketlist_id):
+    '''Create, update or delete many bucketitems at once'''
+
+    # gets the bucketlist created by the user
+    bucketlist = BucketList.query.filter_by(
+        id=bucketlist_id, creator_id=g.user.id).first()
+
+    if bucketlist is None:
+        return errors.not_found(404)
+
+    entries = batch_entries()
+    if entries is None:
+        return errors.bad_request(400)
+
+    if request.method == 'POST':
+        results = create_items(bucketlist, entries)
+    elif request.method == 'PATCH':
+        results = update_items(bucketlist, entries)
+    else:
+        results = delete_items(bucketlist, entries)
+
+    if any(result['status'] < 400 for result in results):
+        bucketlist.touch()
+
+    return jsonify({'items': results})
+
+
+def create_items(bucketlist, entries):
+    '''Inserts every valid entry with a single executemany INSERT'''
+    names = [
+        entry.get('name') if isinstance(entry, dict) else None
+        for entry in entries
+    ]
+    in_use = names_in_use(set(name for name in names if is_name(name)))
+
+    now = datetime.now()
+    results = []
+    rows = []
+    for name in names:
+        if not is_name(name):
+            results.append(failed(400))
+        elif name in in_use:
+            results.append(failed(409))
+        else:
+            # later duplicates within the batch conflict with this one
+            in_use[name] = None
+            rows.append({
+                'name': name,
+                'bucketlist_id': bucketlist.id,
+                'date_created': now,
+                'date_modified': now,
+                'done': False
+            })
+            results.append(None)
+
+    if rows:
+        shard_router.assign_ids(BucketItem.__table__, rows)
+        db.session.execute(BucketItem.__table__.insert(), rows)
+        bucketlist.count_items(items=len(rows))
+        # names are unique, so they identify the new rows unless ids were
+        # assigned up front
+        if 'id' not in rows[0]:
+            ids = names_in_use([row['name'] for row in rows])
+            for row in rows:
+                row['id'] = ids[row['name']]
+        created = iter(rows)
+        for index, result in enumerate(results):
+            if result is None:
+                row = next(created)
+                item = BucketItem(**row)
+                results[index] = {'status': 201, 'item': item.to_json()}
+    return results
+
+
+def update_items(bucketlist, entries):
+    '''Applies every valid entry with a single executemany UPDATE. Items of
+    the batch may take each other's names.'''
+    ids = set(
+        entry.get('id') for entry in entries
+        if isinstance(entry, dict) and is_id(entry.get('id')))
+    items = {}
+    for chunk in chunked(ids):
+        items.update((item.id, item) for item in BucketItem.query.filter(
+            BucketItem.bucketlist_id == bucketlist.id,
+            BucketItem.id.in_(chunk)))
+    in_use = names_in_use(set(
+        entry.get('name') for entry in entries
+        if isinstance(entry, dict) and is_name(entry.get('name'))))
+
+    now = datetime.now()
+    # items renamed give up their names to the others, until an item whose
+    # renames all failed turns out to keep its name
+    released = set(
+        entry['id'] for entry in entries
+        if isinstance(entry, dict) and is_id(entry.get('id')) and
+        entry['id'] in items and is_name(entry.get('name')) and
+        entry['name'] != items[entry['id']].name)
+    while True:
+        results, mappings, done, names = apply_updates(
+            entries, items, in_use, released, now)
+        kept = set(item_id for item_id in released
+                   if names[item_id] == items[item_id].name)
+        if not kept:
+            break
+        released -= kept
+
+    if mappings:
+        # names taken over are cleared first, the unique index would refuse
+        # them while their item still has them
+        taken = set(names.values())
+        cleared = [{'id': item_id, 'name': None} for item_id in released
+                   if items[item_id].name in taken]
+        if cleared:
+            db.session.bulk_update_mappings(BucketItem, cleared)
+        db.session.bulk_update_mappings(BucketItem, mappings)
+        bucketlist.count_items(done=done)
+    return results
+
+
+def apply_updates(entries, items, in_use, released, now):
+    '''Results and UPDATE mappings of entries, how many more items are done
+    and the names of items after them, the names of released items being
+    free'''
+    taken = dict((name, item_id) for name, item_id in in_use.items()
+                 if item_id not in released)
+    names = dict((item.id, item.name) for item in items.values())
+    results = []
+    mappings = []
+    # items marked done minus items marked not done
+    done = 0
+    done_now = dict((item.id, bool(item.done)) for item in items.values())
+    for entry in entries:
+        if not isinstance(entry, dict) or not is_id(entry.get('id')):
+            results.append(failed(400))
+            continue
+        item = items.get(entry['id'])
+        if item is None:
+            results.append(failed(404))
+            continue
+
+        changes = {'id': item.id, 'date_modified': now}
+        if 'done' in entry:
+            if not isinstance(entry['done'], bool):
+                results.append(failed(400))
+                continue
+            changes['done'] = entry['done']
+        if 'name' in entry:
+            if not is_name(entry['name']):
+                results.append(failed(400))
+                continue
+            if taken.get(entry['name'], item.id) != item.id:
+                results.append(failed(409))
+                continue
+            changes['name'] = entry['name']
+
+        # only entries applied hold on to names, and the name an item is
+        # renamed from is free again
+        if 'name' in changes:
+            if taken.get(names[item.id]) == item.id:
+                del taken[names[item.id]]
+            taken[changes['name']] = item.id
+            names[item.id] = changes['name']
+        if 'done' in changes and changes['done'] != done_now[item.id]:
+            done += 1 if changes['done'] else -1
+            # a later entry for the same item starts from this one
+            done_now[item.id] = changes['done']
+        mappings.append(changes)
+        json_item = item.to_json()
+        json_item.update(
+            name=changes.get('name', item.name),
+            done=changes.get('done', item.done),
+            last_modified=http_date(now))
+        results.append({'status': 200, 'item': json_item})
+    return results, mappings, done, names
+
+
+def delete_items(bucketlist, entries):
+    '''Removes every entry found with a single DELETE per chunk of ids'''
+    ids = [
+        entry.get('id') if isinstance(entry, dict) else entry
+        for entry in entries
+    ]
+    found = set()
+    done = 0
+    for chunk in chunked(set(item_id for item_id in ids if is_id(item_id))):
+        for item_id, item_done in db.session.query(
+                BucketItem.id, BucketItem.done).filter(
+                    BucketItem.bucketlist_id == bucketlist.id,
+                    BucketItem.id.in_(chunk)):
+            found.add(item_id)
+            done += bool(item_done)
+
+    for chunk in chunked(found):
+        BucketItem.query.filter(
+            BucketItem.id.in_(chunk)
+        ).delete(synchronize_session=False)
+    bucketlist.count_items(items=-len(found), done=-done)
+
+    results = []
+    for item_id in ids:
+        if not is_id(item_id):
+            results.append(failed(400))
+        elif item_id in found:
+            # each id is only reported deleted once
+            found.discard(item_id)
+            results.append({'status': 200, 'id': item_id})
+        else:
+            results.append(failed(404))
+    return results
@@ -0,0 +1,95 @@
+'''
+Conditional GET support for bucketlist resources
+
+The ETag of a response is derived from the ids and modification dates of
+the bucketlists it shows and from the count and latest modification of
+their items, all of which are cheap to read compared to serializing the
+response. Clients presenting a current ETag (or a recent enough
+If-Modified-Since) get a 304 without the response being built.
+
+Lists of bucketlists have no Last-Modified: deleting a bucketlist, or one
+moving onto or off a page, leaves the newest date among them as it was.
+Their ETag covers the ids and count, which do change.
+'''
+import hashlib
+
+from flask import current_app, g, request
+
+from . import api_1
+from .. import db, response_cache
+from ..models import BucketItem, chunked
+from ..serializers import dumps
+
+
+def bucketlist_versions(bucketlists):
+    '''Returns the values identifying the current version of bucketlists
+    along with the time any of them or their items last changed'''
+    ids = [bucketlist.id for bucketlist in bucketlists]
+    items = {}
+    for chunk in chunked(ids):
+        items.update(
+            (bucketlist_id, (count, latest))
+            for bucketlist_id, count, latest in db.session.query(
+                BucketItem.bucketlist_id,
+                db.func.count(BucketItem.id),
+                db.func.max(BucketItem.date_modified)
+            ).filter(
+                BucketItem.bucketlist_id.in_(chunk)
+            ).group_by(BucketItem.bucketlist_id))
+
+    versions = []
+    modified = []
+    for bucketlist in bucketlists:
+        count, latest = items.get(bucketlist.id, (0, None))
+        versions.append(
+            (bucketlist.id, bucketlist.date_modified, count, latest))
+        modified.extend(
+            date for date in (bucketlist.date_modified, latest) if date)
+    return versions, max(modified) if modified else None
+
+
+def make_etag(versions):
+    # the query string selects the representation, so it is part of it
+    key = repr((request.full_path, versions)).encode('utf-8')
+    return hashlib.sha1(key).hexdigest()
+
+
+def not_modified(etag, last_modified):
+    # werkzeug's ETags is always truthy on python 3, test the header
+    if 'If-None-Match' in request.headers:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    if since is not None and last_modified is not None:
+        # http dates only carry whole seconds
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+
+def conditional_json(versions, last_modified, build):
+    '''Returns 304 when the client's copy is current, otherwise the json
+    of build(), reusing a cached body when its ETag still matches.
+    If-Modified-Since is ignored when last_modified is None.'''
+    etag = make_etag(versions)
+    if not_modified(etag, last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        body = response_cache.get(g.user.id, request.full_path, etag)
+        if body is None:
+            body = dumps(build())
+            response_cache.set(g.user.id, request.full_path, etag, body)
+        response = current_app.response_class(
+            body, mimetype='application/json')
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+# writes drop the responses cached for the user
+@api_1.after_request
+def invalidate_cached_responses(response):
+    user = getattr(g, 'user', None)
+    if request.method not in ('GET', 'HEAD') and user is not None and \
+            response.status_code < 400:
+        response_cache.invalidate_user(user.id)
+    return response
@@ -1,9 +1,10 @@
 '''
 Error handling for API
 '''
-from flask import jsonify, make_response
+from flask import make_response
 
 from . import api_1
+from ..serializers import jsonify
 
 
 @api_1.errorhandler(400)
@@ -21,5 +22,24 @@ def not_found(error):
     return make_response(jsonify({'error': 'Not found'}), 404)
 
 
+@api_1.errorhandler(429)
+def too_many_requests(error):
+    response = make_response(jsonify({'error': 'Too Many Requests'}), 429)
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+@api_1.errorhandler(503)
+def service_unavailable(error):
+    response = make_response(
+        jsonify({'error': 'Service Unavailable'}), 503)
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
 def internal_server_error(error):
     return make_response(jsonify({'error': 'Internal Server Error'}), 500)
@@ -0,0 +1,70 @@
+'''
+Health and metrics endpoints for load balancers, monitoring and load tests
+'''
+import time
+
+from flask import current_app, make_response
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import api_1
+from .authentication import auth
+from .. import db, profiler
+from ..pool import pool_status
+from ..serializers import jsonify
+from ..shards import shard_router
+
+
+# status, latency and pool of one database
+def check_engine(engine):
+    start = time.time()
+    try:
+        connection = engine.connect()
+        try:
+            connection.scalar(db.select([1]))
+        finally:
+            connection.close()
+    except SQLAlchemyError:
+        return {'status': 'unavailable', 'pool': pool_status(engine)}
+    return {
+        'status': 'ok',
+        'latency_ms': round(1000 * (time.time() - start), 3),
+        'pool': pool_status(engine)
+    }
+
+
+@api_1.route('/_health/db')
+def health_db():
+    '''Checks the database, every shard and every replica answer and
+    reports on their connection pools'''
+
+    health = check_engine(db.engine)
+    shards = [check_engine(shard_router.engine(shard))
+              for shard in shard_router.shards()[1:]]
+    if shards:
+        for shard, status in enumerate(shards):
+            status['shard'] = shard
+        health['shards'] = shards
+    # replicas serve the reads, one down fails them
+    names, _ = current_app.extensions['replicas']
+    replicas = [check_engine(db.get_engine(current_app, bind=name))
+                for name in names]
+    if replicas:
+        for name, status in zip(names, replicas):
+            status['replica'] = name
+        health['replicas'] = replicas
+    if any(status['status'] != 'ok'
+           for status in [health] + shards + replicas):
+        health['status'] = 'unavailable'
+        return make_response(jsonify(health), 503)
+    return jsonify(health)
+
+
+@api_1.route('/_metrics')
+@auth.login_required
+def metrics():
+    '''Reports per endpoint latency percentiles gathered by the profiler'''
+
+    return jsonify({
+        'profiling': current_app.config['PROFILE_REQUESTS'],
+        'endpoints': profiler.metrics()
+    })
@@ -0,0 +1,99 @@
+'''
+Background job endpoints
+
+Slow operations answer 202 Accepted with the job in the body and its URL in
+the Location header. Clients poll the job until its state is done or
+failed, and download the file of finished exports from its result_url.
+'''
+import json
+import os
+
+from flask import request, g, current_app, send_file
+
+from . import api_1
+from . import errors
+from .authentication import auth
+from .. import job_runner
+from ..serializers import jsonify
+from ..transfer import EXPORT_FORMATS, parse_import
+
+
+EXPORT_MIMETYPES = {'json': 'application/json', 'csv': 'text/csv'}
+
+
+# clients may ask for any operation to run in the background
+def prefers_async():
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+
+def accepted(job):
+    '''202 response pointing to a queued job'''
+    json_job = job.to_json()
+    response = jsonify({'job': json_job})
+    response.status_code = 202
+    response.headers['Location'] = json_job['job_url']
+    return response
+
+
+# gets a job queued by the user
+def user_job(job_id):
+    job = job_runner.queue.get(job_id)
+    if job is None or job.creator_id != g.user.id:
+        return None
+    return job
+
+
+@api_1.route('/jobs/<int:job_id>/')
+@auth.login_required
+def job(job_id):
+    '''Returns the state of a job, and its result once done'''
+
+    job = user_job(job_id)
+    if job is None:
+        return errors.not_found(404)
+    return jsonify({'job': job.to_json()})
+
+
+@api_1.route('/jobs/<int:job_id>/result/')
+@auth.login_required
+def job_result(job_id):
+    '''Downloads the file written by a finished export'''
+
+    job = user_job(job_id)
+    if job is None or not job.has_file():
+        return errors.not_found(404)
+    format = json.loads(job.payload)['format']
+    path = job.file_path()
+    if not os.path.exists(path):
+        return errors.not_found(404)
+    return send_file(path, mimetype=EXPORT_MIMETYPES[format],
+                     as_attachment=True,
+                     attachment_filename='bucketlists.%s' % format)
+
+
+@api_1.route('/bucketlists/export/', methods=['POST'])
+@auth.login_required
+def export_job():
+    '''Exports every bucketlist of the user with its items in the
+    background, as json or ?format=csv'''
+
+    format = request.args.get('format', 'json')
+    if format not in EXPORT_FORMATS:
+        return errors.bad_request(400)
+    return accepted(job_runner.enqueue(
+        'export_bucketlists', g.user.id, format=format))
+
+
+@api_1.route('/bucketlists/import/', methods=['POST'])
+@auth.login_required
+def import_job():
+    '''Creates the bucketlists and items sent in the background'''
+
+    try:
+        bucketlists = parse_import(
+            request.get_json(silent=True),
+            current_app.config['MAX_IMPORT_SIZE'])
+    except ValueError:
+        return errors.bad_request(400)
+    return accepted(job_runner.enqueue(
+        'import_bucketlists', g.user.id, bucketlists=bucketlists))
@@ -0,0 +1,62 @@
+'''
+Keyset (cursor) pagination for API list endpoints
+'''
+import base64
+import json
+from datetime import datetime
+
+from .. import db
+
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+# builds an opaque cursor from the sort key of the last row on a page
+def encode_cursor(values):
+    key = [
+        value.strftime(DATETIME_FORMAT) if isinstance(value, datetime)
+        else value for value in values
+    ]
+    return base64.urlsafe_b64encode(
+        json.dumps(key).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+# turns a cursor back into sort key values for the given columns
+# raises ValueError if the cursor was not produced by encode_cursor
+def decode_cursor(cursor, columns):
+    try:
+        padded = str(cursor) + '=' * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('invalid cursor')
+    if not isinstance(key, list) or len(key) != len(columns):
+        raise ValueError('invalid cursor')
+
+    values = []
+    for value, column in zip(key, columns):
+        if column.type.python_type is datetime:
+            value = datetime.strptime(value, DATETIME_FORMAT)
+        elif not isinstance(value, int):
+            raise ValueError('invalid cursor')
+        values.append(value)
+    return tuple(values)
+
+
+def keyset_page(query, columns, cursor, limit):
+    '''Returns up to `limit` rows ordered by `columns` that come after
+    `cursor`, along with the cursor of the next page (None on the last page).
+    Seeks straight to the cursor instead of scanning past an OFFSET.
+    '''
+    query = query.order_by(*columns)
+    if cursor:
+        query = query.filter(
+            db.tuple_(*columns) > decode_cursor(cursor, columns))
+
+    # fetch one extra row to find out whether another page exists
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(
+            [getattr(rows[-1], column.key) for column in columns])
+    return rows, next_cursor
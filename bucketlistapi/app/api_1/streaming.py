@@ -0,0 +1,57 @@
+'''
+Streaming JSON responses for large collections
+
+Rows are read through a server side cursor (yield_per) and written out a
+batch at a time, so memory use does not grow with the size of the table.
+'''
+from flask import Response, current_app, request, stream_with_context
+
+from ..serializers import dumps
+
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+# clients ask for newline delimited json with ?format=ndjson or Accept
+def wants_ndjson():
+    return request.args.get('format') == 'ndjson' or \
+        request.accept_mimetypes.best == NDJSON_MIMETYPE
+
+
+# groups the rows of a query into lists of size rows
+def batches(query, size):
+    batch = []
+    for row in query.yield_per(size):
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def stream_collection(key, query, serialize):
+    '''Streams the rows of query as {key: [...]}, or as one json document
+    per line for NDJSON clients. serialize turns a batch of rows into a list
+    of json dicts.
+    '''
+    size = current_app.config['STREAM_BATCH_SIZE']
+
+    if wants_ndjson():
+        def generate():
+            for batch in batches(query, size):
+                yield b''.join(
+                    dumps(obj) + b'\n' for obj in serialize(batch))
+        mimetype = NDJSON_MIMETYPE
+    else:
+        def generate():
+            yield ('{"%s":[' % key).encode('utf-8')
+            separator = b''
+            for batch in batches(query, size):
+                yield separator + b','.join(
+                    dumps(obj) for obj in serialize(batch))
+                separator = b','
+            yield b']}'
+        mimetype = 'application/json'
+
+    return Response(stream_with_context(generate()), mimetype=mimetype)
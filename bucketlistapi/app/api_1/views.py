@@ -1,12 +1,20 @@
 '''
 Views for the API
 '''
-from flask import jsonify, request, g, current_app, url_for
+from flask import request, g, current_app
 
 from . import api_1
 from . import errors
 from .authentication import auth
+from .conditional import bucketlist_versions, conditional_json
+from .jobs import accepted, prefers_async
+from .pagination import keyset_page
+from .streaming import stream_collection
+from .. import db, job_runner, url_templates
+from ..fields import requested_fields
 from ..models import User, BucketList, BucketItem
+from ..search import search_bucketlists, search_bucketitems
+from ..serializers import jsonify
 from datetime import datetime
 
 
@@ -16,10 +24,15 @@ from datetime import datetime
 def get_users():
     '''Returns all users'''
 
-    users = User.query.all()
-    return jsonify({
-        'users': [{'user': user.to_json()} for user in users]
-    })
+    try:
+        fields = requested_fields(User)
+    except ValueError:
+        return errors.bad_request(400)  # unknown field
+
+    return stream_collection(
+        'users', User.json_rows(User.query.order_by(User.id), fields),
+        lambda users: [
+            {'user': user} for user in User.bulk_to_json(users, fields)])
 
 
 @api_1.route('/users/<username>/')
@@ -27,10 +40,16 @@ def get_users():
 def get_user(username):
     '''Returns a user'''
 
-    user = User.query.filter_by(username=username).first()
+    try:
+        fields = requested_fields(User)
+    except ValueError:
+        return errors.bad_request(400)  # unknown field
+
+    user = User.json_rows(
+        User.query.filter_by(username=username), fields).first()
     if not user:
         return errors.bad_request(400)
-    return jsonify({'user': user.to_json()})
+    return jsonify({'user': User.bulk_to_json([user], fields)[0]})
 
 
 # bucketlist endpoints
@@ -67,36 +86,113 @@ def bucketlists():
         # gets the bucketname the user desires to see
         q = request.args.get('q', "", type=str)
 
-        # paginate bucketlist
-        # query the BucketList table and apply query parameters set
-        pagination = BucketList.query.filter_by(
-            creator_id=g.user.id
-        ).filter(
-            BucketList.name.contains(q)
-        ).paginate(
-            page, per_page=limit, error_out=False
-        )
+        # also match bucketlists through the names of their items
+        search_items = request.args.get('search_items') == 'true'
 
-        bucketlists = pagination.items
+        # fields and relations to return, the rest is not loaded
+        try:
+            fields = requested_fields(BucketList)
+        except ValueError:
+            return errors.bad_request(400)  # unknown field
+
+        # query the BucketList table and apply query parameters set
+        query = BucketList.json_rows(search_bucketlists(
+            BucketList.query.filter_by(creator_id=g.user.id),
+            q, include_items=search_items
+        ), fields)
+
+        # cursor mode seeks on (date_created, id) instead of using OFFSET
+        cursor = request.args.get('cursor')
+        if cursor is not None:
+            return bucketlists_after_cursor(query, cursor, limit, fields)
+
+        # the total count costs an extra query, clients may opt out of it
+        with_count = request.args.get('count', 'true') != 'false'
+
+        if with_count:
+            # paginate bucketlist
+            pagination = query.paginate(page, per_page=limit, error_out=False)
+            bucketlists = pagination.items
+            has_prev = pagination.has_prev
+            has_next = pagination.has_next
+            count = pagination.total
+        else:
+            bucketlists = query.limit(limit + 1).offset(
+                max(page - 1, 0) * limit).all()
+            has_prev = page > 1
+            has_next = len(bucketlists) > limit
+            bucketlists = bucketlists[:limit]
+            count = None
 
         # get url of prev page if any
-        prev_page = url_for(
-            'api_1.bucketlists', page=page - 1, _external=True
-        ) if pagination.has_prev else None
+        prev_page = url_templates.url_for(
+            'api_1.bucketlists', page=page - 1
+        ) if has_prev else None
 
         # get url for next page if any
-        next_page = url_for(
-            'api_1.bucketlists', page=page + 1, _external=True
-        ) if pagination.has_next else None
-
-        return jsonify({
-            'bucketlists': [
-                bucketlist.to_json() for bucketlist in bucketlists
-            ],
-            'prev': prev_page,
+        next_page = url_templates.url_for(
+            'api_1.bucketlists', page=page + 1
+        ) if has_next else None
+
+        # a deleted bucketlist leaves the newest date on the page unchanged,
+        # so pages are validated by their ETag only
+        versions, _ = bucketlist_versions(bucketlists)
+        return conditional_json(
+            [versions, count, has_prev, has_next], None,
+            lambda: {
+                'bucketlists': BucketList.bulk_to_json(bucketlists, fields),
+                'prev': prev_page,
+                'next': next_page,
+                'count': count
+            })
+
+
+def bucketlists_after_cursor(query, cursor, limit, fields):
+    '''Returns the page of bucketlists that follows cursor'''
+
+    try:
+        bucketlists, next_cursor = keyset_page(
+            query, (BucketList.date_created, BucketList.id), cursor, limit)
+    except ValueError:
+        return errors.bad_request(400)  # tampered or malformed cursor
+
+    # the next page keeps the search, fields and limit of this one
+    next_page = None
+    if next_cursor:
+        args = request.args.to_dict()
+        args.update(cursor=next_cursor, limit=limit)
+        next_page = url_templates.url_for('api_1.bucketlists', **args)
+
+    # counting is skipped unless explicitly requested
+    count = None
+    if request.args.get('count') == 'true':
+        count = query.order_by(None).count()
+
+    def build():
+        json_bucketlists = {
+            'bucketlists': BucketList.bulk_to_json(bucketlists, fields),
             'next': next_page,
-            'count': pagination.total
-        })
+            'next_cursor': next_cursor
+        }
+        if count is not None:
+            json_bucketlists['count'] = count
+        return json_bucketlists
+
+    # validated by their ETag only, as pages are
+    versions, _ = bucketlist_versions(bucketlists)
+    return conditional_json([versions, count, next_cursor], None, build)
+
+
+@api_1.route('/bucketlists/export/')
+@auth.login_required
+def export_bucketlists():
+    '''Streams every bucketlist of the user with its items'''
+
+    return stream_collection(
+        'bucketlists',
+        BucketList.json_rows(BucketList.query.filter_by(
+            creator_id=g.user.id).order_by(BucketList.id)),
+        BucketList.bulk_to_json)
 
 
 @api_1.route('/bucketlists/<int:bucketlist_id>/',
@@ -117,13 +213,124 @@ def bucketlist(bucketlist_id):
         name = request.json.get('name')
         bucketlist.rename(name)
     elif request.method == 'DELETE':
+        # large bucketlists are deleted in the background
+        if prefers_async() or has_items_over(
+                bucketlist, current_app.config['BACKGROUND_DELETE_ITEMS']):
+            return accepted(job_runner.enqueue(
+                'delete_bucketlist', g.user.id, bucketlist_id=bucketlist.id))
         # delete this bucketlist
         bucketlist.delete()
         return jsonify({"status": "successfully deleted!"})
+    else:
+        try:
+            fields = requested_fields(BucketList)
+        except ValueError:
+            return errors.bad_request(400)  # unknown field
+
+        # clients holding the current version get a 304
+        versions, last_modified = bucketlist_versions([bucketlist])
+        return conditional_json(
+            versions, last_modified,
+            lambda: {'bucketlist': bucketlist.to_json(fields)})
 
     return jsonify({'bucketlist': bucketlist.to_json()})
 
 
+def has_items_over(bucketlist, count):
+    '''Whether bucketlist holds more than count items, without counting
+    them all'''
+    return db.session.query(BucketItem.id).filter_by(
+        bucketlist_id=bucketlist.id).order_by(BucketItem.id).offset(
+            count).first() is not None
+
+
+@api_1.route('/bucketlists/<int:bucketlist_id>/items/', methods=['GET'])
+@auth.login_required
+def bucketitems(bucketlist_id):
+    '''Returns a page of the items of a bucketlist'''
+
+    # gets the bucketlist created by the user
+    bucketlist = BucketList.query.filter_by(
+        id=bucketlist_id, creator_id=g.user.id).first()
+
+    if bucketlist is None:
+        return errors.not_found(404)
+
+    limit = min(
+        request.args.get(
+            'limit', current_app.config['DEFAULT_PER_PAGE'], type=int),
+        current_app.config['MAX_PER_PAGE'])
+
+    # filters, fields and cursor all raise ValueError when malformed
+    try:
+        fields = requested_fields(BucketItem)
+        query = filter_bucketitems(
+            BucketItem.query.filter_by(bucketlist_id=bucketlist.id))
+        items, next_cursor = keyset_page(
+            BucketItem.json_rows(query, fields), (BucketItem.id,),
+            request.args.get('cursor'), limit)
+    except ValueError:
+        return errors.bad_request(400)
+
+    # the next page keeps the filters of this one
+    next_page = None
+    if next_cursor:
+        args = request.args.to_dict()
+        args['cursor'] = next_cursor
+        next_page = url_templates.url_for(
+            'api_1.bucketitems', bucketlist_id=bucketlist.id, **args)
+
+    # counting is skipped unless explicitly requested
+    count = None
+    if request.args.get('count') == 'true':
+        count = query.order_by(None).count()
+
+    def build():
+        json_items = {
+            'items': BucketItem.bulk_to_json(items, fields),
+            'next': next_page,
+            'next_cursor': next_cursor
+        }
+        if count is not None:
+            json_items['count'] = count
+        return json_items
+
+    versions, last_modified = bucketlist_versions([bucketlist])
+    return conditional_json(
+        [versions, count, next_cursor], last_modified, build)
+
+
+def parse_date(value):
+    '''Parses an ISO 8601 date or date and time, raises ValueError'''
+    for date_format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError('invalid date %r' % value)
+
+
+def filter_bucketitems(query):
+    '''Applies the done, q, created_after and created_before arguments'''
+    done = request.args.get('done')
+    if done is not None:
+        if done not in ('true', 'false'):
+            raise ValueError('done is true or false')
+        query = query.filter(BucketItem.done == (done == 'true'))
+
+    query = search_bucketitems(query, request.args.get('q'))
+
+    created_after = request.args.get('created_after')
+    if created_after is not None:
+        query = query.filter(
+            BucketItem.date_created >= parse_date(created_after))
+    created_before = request.args.get('created_before')
+    if created_before is not None:
+        query = query.filter(
+            BucketItem.date_created < parse_date(created_before))
+    return query
+
+
 @api_1.route('/bucketlists/<int:bucketlist_id>/items/', methods=['POST'])
 @auth.login_required
 def add_bucketitem(bucketlist_id):
@@ -142,6 +349,8 @@ def add_bucketitem(bucketlist_id):
     )
     bucketitem.create()
     bucketitem.save()
+    bucketlist.touch()
+    bucketlist.count_items(items=1)
 
     return jsonify({'item': bucketitem.to_json()})
 
@@ -167,12 +376,17 @@ def bucketitem(bucketlist_id, bucketitem_id):
         return errors.not_found(404)
 
     if request.method == 'PUT':
+        was_done = bool(bucketitem.done)
         bucketitem.done = request.json.get('done')
         new_name = request.json.get('name')
         if new_name is not None:
             bucketitem.name = new_name
         bucketitem.date_modified = datetime.now()
+        bucketlist.touch()
+        bucketlist.count_items(done=bool(bucketitem.done) - was_done)
         return jsonify({'item': bucketitem.to_json()})
     else:
         bucketitem.delete()
+        bucketlist.touch()
+        bucketlist.count_items(items=-1, done=-bool(bucketitem.done))
         return jsonify({"status": "successfully deleted!"})
@@ -0,0 +1,494 @@
+'''
+Bulk copying of users, bucketlists and items between databases
+
+    python manage.py export -o dump.ndjson
+    python manage.py import -i dump.ndjson -d postgresql://localhost/flaskdb
+
+Rows keep their ids, so dumps load into empty databases. The item counters
+of bucketlists are recounted once the items are loaded. Tables are copied
+in foreign key order a batch of rows at a time, memory use does not depend
+on their size.
+
+NDJSON dumps are a single stream, one {"<table>": {<row>}} object per line,
+and may be piped between the commands with '-'. CSV dumps are a directory
+with a <table>.csv file per table, each with a header row.
+
+PostgreSQL reads and writes CSV with COPY, and loads NDJSON with COPY too,
+converting it to CSV on the fly. Other databases are read through a
+streaming cursor and loaded with executemany INSERTs. A load runs in a
+single transaction: if it fails, nothing was loaded.
+
+With shards (app/shards.py), dumps hold the bucketlists and items of every
+shard after those of the primary, and loads put them back on the shard of
+their user, in a transaction per database committed once all succeeded.
+Loaded into a single database, a sharded dump keeps the shard of its users,
+which SHARDS ignores when unset.
+'''
+import csv
+import io
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from itertools import chain, groupby
+
+from . import db
+from .models import User, BucketList, BucketItem, IdSequence
+from .serializers import dumps
+from .shards import SHARDED_TABLES
+from .transfer import csv_row, open_csv
+
+
+FORMATS = ('ndjson', 'csv')
+
+# in foreign key order
+TABLES = [model.__table__ for model in (User, BucketList, BucketItem)]
+TABLES_BY_NAME = dict((table.name, table) for table in TABLES)
+
+
+if sys.version_info[0] < 3:
+    def csv_reader(f):
+        for row in csv.reader(f):
+            yield [value.decode('utf-8') for value in row]
+
+    def open_csv_input(path):
+        return open(path, 'rb')
+else:
+    def csv_reader(f):
+        return csv.reader(f)
+
+    def open_csv_input(path):
+        return io.open(path, newline='', encoding='utf-8')
+
+
+def parse_datetime(value):
+    '''Parses the ISO 8601 written by dumps, or PostgreSQL's 'date time',
+    several times faster than strptime'''
+    try:
+        date, time_of_day = value.replace('T', ' ').split(' ')
+        year, month, day = date.split('-')
+        time_of_day, _, fraction = time_of_day.partition('.')
+        hour, minute, second = time_of_day.split(':')
+        return datetime(
+            int(year), int(month), int(day), int(hour), int(minute),
+            int(second), int(fraction.ljust(6, '0')[:6]) if fraction else 0)
+    except ValueError:
+        raise ValueError('invalid date %r' % value)
+
+
+def dump_value(column, value):
+    '''Value of a column as written to json, csv writes None as empty'''
+    if value is None:
+        return None
+    if isinstance(column.type, db.DateTime):
+        return value.isoformat()
+    return value
+
+
+def csv_value(column, value):
+    '''Value of a column as written to csv'''
+    if isinstance(column.type, db.Boolean) and value is not None:
+        return 'true' if value else 'false'
+    return dump_value(column, value)
+
+
+def load_boolean(value):
+    if isinstance(value, bool):
+        return value
+    return value in ('true', 't', '1')  # 't' from PostgreSQL
+
+
+def loader(column):
+    '''Returns the function converting values of column read from json or
+    csv, where all are strings and empty ones are NULL'''
+    if isinstance(column.type, db.Boolean):
+        load = load_boolean
+    elif isinstance(column.type, db.DateTime):
+        load = parse_datetime
+    elif isinstance(column.type, db.Integer):
+        load = int
+    else:
+        return lambda value: value if value != '' else None
+    return lambda value: load(value) if value is not None and value != '' \
+        else None
+
+
+def copy_value(value):
+    '''Value read from json or csv as COPY reads it'''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
+
+
+def is_postgresql(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def quote(connection, name):
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+def copy_sql(connection, table, columns):
+    return '%s (%s)' % (quote(connection, table.name), ', '.join(
+        quote(connection, column) for column in columns))
+
+
+def row_batches(connection, table, size):
+    '''Yields the rows of table in id order, size at a time, from a server
+    side cursor where the database has them'''
+    result = connection.execution_options(stream_results=True).execute(
+        db.select(list(table.c)).order_by(table.c.id))
+    while True:
+        rows = result.fetchmany(size)
+        if not rows:
+            return
+        yield rows
+
+
+class Timer(object):
+
+    '''Rows copied per table and the seconds it took'''
+
+    def __init__(self):
+        self.tables = []
+
+    def table(self, name, copy):
+        start = time.time()
+        rows = copy()
+        self.tables.append((name, rows, time.time() - start))
+
+    def report(self):
+        lines = []
+        for name, rows, seconds in self.tables + [(
+                'total', sum(rows for _, rows, _ in self.tables),
+                sum(seconds for _, _, seconds in self.tables))]:
+            lines.append('%-10s %10d rows %9.2fs %12.0f rows/s' % (
+                name, rows, seconds, rows / seconds if seconds else 0))
+        return '\n'.join(lines)
+
+
+# exports
+
+def dump_ndjson(connection, table, out, size):
+    rows = 0
+    # plain strings, orjson refuses subclasses such as quoted_name as keys
+    name = type(u'')(table.name)
+    columns = [(type(u'')(column.name), column) for column in table.c]
+    for batch in row_batches(connection, table, size):
+        out.write(b''.join(dumps({name: dict(
+            (key, dump_value(column, row[column]))
+            for key, column in columns)}) + b'\n' for row in batch))
+        rows += len(batch)
+    return rows
+
+
+def dump_csv(connection, table, path, size, header=True):
+    '''Writes the rows of table to path, after those of other databases
+    when header is False'''
+    if is_postgresql(connection):
+        cursor = connection.connection.cursor()
+        with open(path, 'wb' if header else 'ab') as f:
+            cursor.copy_expert(
+                'COPY (SELECT %s FROM %s ORDER BY id) TO STDOUT '
+                'WITH CSV%s' % (
+                    ', '.join(quote(connection, column.name)
+                              for column in table.c),
+                    quote(connection, table.name),
+                    ' HEADER' if header else ''), f)
+        return cursor.rowcount
+
+    rows = 0
+    columns = list(table.c)
+    with open_csv(path, 'w' if header else 'a') as f:
+        writer = csv.writer(f)
+        if header:
+            writer.writerow(csv_row([column.name for column in columns]))
+        for batch in row_batches(connection, table, size):
+            writer.writerows(
+                csv_row([csv_value(column, row[column])
+                         for column in columns]) for row in batch)
+            rows += len(batch)
+    return rows
+
+
+def dump(engine, path, format='ndjson', size=10000, shards=()):
+    '''Writes every table to path, a file or '-' for stdout with ndjson, a
+    directory with csv. The bucketlists and items of the engines of shards
+    follow those of engine. Returns the Timer of the tables.'''
+    timer = Timer()
+    connections = [engine.connect()]
+    try:
+        connections.extend(shard.connect() for shard in shards)
+
+        def sources(table):
+            # users stay in the primary
+            return connections if table.name in SHARDED_TABLES \
+                else connections[:1]
+
+        if format == 'ndjson':
+            out = open(path, 'wb') if path != '-' else \
+                getattr(sys.stdout, 'buffer', sys.stdout)
+            try:
+                for table in TABLES:
+                    timer.table(table.name, lambda: sum(
+                        dump_ndjson(connection, table, out, size)
+                        for connection in sources(table)))
+            finally:
+                if path != '-':
+                    out.close()
+        else:
+            if path == '-':
+                raise ValueError('csv dumps are a directory of files')
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            for table in TABLES:
+                timer.table(table.name, lambda: sum(
+                    dump_csv(connection, table, os.path.join(
+                        path, table.name + '.csv'), size, n == 0)
+                    for n, connection in enumerate(sources(table))))
+    finally:
+        for connection in connections:
+            connection.close()
+    return timer
+
+
+# imports
+
+class CSVStream(object):
+
+    '''Read only file of rows written as csv, what COPY ... FROM STDIN
+    reads from'''
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = b''
+        self.count = 0
+        # holds the row being written
+        self.line = io.BytesIO() if sys.version_info[0] < 3 else io.StringIO()
+        self.writer = csv.writer(self.line)
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow(csv_row(row))
+            value = self.line.getvalue()
+            self.line.seek(0)
+            self.line.truncate()
+            self.buffer += value if isinstance(value, bytes) \
+                else value.encode('utf-8')
+            self.count += 1
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def load_rows(connection, table, columns, rows, size):
+    '''Inserts rows, lists of strings or json values of columns'''
+    if is_postgresql(connection):
+        stream = CSVStream([copy_value(value) for value in row]
+                           for row in rows)
+        connection.connection.cursor().copy_expert(
+            'COPY %s FROM STDIN WITH CSV' % copy_sql(
+                connection, table, columns), stream)
+        return stream.count
+
+    columns = [(name, loader(table.c[name])) for name in columns]
+    count = 0
+    batch = []
+    insert = table.insert()
+    for row in rows:
+        batch.append(dict(
+            (name, load(value)) for (name, load), value in zip(columns, row)))
+        if len(batch) == size:
+            connection.execute(insert, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        connection.execute(insert, batch)
+        count += len(batch)
+    return count
+
+
+class Targets(object):
+
+    '''Connections a load writes to by shard, None for the primary. Users go
+    to the primary, bucketlists and items to the shard of their user.'''
+
+    def __init__(self, connections):
+        self.connections = connections
+        self.primary = connections[None]
+        self.user_shards = {}
+        self.bucketlist_shards = {}
+
+    @property
+    def sharded(self):
+        return len(self.connections) > 1
+
+    def load(self, table, columns, rows, size):
+        '''Inserts rows of table, lists of values of columns, where they
+        belong'''
+        if not self.sharded:
+            return load_rows(self.primary, table, columns, rows, size)
+        shard_of = self.router(table, columns)
+        count = 0
+        batches = {}
+        for row in rows:
+            shard = shard_of(row)
+            batch = batches.setdefault(shard, [])
+            batch.append(row)
+            if len(batch) == size:
+                count += load_rows(
+                    self.connections[shard], table, columns, batch, size)
+                batches[shard] = []
+        for shard, batch in batches.items():
+            if batch:
+                count += load_rows(
+                    self.connections[shard], table, columns, batch, size)
+        return count
+
+    def router(self, table, columns):
+        '''Returns the function giving the shard of a row of table,
+        remembering those of the users and bucketlists loaded'''
+        def value(row, name):
+            if name not in columns:
+                return None
+            return loader(table.c[name])(row[columns.index(name)])
+
+        def user(row):
+            shard = value(row, 'shard')
+            if shard not in self.connections:
+                raise ValueError('user %s is on shard %s, which SHARDS '
+                                 'lacks' % (value(row, 'id'), shard))
+            self.user_shards[value(row, 'id')] = shard
+            return None
+
+        def bucketlist(row):
+            shard = self.user_shards.get(value(row, 'creator_id'))
+            self.bucketlist_shards[value(row, 'id')] = shard
+            return shard
+
+        def item(row):
+            return self.bucketlist_shards.get(value(row, 'bucketlist_id'))
+
+        return {'user': user, 'bucketlist': bucketlist,
+                'bucketitem': item}[table.name]
+
+
+def ndjson_rows(f):
+    '''Yields (table name, row dict) for every line of a dump'''
+    for line in f:
+        if line.strip():
+            (name, row), = json.loads(line.decode('utf-8')).items()
+            yield name, row
+
+
+def load_ndjson(targets, f, timer, size):
+    for name, entries in groupby(ndjson_rows(f), lambda entry: entry[0]):
+        table = TABLES_BY_NAME[name]
+        # the columns of the first row, older dumps may lack newer ones
+        _, first = next(entries)
+        columns = [column.name for column in table.c if column.name in first]
+        rows = ([row.get(column) for column in columns]
+                for _, row in chain([(name, first)], entries))
+        timer.table(name, lambda: targets.load(table, columns, rows, size))
+
+
+def load_csv(targets, path, timer, size):
+    for table in TABLES:
+        csv_path = os.path.join(path, table.name + '.csv')
+        if not os.path.exists(csv_path):
+            continue
+        with open_csv_input(csv_path) as f:
+            header = f.readline()
+            if not header:
+                continue
+            columns = next(csv_reader([header]))
+            if is_postgresql(targets.primary) and not targets.sharded:
+                # the rest of the file is what COPY reads
+                timer.table(table.name, lambda: copy_file(
+                    targets.primary, table, columns, f))
+            else:
+                timer.table(table.name, lambda: targets.load(
+                    table, columns, csv_reader(f), size))
+
+
+def copy_file(connection, table, columns, f):
+    cursor = connection.connection.cursor()
+    cursor.copy_expert('COPY %s FROM STDIN WITH CSV' % copy_sql(
+        connection, table, columns), f)
+    return cursor.rowcount
+
+
+def reset_sequences(connection, tables=TABLES):
+    '''Points the id sequences of PostgreSQL past the ids loaded'''
+    for table in tables:
+        connection.execute(
+            "SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+            "COALESCE(MAX(id), 0) + 1, false) FROM %s" % (
+                quote(connection, table.name), quote(connection, table.name)))
+
+
+def reset_id_sequence(targets):
+    '''Points the id_sequence of the primary past the ids loaded in every
+    shard'''
+    sequence = IdSequence.__table__
+    for table in TABLES:
+        if table.name not in SHARDED_TABLES:
+            continue
+        last = max(connection.scalar(db.select([db.func.max(table.c.id)]))
+                   or 0 for connection in targets.connections.values())
+        targets.primary.execute(sequence.delete().where(
+            sequence.c.name == table.name))
+        targets.primary.execute(
+            sequence.insert(), name=table.name, next_id=last + 1)
+
+
+def load(engine, path, format='ndjson', size=10000, shards=None):
+    '''Loads a dump written by dump() in a single transaction. shards maps
+    shard numbers to the engines the bucketlists and items of their users
+    go to, each loaded in a transaction of its own. Returns the Timer of
+    the tables.'''
+    timer = Timer()
+    engines = dict(shards or {})
+    engines[None] = engine
+    connections = {}
+    transactions = []
+    try:
+        for shard, shard_engine in engines.items():
+            connections[shard] = shard_engine.connect()
+            transactions.append(connections[shard].begin())
+        targets = Targets(connections)
+        if format == 'ndjson':
+            f = open(path, 'rb') if path != '-' else \
+                getattr(sys.stdin, 'buffer', sys.stdin)
+            try:
+                load_ndjson(targets, f, timer, size)
+            finally:
+                if path != '-':
+                    f.close()
+        else:
+            load_csv(targets, path, timer, size)
+        for shard, connection in connections.items():
+            # counters follow the items loaded, whatever the dump held
+            connection.execute(BucketList.recount())
+            if is_postgresql(connection):
+                reset_sequences(connection, TABLES if shard is None else [
+                    table for table in TABLES
+                    if table.name in SHARDED_TABLES])
+        if targets.sharded:
+            reset_id_sequence(targets)
+        for transaction in transactions:
+            transaction.commit()
+    except Exception:
+        for transaction in transactions:
+            if transaction.is_active:
+                transaction.rollback()
+        raise
+    finally:
+        for connection in connections.values():
+            connection.close()
+    return timer
@@ -0,0 +1,272 @@
+'''
+In-process caching for the API
+
+LRUCache follows the get/set/add/delete interface of werkzeug.contrib.cache,
+so any of werkzeug's cache clients (RedisCache, MemcachedCache, ...) can be
+configured instead wherever entries must be shared between processes.
+'''
+import hashlib
+import hmac
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import current_app
+
+
+class LRUCache(object):
+
+    '''Thread safe least recently used cache with per entry expiry'''
+
+    def __init__(self, maxsize=1024, default_timeout=300):
+        self.maxsize = maxsize
+        self.default_timeout = default_timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.time():
+                return None
+            # re-inserting marks the entry as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + timeout, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return True
+
+    def add(self, key, value, timeout=None):
+        '''Sets key unless it holds an entry already, returns whether it
+        did'''
+        if timeout is None:
+            timeout = self.default_timeout
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                return False
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + timeout, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        return True
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TokenCache(object):
+
+    '''Remembers verified auth tokens so that authenticating a request does
+    not need to check the signature and load the user again. Entries are
+    keyed on the token signature and expire together with the token.
+
+    Every entry holds the generation of its user it was cached in, and is
+    only used while that is still the user's generation. invalidate_user
+    deletes the generation, so a single write drops every token of the
+    user, with no list of them to update concurrently.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TOKEN_CACHE_SIZE', 4096)
+        app.config.setdefault('TOKEN_CACHE_BACKEND', None)
+        backend = app.config['TOKEN_CACHE_BACKEND']
+        if backend is None:
+            backend = LRUCache(maxsize=app.config['TOKEN_CACHE_SIZE'])
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['token_cache'] = backend
+
+    @property
+    def backend(self):
+        return current_app.extensions['token_cache']
+
+    @staticmethod
+    def token_key(token):
+        return 'token:' + token.rsplit('.', 1)[-1]
+
+    @staticmethod
+    def user_key(user_id):
+        return 'token-user:%d' % user_id
+
+    def get(self, token):
+        '''Returns the principal cached for token, if any'''
+        if not token:
+            return None
+        backend = self.backend
+        entry = backend.get(self.token_key(token))
+        if entry is None:
+            return None
+        generation, principal = entry
+        if backend.get(self.user_key(principal.id)) != generation:
+            return None
+        return principal
+
+    def set(self, token, principal, expires):
+        '''Caches principal for token until the token expires at the unix
+        time `expires`'''
+        timeout = int(expires - time.time())
+        if timeout <= 0:
+            return
+        backend = self.backend
+        # a generation started by another request is kept, read back what
+        # is there in case it lost
+        user_key = self.user_key(principal.id)
+        backend.add(user_key, uuid.uuid4().hex, timeout=timeout)
+        generation = backend.get(user_key)
+        if generation is None:
+            return
+        backend.set(self.token_key(token), (generation, principal),
+                    timeout=timeout)
+
+    def invalidate(self, token):
+        '''Forgets a single token, e.g. on logout'''
+        if token:
+            self.backend.delete(self.token_key(token))
+
+    def invalidate_user(self, user_id):
+        '''Forgets every token cached for a user, e.g. when it is deleted'''
+        self.backend.delete(self.user_key(user_id))
+
+
+class CredentialCache(object):
+
+    '''Remembers recently verified username/password pairs for a short time
+    so that clients sending Basic auth on every request skip the slow
+    password hash. Only a keyed HMAC of the credentials is stored and it is
+    compared in constant time.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CREDENTIAL_CACHE_TTL', 60)
+        app.config.setdefault('CREDENTIAL_CACHE_SIZE', 4096)
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['credential_cache'] = LRUCache(
+            maxsize=app.config['CREDENTIAL_CACHE_SIZE'],
+            default_timeout=app.config['CREDENTIAL_CACHE_TTL'])
+
+    @property
+    def backend(self):
+        return current_app.extensions['credential_cache']
+
+    @staticmethod
+    def digest(username, password):
+        message = b'\0'.join(
+            value if isinstance(value, bytes) else value.encode('utf-8')
+            for value in (username, password))
+        return hmac.new(
+            current_app.config['SECRET_KEY'].encode('utf-8'),
+            message, hashlib.sha256).hexdigest()
+
+    def get(self, username, password):
+        '''Returns the principal if these credentials were verified
+        recently'''
+        if not username or password is None:
+            return None
+        entry = self.backend.get('credentials:' + username)
+        if entry is None:
+            return None
+        digest, principal = entry
+        if hmac.compare_digest(
+                digest, self.digest(username, password)):
+            return principal
+        return None
+
+    def set(self, username, password, principal):
+        if current_app.config['CREDENTIAL_CACHE_TTL'] > 0:
+            self.backend.set(
+                'credentials:' + username,
+                (self.digest(username, password), principal))
+
+    def invalidate(self, username):
+        '''Forgets the credentials of a user, e.g. on a password change'''
+        self.backend.delete('credentials:' + username)
+
+
+class ResponseCache(object):
+
+    '''Keeps the serialized body of GET responses per user along with their
+    ETag. A cached body is only served while its ETag still matches the
+    one computed from the database, and writes by the user drop all of
+    their entries.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESPONSE_CACHE_SIZE', 1024)
+        app.config.setdefault('RESPONSE_CACHE_TTL', 300)
+        app.config.setdefault('RESPONSE_CACHE_BACKEND', None)
+        backend = app.config['RESPONSE_CACHE_BACKEND']
+        if backend is None:
+            backend = LRUCache(
+                maxsize=app.config['RESPONSE_CACHE_SIZE'],
+                default_timeout=app.config['RESPONSE_CACHE_TTL'])
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['response_cache'] = backend
+
+    @property
+    def backend(self):
+        return current_app.extensions['response_cache']
+
+    @staticmethod
+    def user_key(user_id):
+        return 'response-user:%d' % user_id
+
+    def get(self, user_id, path, etag):
+        '''Returns the body cached for path if it has this etag'''
+        entry = self.backend.get('response:%d:%s' % (user_id, path))
+        if entry is not None and entry[0] == etag:
+            return entry[1]
+        return None
+
+    def set(self, user_id, path, etag, body):
+        backend = self.backend
+        key = 'response:%d:%s' % (user_id, path)
+        backend.set(key, (etag, body))
+
+        # remember the user's entries so their writes can drop them all
+        user_key = self.user_key(user_id)
+        keys = backend.get(user_key) or []
+        if key not in keys:
+            backend.set(user_key, keys + [key])
+
+    def invalidate_user(self, user_id):
+        '''Forgets every response cached for a user'''
+        backend = self.backend
+        user_key = self.user_key(user_id)
+        for key in backend.get(user_key) or []:
+            backend.delete(key)
+        backend.delete(user_key)
@@ -0,0 +1,107 @@
+'''
+Sparse fieldsets for serialized resources
+
+Clients pick the fields of a resource with ?fields= and the relations to
+embed with ?expand=, both comma separated and dotted for nested
+resources:
+
+    /users/?expand=bucketlists&fields=username,bucketlists.name
+    /bucketlists/?fields=id,name,items.done
+    /bucketlists/?include_items=false
+
+Without them every field and relation is returned. The models read a
+FieldSet to decide which columns to select and which relations to query
+at all, so data that was not asked for is never loaded.
+'''
+from flask import request
+
+
+class FieldSet(object):
+
+    '''Fields of a resource to serialize and relations to embed.
+
+    fields maps field names to the fields tree of the resource they embed
+    (None for all of its fields), or is None for every field. expand maps
+    relations to their own expand tree, or is None to embed everything.
+    '''
+
+    def __init__(self, fields=None, expand=None):
+        self.fields = fields
+        self.expand = expand
+
+    def __contains__(self, name):
+        return self.fields is None or name in self.fields
+
+    def nested(self, relation):
+        '''Returns the FieldSet of an embedded relation, or None when the
+        relation is not embedded'''
+        if relation not in self:
+            return None
+        if self.expand is not None and relation not in self.expand:
+            return None
+        return FieldSet(
+            None if self.fields is None else self.fields[relation],
+            None if self.expand is None else self.expand[relation] or {})
+
+
+# every field and relation
+EVERYTHING = FieldSet()
+
+
+def path_tree(value):
+    '''Parses 'a,b.c' into {'a': None, 'b': {'c': None}}'''
+    tree = {}
+    for path in value.split(','):
+        names = [name.strip() for name in path.split('.')]
+        if not all(names):
+            continue
+        node = tree
+        for name in names[:-1]:
+            if name in node and node[name] is None:
+                break  # the whole resource is already selected
+            node = node.setdefault(name, {})
+        else:
+            node[names[-1]] = None
+    return tree
+
+
+def validate(tree, model, relations_only=False):
+    '''Raises ValueError for names model does not serialize'''
+    for name, subtree in tree.items():
+        relation = model.json_relations.get(name)
+        if name not in model.json_fields or \
+                relations_only and relation is None:
+            raise ValueError('unknown field %s' % name)
+        if subtree is not None:
+            if relation is None:
+                raise ValueError('%s has no fields' % name)
+            validate(subtree, relation, relations_only)
+
+
+def expand_all(model):
+    return dict((name, expand_all(relation))
+                for name, relation in model.json_relations.items())
+
+
+def without(tree, relation):
+    '''Returns the expand tree without relation at any depth'''
+    return dict((name, without(subtree or {}, relation))
+                for name, subtree in tree.items() if name != relation)
+
+
+def requested_fields(model):
+    '''Returns the FieldSet asked for by the fields, expand and
+    include_items arguments of the request. Raises ValueError for names
+    model does not serialize.'''
+    fields = request.args.get('fields')
+    expand = request.args.get('expand')
+    if fields is not None:
+        fields = path_tree(fields)
+        validate(fields, model)
+    if expand is not None:
+        expand = path_tree(expand)
+        validate(expand, model, relations_only=True)
+    if request.args.get('include_items') == 'false':
+        expand = without(
+            expand if expand is not None else expand_all(model), 'items')
+    return FieldSet(fields, expand)
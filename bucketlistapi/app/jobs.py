@@ -0,0 +1,266 @@
+'''
+Background jobs
+
+Operations too slow for a request (deleting large bucketlists, exports and
+imports) are queued as rows of the job table and answered with 202 Accepted
+and the URL of the job, which clients poll until its state is done or
+failed. Pools of worker threads run them, in `python manage.py worker`
+processes or inside every web process with JOB_WORKERS_IN_PROCESS.
+
+A worker claims a queued job with UPDATE ... WHERE state = 'queued', so any
+number of workers share the table and only the one whose update matched
+runs the job. A job still running after JOB_TIMEOUT seconds is taken to
+have died with its worker and is queued again, until it was attempted
+JOB_MAX_ATTEMPTS times, so handlers must be safe to run twice.
+
+Files written by jobs (exports) go to JOB_RESULTS_DIR and are deleted by
+idle workers JOB_RESULTS_TTL seconds after they were written.
+
+TableQueue keeps the jobs in the app's database (SQLite locally), JOB_QUEUE
+takes any other object with its methods. claim() skips the jobs of users
+being moved to another shard (user.moving).
+'''
+import json
+import logging
+import os
+import signal
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+# the models and db are imported where used, app/__init__ imports this
+# module before creating them
+
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+# candidates read per claim, in case other workers take the first ones
+CLAIM_CANDIDATES = 10
+
+logger = logging.getLogger(__name__)
+
+
+class TableQueue(object):
+
+    '''Jobs kept as rows of the job table'''
+
+    def put(self, kind, payload, creator_id):
+        '''Queues a job, flushed with the caller's transaction. Returns the
+        same job still queued or running if there is one.'''
+        from .models import Job
+        payload = json.dumps(payload, sort_keys=True)
+        job = Job.query.filter(
+            Job.creator_id == creator_id, Job.kind == kind,
+            Job.state.in_((QUEUED, RUNNING)), Job.payload == payload
+        ).first()
+        if job is None:
+            job = Job(kind=kind, state=QUEUED, creator_id=creator_id,
+                      payload=payload, attempts=0,
+                      date_created=datetime.now())
+            job.save()
+        return job
+
+    def get(self, job_id):
+        from .models import Job
+        return Job.query.get(job_id)
+
+    def claim(self):
+        '''Marks the oldest queued job running and returns it, None when
+        there is none'''
+        from . import db
+        from .models import Job, User
+        # jobs of users being moved to another shard wait for the move
+        moving = db.session.query(User.id).filter(User.moving)
+        candidates = db.session.query(Job.id).filter(
+            Job.state == QUEUED, ~Job.creator_id.in_(moving)
+        ).order_by(Job.id).limit(CLAIM_CANDIDATES).all()
+        for job_id, in candidates:
+            claimed = Job.query.filter(
+                Job.id == job_id, Job.state == QUEUED
+            ).update({
+                'state': RUNNING,
+                'date_started': datetime.now(),
+                'attempts': Job.attempts + 1
+            }, synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return Job.query.get(job_id)
+        return None
+
+    def finish(self, job, result=None, error=None):
+        '''Records the result of a job, or the error it failed with'''
+        from . import db
+        job.state = FAILED if error is not None else DONE
+        job.result = json.dumps(result) if result is not None else None
+        job.error = error
+        job.date_finished = datetime.now()
+        db.session.add(job)
+        db.session.commit()
+
+    def requeue_lost(self, timeout, max_attempts):
+        '''Queues again the jobs running for longer than timeout seconds,
+        fails those attempted max_attempts times already'''
+        from . import db
+        from .models import Job
+        lost = Job.query.filter(
+            Job.state == RUNNING,
+            Job.date_started < datetime.now() - timedelta(seconds=timeout))
+        lost.filter(Job.attempts >= max_attempts).update({
+            'state': FAILED,
+            'error': 'lost with its worker %d times' % max_attempts,
+            'date_finished': datetime.now()
+        }, synchronize_session=False)
+        lost.update({'state': QUEUED}, synchronize_session=False)
+        db.session.commit()
+
+
+class JobRunner(object):
+
+    '''Registry of the job handlers, queues and runs jobs'''
+
+    def __init__(self, app=None):
+        self.handlers = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('JOB_QUEUE', None)
+        app.config.setdefault('JOB_WORKERS', 2)
+        app.config.setdefault('JOB_WORKERS_IN_PROCESS', 0)
+        app.config.setdefault('JOB_POLL_INTERVAL', 1.0)
+        app.config.setdefault('JOB_TIMEOUT', 3600)
+        app.config.setdefault('JOB_MAX_ATTEMPTS', 3)
+        app.config.setdefault('JOB_RESULTS_TTL', 86400)
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['jobs'] = app.config['JOB_QUEUE'] or TableQueue()
+
+        workers = app.config['JOB_WORKERS_IN_PROCESS']
+        if workers:
+            # started in the process serving requests, after any fork
+            app.before_first_request(WorkerPool(app, self, workers).start)
+
+    @property
+    def queue(self):
+        return current_app.extensions['jobs']
+
+    def handler(self, kind):
+        '''Decorator registering f(job, **payload) as the handler of the
+        jobs of kind, its json result is stored with the job'''
+        def decorator(f):
+            self.handlers[kind] = f
+            return f
+        return decorator
+
+    def enqueue(self, kind, creator_id, **payload):
+        '''Queues a job of kind, committed along with the request'''
+        if kind not in self.handlers:
+            raise ValueError('no handler for %s jobs' % kind)
+        return self.queue.put(kind, payload, creator_id)
+
+    def run_next(self):
+        '''Runs the next queued job, returns it or None when there was
+        none'''
+        from . import db
+        from .shards import shard_router
+        queue = self.queue
+        job = queue.claim()
+        if job is None:
+            queue.requeue_lost(current_app.config['JOB_TIMEOUT'],
+                               current_app.config['JOB_MAX_ATTEMPTS'])
+            self.remove_expired_results()
+            return None
+
+        try:
+            # handlers work on the bucketlists of the job's creator
+            with shard_router.for_user(job.creator_id):
+                result = self.handlers[job.kind](
+                    job, **json.loads(job.payload))
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            logger.exception('job %d (%s) failed', job.id, job.kind)
+            queue.finish(job, error=traceback.format_exc().splitlines()[-1])
+        else:
+            queue.finish(job, result)
+        return job
+
+    def remove_expired_results(self):
+        '''Deletes the files of JOB_RESULTS_DIR older than JOB_RESULTS_TTL
+        seconds, returns how many'''
+        directory = current_app.config['JOB_RESULTS_DIR']
+        if not os.path.isdir(directory):
+            return 0
+        expired = time.time() - current_app.config['JOB_RESULTS_TTL']
+        count = 0
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+                    count += 1
+            except OSError:
+                # removed by another worker meanwhile
+                pass
+        return count
+
+    def run_pending(self):
+        '''Runs jobs until the queue is empty, returns how many ran'''
+        count = 0
+        while self.run_next() is not None:
+            count += 1
+        return count
+
+
+class WorkerPool(object):
+
+    '''Threads running the queued jobs of app until stopped'''
+
+    def __init__(self, app, runner, workers):
+        self.app = app
+        self.runner = runner
+        self.workers = workers
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def start(self):
+        for n in range(self.workers):
+            thread = threading.Thread(
+                target=self.work, name='job-worker-%d' % n)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        interval = self.app.config['JOB_POLL_INTERVAL']
+        while not self.stopping.is_set():
+            try:
+                with self.app.app_context():
+                    job = self.runner.run_next()
+            except Exception:
+                # e.g. the database is down, try again after a while
+                logger.exception('job worker error')
+                job = None
+            if job is None:
+                self.stopping.wait(interval)
+
+    def stop(self):
+        '''Lets the jobs being run finish and stops the threads'''
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+
+    def run(self):
+        '''Runs the pool in the foreground until TERM or INT'''
+        def stop(signum, frame):
+            self.stopping.set()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        self.start()
+        while not self.stopping.is_set():
+            # with a timeout, so Python 2 still delivers signals
+            self.stopping.wait(1)
+        self.stop()
@@ -0,0 +1,61 @@
+'''
+Lightweight latency metrics
+'''
+import threading
+from bisect import bisect_left
+
+
+# bucket upper bounds in seconds, growing by 20% from 0.1ms to ~3 minutes
+BUCKET_BOUNDS = [0.0001 * 1.2 ** n for n in range(80)]
+
+
+class Histogram(object):
+
+    '''Thread safe latency histogram over fixed exponential buckets.
+    Recording is O(1) in memory and percentiles are accurate to within one
+    bucket (20%), which is plenty for spotting slow paths.
+    '''
+
+    def __init__(self):
+        self._counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        bucket = bisect_left(BUCKET_BOUNDS, seconds)
+        with self._lock:
+            self._counts[bucket] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, fraction):
+        '''Returns the upper bound of the bucket holding the given fraction
+        of observations, capped at the largest value seen'''
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = fraction * self.count
+            seen = 0
+            for bucket, count in enumerate(self._counts):
+                seen += count
+                if seen >= rank and count:
+                    break
+            if bucket == len(BUCKET_BOUNDS):
+                return self.max
+            return min(BUCKET_BOUNDS[bucket], self.max)
+
+    def to_json(self):
+        '''Summary of the histogram in milliseconds'''
+        return {
+            'count': self.count,
+            'mean_ms': round(1000 * self.total / self.count, 3)
+            if self.count else 0.0,
+            'max_ms': round(1000 * self.max, 3),
+            'p50_ms': round(1000 * self.percentile(0.50), 3),
+            'p95_ms': round(1000 * self.percentile(0.95), 3),
+            'p99_ms': round(1000 * self.percentile(0.99), 3),
+        }
@@ -1,16 +1,60 @@
 '''
 Models for bucketlist API
 '''
-from passlib.apps import custom_app_context as pwd_context
 from itsdangerous import (
     TimedJSONWebSignatureSerializer as Serializer,
     BadSignature, SignatureExpired
 )
-from flask import url_for, current_app, g
+from flask import current_app, g
 
-from . import db
+from . import (
+    db, token_cache, credential_cache, password_hasher, url_templates)
+from .profiling import profiled_serialization
+from .shards import shard_router
+from .fields import EVERYTHING
+from .serializers import http_date
 
-from datetime import datetime
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import event
+import json
+import os
+
+
+# largest number of ids sent in a single IN (...) clause
+IN_CLAUSE_CHUNK = 500
+
+
+# json dicts of rows with the fields asked for, getters pairs every field
+# with a function reading it from a row, or None for relations that are
+# not embedded
+def select(rows, fields, getters):
+    getters = [(field, get) for field, get in getters
+               if get is not None and field in fields]
+    return [dict((field, get(row)) for field, get in getters)
+            for row in rows]
+
+
+# splits a list of ids into IN (...) sized chunks
+def chunked(ids, size=IN_CLAUSE_CHUNK):
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+# generate timed authentication token for a user id
+def generate_auth_token(user_id, expiration=600):
+    s = Serializer(current_app.config['SECRET_KEY'], expires_in=expiration)
+    return s.dumps({'id': user_id})
+
+
+class AuthPrincipal(namedtuple('AuthPrincipal', ['id', 'username'])):
+
+    '''Lightweight stand-in for a User authenticated from a cached token'''
+    __slots__ = ()
+
+    def generate_auth_token(self, expiration=600):
+        return generate_auth_token(self.id, expiration)
 
 
 class Base(db.Model):
@@ -22,14 +66,15 @@ class Base(db.Model):
     date_created = db.Column(db.DateTime)
 
     # saves
+    # changes are flushed, the request or transaction() commits them
     def save(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
 
     # deletes
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        db.session.flush()
 
 
 class User(Base):
@@ -38,57 +83,124 @@ class User(Base):
     __tablename__ = 'user'
     username = db.Column(db.String(64), unique=True, index=True)
     password_hash = db.Column(db.String(128))
+    # shard holding the user's bucketlists and items, None for the primary
+    # database, see app/shards.py
+    shard = db.Column(db.Integer)
+    # set while the user's bucketlists and items are moved to another shard,
+    # see app/rebalance.py
+    moving = db.Column(db.Boolean)
+    # bucketlists do not join their creator, who may be in another database
     bucketlists = db.relationship('BucketList', backref=db.backref(
-        'bucketlist', lazy='joined'), lazy='dynamic', uselist=True)
+        'bucketlist', lazy='select'), lazy='dynamic', uselist=True)
 
     # perform hashing on password
     def hash_password(self, password):
-        self.password_hash = pwd_context.encrypt(password)
+        self.password_hash = password_hasher.encrypt(password)
+        if self.username:
+            credential_cache.invalidate(self.username)
 
     # verify hashed password
     def verify_password(self, password):
-        return pwd_context.verify(password, self.password_hash)
+        return password_hasher.verify(password, self.password_hash)
 
     # generate timed authentication token
     def generate_auth_token(self, expiration=600):
-        s = Serializer(current_app.config['SECRET_KEY'], expires_in=expiration)
-        return s.dumps({'id': self.id})
+        return generate_auth_token(self.id, expiration)
 
     # verify authentication token
+    # returns an AuthPrincipal when the token was verified before
     @staticmethod
     def verify_auth_token(token):
+        principal = token_cache.get(token)
+        if principal is not None:
+            return principal
         s = Serializer(current_app.config['SECRET_KEY'])
         try:
-            data = s.loads(token)
+            data, header = s.loads(token, return_header=True)
         except SignatureExpired:
             return None  # valid token, but expired
         except BadSignature:
             return None  # invalid token
         user = User.query.get(data['id'])
+        if user is not None:
+            token_cache.set(
+                token, AuthPrincipal(user.id, user.username), header['exp'])
         return user
 
     # json format
-    def to_json(self):
-        bucketlists = [item.to_json() for item in self.bucketlists]
-        json_user = {
-            'username': self.username,
-            'user_url': url_for(
-                'api_1.get_user', username=self.username, _external=True
-            ),
-            'bucketlists': bucketlists
-        }
-        return json_user
+    def to_json(self, fields=EVERYTHING):
+        return User.bulk_to_json([self], fields)[0]
+
+    # selects the columns read by bulk_to_json as row tuples, which skips
+    # building objects on list endpoints
+    @staticmethod
+    def json_rows(query, fields=EVERYTHING):
+        return query.with_entities(User.id, User.username, User.shard)
+
+    # json format for many users or user rows, loading their bucketlists
+    # in bulk unless fields leaves them out. The bucketlists of users on
+    # different shards are loaded in parallel
+    @staticmethod
+    @profiled_serialization
+    def bulk_to_json(users, fields=EVERYTHING):
+        bucketlist_fields = fields.nested('bucketlists')
+        json_bucketlists = {}
+        if bucketlist_fields is not None:
+            def user_bucketlists(user_ids):
+                bucketlists = []
+                for ids in chunked(user_ids):
+                    bucketlists.extend(BucketList.json_rows(
+                        BucketList.query.filter(
+                            BucketList.creator_id.in_(ids)
+                        ).order_by(BucketList.id), bucketlist_fields,
+                        with_creator=True))
+                return [(bucketlist.creator_id, json_bucketlist)
+                        for bucketlist, json_bucketlist in zip(
+                            bucketlists, BucketList.bulk_to_json(
+                                bucketlists, bucketlist_fields))]
+
+            shards = {}
+            for user in users:
+                shards.setdefault(user.shard, []).append(user.id)
+            for pairs in shard_router.gather(
+                    user_bucketlists, shards.items()):
+                for creator_id, json_bucketlist in pairs:
+                    json_bucketlists.setdefault(creator_id, []).append(
+                        json_bucketlist)
+
+        user_url = url_templates.get('api_1.get_user', 'username')
+        return select(users, fields, [
+            ('username', lambda user: user.username),
+            ('user_url', lambda user: user_url.build(username=user.username)),
+            ('bucketlists', None if bucketlist_fields is None
+             else lambda user: json_bucketlists.get(user.id, [])),
+        ])
 
 
 class BucketList(Base):
 
     '''BucketList Table'''
     __tablename__ = 'bucketlist'
+    # unique within each shard only, see app/shards.py
     name = db.Column(db.String(64), unique=True, index=True)
     date_modified = db.Column(db.DateTime)
     creator_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # number of items and of done items, kept by every write to the items
+    # so listings never count them
+    item_count = db.Column(db.Integer, nullable=False, default=0,
+                           server_default='0')
+    done_count = db.Column(db.Integer, nullable=False, default=0,
+                           server_default='0')
+    # every bucketlist lookup and listing is scoped to its creator
+    __table_args__ = (
+        db.Index('ix_bucketlist_creator_id_id', 'creator_id', 'id'),
+        db.Index('ix_bucketlist_creator_id_date_created_id',
+                 'creator_id', 'date_created', 'id'),
+    )
+    # delete() removes the items itself, without loading them
     bucketitems = db.relationship('BucketItem', backref=db.backref(
-        'bucketitem', lazy='joined'), lazy='dynamic', uselist=True)
+        'bucketitem', lazy='joined'), lazy='dynamic', uselist=True,
+        passive_deletes=True)
 
     # instantiate bucketlist fields at creation
     def create(self):
@@ -102,33 +214,161 @@ class BucketList(Base):
         self.date_modified = datetime.now()
         self.save()
 
+    # deletes the bucketlist and its items, with one statement for them
+    def delete(self):
+        BucketItem.query.filter_by(bucketlist_id=self.id).delete(
+            synchronize_session=False)
+        super(BucketList, self).delete()
+
+    # mark bucketlist as modified when its items change
+    def touch(self):
+        self.date_modified = datetime.now()
+
+    # adds to the counters of items and done items, negative to subtract.
+    # The UPDATE adds to the stored values, so concurrent requests do not
+    # overwrite each other's counts
+    def count_items(self, items=0, done=0):
+        if not items and not done:
+            return
+        self.item_count = BucketList.item_count + items
+        self.done_count = BucketList.done_count + done
+        self.save()
+
+    # UPDATE setting the counters from the items, of every bucketlist or of
+    # those matching where
+    @staticmethod
+    def recount(where=None):
+        items = BucketItem.__table__
+
+        def count(*criteria):
+            return db.select([db.func.count(items.c.id)]).where(db.and_(
+                items.c.bucketlist_id == BucketList.__table__.c.id,
+                *criteria)).as_scalar()
+
+        update = BucketList.__table__.update().values(
+            item_count=count(),
+            done_count=count(items.c.done == db.true()))
+        return update if where is None else update.where(where)
+
+    # rows of (id, item_count, done_count, items, done items) of the
+    # bucketlists whose counters differ from their items
+    @staticmethod
+    def count_drift():
+        counts = db.session.query(
+            BucketItem.bucketlist_id,
+            db.func.count(BucketItem.id).label('item_total'),
+            db.func.sum(db.case([(BucketItem.done == db.true(), 1)],
+                                else_=0)).label('done_total')
+        ).group_by(BucketItem.bucketlist_id).subquery()
+        items = db.func.coalesce(counts.c.item_total, 0)
+        done = db.func.coalesce(counts.c.done_total, 0)
+        return db.session.query(
+            BucketList.id, BucketList.item_count, BucketList.done_count,
+            items, done
+        ).outerjoin(counts, counts.c.bucketlist_id == BucketList.id).filter(
+            db.or_(BucketList.item_count != items,
+                   BucketList.done_count != done)
+        ).order_by(BucketList.id).all()
+
     # json format
-    def to_json(self):
-        items = [item.to_json() for item in self.bucketitems]
-        json_bucketlist = {
-            'id': self.id,
-            'name': self.name,
-            'created_by': User.query.get(self.creator_id).username,
-            'date_created': self.date_created,
-            'last_modified': self.date_modified,
-            'items': items,
-            'bucketlist_url': url_for(
-                'api_1.bucketlist',
-                bucketlist_id=self.id,
-                _external=True
-            ),
-        }
-        return json_bucketlist
+    def to_json(self, fields=EVERYTHING):
+        return BucketList.bulk_to_json([self], fields)[0]
+
+    # selects the columns read by bulk_to_json as row tuples, which skips
+    # building objects and joining their creators on list endpoints. The
+    # id and dates are always selected for paging and ETags.
+    @staticmethod
+    def json_rows(query, fields=EVERYTHING, with_creator=False):
+        columns = [
+            BucketList.id, BucketList.date_created, BucketList.date_modified]
+        columns.extend(
+            column for field, column in (
+                ('name', BucketList.name),
+                ('item_count', BucketList.item_count),
+                ('done_count', BucketList.done_count)
+            ) if field in fields)
+        if 'created_by' in fields or with_creator:
+            columns.append(BucketList.creator_id)
+        return query.with_entities(*columns)
+
+    # json format for many bucketlists or bucketlist rows
+    # creators and items are fetched with one IN (...) query each instead
+    # of one query per bucketlist, and only when fields asks for them
+    @staticmethod
+    @profiled_serialization
+    def bulk_to_json(bucketlists, fields=EVERYTHING):
+        creators = {}
+        if 'created_by' in fields:
+            creator_ids = set(
+                bucketlist.creator_id for bucketlist in bucketlists)
+            for ids in chunked(creator_ids):
+                creators.update(db.session.query(
+                    User.id, User.username).filter(User.id.in_(ids)))
+
+        item_fields = fields.nested('items')
+        items = {}
+        more_items = {}
+        if item_fields is not None:
+            limit = current_app.config['EMBEDDED_ITEMS_LIMIT']
+            for ids in chunked(bucketlist.id for bucketlist in bucketlists):
+                rows = BucketItem.first_rows(ids, item_fields, limit)
+                for row, json_item in zip(
+                        rows, BucketItem.bulk_to_json(rows, item_fields)):
+                    items.setdefault(row.bucketlist_id, []).append(
+                        (row.id, json_item))
+
+            # lists holding more items link to the next page of them
+            from .api_1.pagination import encode_cursor
+            for bucketlist_id, rows in items.items():
+                if limit and len(rows) > limit:
+                    rows = rows[:limit]
+                    more_items[bucketlist_id] = encode_cursor([rows[-1][0]])
+                items[bucketlist_id] = [json_item for _, json_item in rows]
+
+        bucketlist_url = url_templates.get(
+            'api_1.bucketlist', 'bucketlist_id')
+        items_url = url_templates.get('api_1.bucketitems', 'bucketlist_id')
+        items_next = url_templates.get(
+            'api_1.bucketitems', 'bucketlist_id', 'cursor')
+        return select(bucketlists, fields, [
+            ('id', lambda bucketlist: bucketlist.id),
+            ('name', lambda bucketlist: bucketlist.name),
+            ('created_by',
+             lambda bucketlist: creators.get(bucketlist.creator_id)),
+            ('date_created',
+             lambda bucketlist: http_date(bucketlist.date_created)),
+            ('last_modified',
+             lambda bucketlist: http_date(bucketlist.date_modified)),
+            ('item_count', lambda bucketlist: bucketlist.item_count),
+            ('done_count', lambda bucketlist: bucketlist.done_count),
+            ('items', None if item_fields is None
+             else lambda bucketlist: items.get(bucketlist.id, [])),
+            ('items_url', lambda bucketlist: items_url.build(
+                bucketlist_id=bucketlist.id)),
+            ('items_next', None if item_fields is None
+             else lambda bucketlist: items_next.build(
+                 bucketlist_id=bucketlist.id,
+                 cursor=more_items[bucketlist.id])
+             if bucketlist.id in more_items else None),
+            ('bucketlist_url', lambda bucketlist: bucketlist_url.build(
+                bucketlist_id=bucketlist.id)),
+        ])
 
 
 class BucketItem(Base):
 
     '''BucketItem Table'''
     __tablename__ = 'bucketitem'
+    # unique within each shard only, as bucketlist names
     name = db.Column(db.String(64), unique=True, index=True)
     date_modified = db.Column(db.DateTime)
     done = db.Column(db.Boolean)
     bucketlist_id = db.Column(db.Integer, db.ForeignKey('bucketlist.id'))
+    # serve paging through and filtering the items of one bucketlist
+    __table_args__ = (
+        db.Index('ix_bucketitem_bucketlist_id_id', 'bucketlist_id', 'id'),
+        db.Index('ix_bucketitem_bucketlist_id_done', 'bucketlist_id', 'done'),
+    )
 
     # intantiate bucketitems fields at creation
     def create(self):
@@ -136,13 +376,137 @@ class BucketItem(Base):
         self.date_modified = datetime.now()
         self.done = False
 
+    # json format
+    def to_json(self, fields=EVERYTHING):
+        return BucketItem.bulk_to_json([self], fields)[0]
+
+    # rows of the first limit + 1 items of each of the bucketlists, one
+    # window query for all of them. limit None reads every item
+    @staticmethod
+    def first_rows(bucketlist_ids, fields=EVERYTHING, limit=None):
+        query = BucketItem.json_rows(BucketItem.query.filter(
+            BucketItem.bucketlist_id.in_(bucketlist_ids)), fields)
+        if not limit:
+            return query.order_by(BucketItem.id).all()
+        numbered = query.add_columns(db.func.row_number().over(
+            partition_by=BucketItem.bucketlist_id,
+            order_by=BucketItem.id
+        ).label('position')).subquery()
+        return db.session.query(numbered).filter(
+            numbered.c.position <= limit + 1
+        ).order_by(numbered.c.id).all()
+
+    # selects the columns read by bulk_to_json as row tuples
+    @staticmethod
+    def json_rows(query, fields=EVERYTHING):
+        columns = [BucketItem.id, BucketItem.bucketlist_id]
+        columns.extend(
+            column for field, column in (
+                ('name', BucketItem.name),
+                ('date_created', BucketItem.date_created),
+                ('last_modified', BucketItem.date_modified),
+                ('done', BucketItem.done)
+            ) if field in fields)
+        return query.with_entities(*columns)
+
+    # json format for many bucketitems or bucketitem rows
+    @staticmethod
+    @profiled_serialization
+    def bulk_to_json(items, fields=EVERYTHING):
+        return select(items, fields, [
+            ('id', lambda item: item.id),
+            ('name', lambda item: item.name),
+            ('date_created', lambda item: http_date(item.date_created)),
+            ('last_modified', lambda item: http_date(item.date_modified)),
+            ('done', lambda item: item.done),
+        ])
+
+
+class IdSequence(db.Model):
+
+    '''IdSequence Table, the next id of each sharded table, see
+    app/shards.py'''
+    __tablename__ = 'id_sequence'
+    name = db.Column(db.String(64), primary_key=True)
+    next_id = db.Column(db.Integer, nullable=False)
+
+
+class Job(Base):
+
+    '''Job Table, the queue of background jobs, see app/jobs.py'''
+    __tablename__ = 'job'
+    kind = db.Column(db.String(64))
+    state = db.Column(db.String(16))
+    creator_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # json arguments of the handler and json result it returned
+    payload = db.Column(db.Text)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer)
+    date_started = db.Column(db.DateTime)
+    date_finished = db.Column(db.DateTime)
+    # workers claim the oldest queued jobs, users look up their own
+    __table_args__ = (
+        db.Index('ix_job_state_id', 'state', 'id'),
+        db.Index('ix_job_creator_id_id', 'creator_id', 'id'),
+    )
+
     # json format
     def to_json(self):
-        json_items = {
+        job_url = url_templates.get('api_1.job', 'job_id')
+        result_url = url_templates.get('api_1.job_result', 'job_id')
+        return {
             'id': self.id,
-            'name': self.name,
-            'date_created': self.date_created,
-            'last_modified': self.date_modified,
-            'done': self.done
+            'kind': self.kind,
+            'state': self.state,
+            'attempts': self.attempts,
+            'date_created': http_date(self.date_created),
+            'date_started': http_date(self.date_started),
+            'date_finished': http_date(self.date_finished),
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'job_url': job_url.build(job_id=self.id),
+            'result_url': result_url.build(job_id=self.id)
+            if self.has_file() else None,
         }
-        return json_items
+
+    # finished exports leave a file to download, until it expires
+    def has_file(self):
+        if self.kind != 'export_bucketlists' or self.state != 'done':
+            return False
+        return self.date_finished > datetime.now() - timedelta(
+            seconds=current_app.config['JOB_RESULTS_TTL'])
+
+    # file written by an export job, in the format it was asked for
+    def file_path(self):
+        return os.path.join(
+            current_app.config['JOB_RESULTS_DIR'], 'export-%d.%s' % (
+                self.id, json.loads(self.payload)['format']))
+
+
+# fields serialized by each model, and the models of embedded relations
+User.json_fields = ('username', 'user_url', 'bucketlists')
+User.json_relations = {'bucketlists': BucketList}
+BucketList.json_fields = (
+    'id', 'name', 'created_by', 'date_created', 'last_modified',
+    'item_count', 'done_count', 'items', 'items_url', 'items_next',
+    'bucketlist_url')
+BucketList.json_relations = {'items': BucketItem}
+BucketItem.json_fields = (
+    'id', 'name', 'date_created', 'last_modified', 'done')
+BucketItem.json_relations = {}
+
+
+# with shards, new users get one and rows of the sharded tables ids unique
+# over all of them
+@event.listens_for(User, 'before_insert')
+def assign_shard(mapper, connection, user):
+    if user.shard is None and shard_router.enabled:
+        user.shard = shard_router.choose_shard()
+
+
+@event.listens_for(BucketList, 'before_insert')
+@event.listens_for(BucketItem, 'before_insert')
+def assign_id(mapper, connection, target):
+    if target.id is None and shard_router.enabled:
+        target.id = shard_router.next_ids(mapper.mapped_table.name)[0]
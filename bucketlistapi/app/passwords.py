@@ -0,0 +1,39 @@
+'''
+Capping how many password hashes run at once
+'''
+import threading
+
+from flask import current_app
+from passlib.apps import custom_app_context as pwd_context
+
+
+class PasswordHasher(object):
+
+    '''Runs the deliberately slow passlib hashes on the calling thread, at
+    most PASSWORD_HASH_CONCURRENCY at a time per process. A burst of logins
+    waits for a slot instead of hashing on every request thread at once,
+    leaving the CPU to requests that need no hash.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_CONCURRENCY', 4)
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['password_hasher'] = threading.BoundedSemaphore(
+            app.config['PASSWORD_HASH_CONCURRENCY'])
+
+    @property
+    def slots(self):
+        return current_app.extensions['password_hasher']
+
+    def encrypt(self, password):
+        with self.slots:
+            return pwd_context.encrypt(password)
+
+    def verify(self, password, password_hash):
+        with self.slots:
+            return pwd_context.verify(password, password_hash)
@@ -0,0 +1,129 @@
+'''
+Connection pool configuration and instrumentation
+'''
+import threading
+import time
+
+from flask.ext.sqlalchemy import SQLAlchemy as BaseSQLAlchemy
+from sqlalchemy import exc, event
+from sqlalchemy.pool import QueuePool
+
+from .metrics import Histogram
+from .replicas import RoutingSession
+
+
+# options only understood by QueuePool
+QUEUE_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+class PoolMetrics(object):
+
+    '''Checkout latency and connection counts of one engine's pool'''
+
+    def __init__(self):
+        self.checkout = Histogram()
+        self.checked_out = 0
+        self.checkouts = 0
+        self.disconnects = 0
+        self._lock = threading.Lock()
+
+    def checked_out_one(self, seconds):
+        self.checkout.observe(seconds)
+        with self._lock:
+            self.checked_out += 1
+            self.checkouts += 1
+
+    def returned_one(self):
+        with self._lock:
+            self.checked_out -= 1
+
+    def to_json(self):
+        return {
+            'checked_out': self.checked_out,
+            'checkouts': self.checkouts,
+            'disconnects': self.disconnects,
+            'checkout_latency': self.checkout.to_json(),
+        }
+
+
+class InstrumentedPool(object):
+
+    '''Pool mixin timing every checkout. Subclasses are created per engine
+    by instrumented(), so metrics survive the pool being recreated.'''
+
+    metrics = None
+
+    def _do_get(self):
+        start = time.time()
+        connection = super(InstrumentedPool, self)._do_get()
+        self.metrics.checked_out_one(time.time() - start)
+        return connection
+
+    def _do_return_conn(self, connection):
+        self.metrics.returned_one()
+        return super(InstrumentedPool, self)._do_return_conn(connection)
+
+
+# pessimistic disconnect handling: a connection that fails a trivial query
+# is discarded and the pool retries with a fresh one
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        connection_proxy._pool.metrics.disconnects += 1
+        raise exc.DisconnectionError()
+    finally:
+        try:
+            cursor.close()
+        except Exception:
+            pass
+
+
+def instrumented(poolclass, pre_ping=False):
+    '''Returns a subclass of poolclass recording its own PoolMetrics'''
+    pool = type('Instrumented' + poolclass.__name__,
+                (InstrumentedPool, poolclass), {'metrics': PoolMetrics()})
+    if pre_ping:
+        event.listen(pool, 'checkout', ping_connection)
+    return pool
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+
+    '''Flask-SQLAlchemy with configurable pre-ping and pool metrics, whose
+    sessions send reads to replicas (see app/replicas.py)'''
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_POOL_PRE_PING', False)
+        super(SQLAlchemy, self).init_app(app)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+        poolclass = options.get('poolclass') or \
+            info.get_dialect().get_pool_class(info)
+        if not issubclass(poolclass, QueuePool):
+            # e.g. SQLite's NullPool takes no sizing options
+            for option in QUEUE_POOL_OPTIONS:
+                options.pop(option, None)
+        options['poolclass'] = instrumented(
+            poolclass, app.config['SQLALCHEMY_POOL_PRE_PING'])
+
+
+def pool_status(engine):
+    '''Returns the size and usage of an engine's pool'''
+    pool = engine.pool
+    status = {'class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'overflow': pool.overflow(),
+            'max_overflow': pool._max_overflow,
+        })
+    if isinstance(pool, InstrumentedPool):
+        status.update(pool.metrics.to_json())
+    return status
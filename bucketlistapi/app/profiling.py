@@ -0,0 +1,194 @@
+'''
+Per request profiling
+
+When PROFILE_REQUESTS is on, every request records its wall time, the
+number and total time of its SQL statements, its slowest statements and
+the time spent serializing models. The figures are sent back in a
+Server-Timing header and aggregated per endpoint for /api/v1/_metrics.
+Recording costs a couple of timestamps per statement, so it can stay on
+in production.
+'''
+import heapq
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .metrics import Histogram
+
+
+# slowest statements kept per request and per endpoint
+SLOWEST_STATEMENTS = 3
+
+
+class RequestProfile(object):
+
+    '''Measurements of a single request'''
+
+    def __init__(self):
+        self.start = time.time()
+        self.statements = []
+        self.sql_time = 0.0
+        self.serialize_time = 0.0
+        self.serialize_depth = 0
+
+    def add_statement(self, statement, seconds):
+        self.statements.append((seconds, statement))
+        self.sql_time += seconds
+
+    def slowest(self):
+        return heapq.nlargest(SLOWEST_STATEMENTS, self.statements)
+
+
+class EndpointMetrics(object):
+
+    '''Aggregated measurements of every request to one endpoint'''
+
+    def __init__(self):
+        self.wall = Histogram()
+        self.sql = Histogram()
+        self.serialize = Histogram()
+        self.queries = 0
+        self.max_queries = 0
+        self.slowest = []
+        self._lock = threading.Lock()
+
+    def record(self, profile, wall):
+        self.wall.observe(wall)
+        self.sql.observe(profile.sql_time)
+        self.serialize.observe(profile.serialize_time)
+        with self._lock:
+            self.queries += len(profile.statements)
+            self.max_queries = max(self.max_queries, len(profile.statements))
+            self.slowest = heapq.nlargest(
+                SLOWEST_STATEMENTS, self.slowest + profile.slowest())
+
+    def to_json(self):
+        count = self.wall.count
+        return {
+            'requests': count,
+            'wall': self.wall.to_json(),
+            'sql': self.sql.to_json(),
+            'serialize': self.serialize.to_json(),
+            'queries_per_request': round(float(self.queries) / count, 2)
+            if count else 0.0,
+            'max_queries': self.max_queries,
+            'slowest_statements': [
+                {'ms': round(1000 * seconds, 3), 'statement': statement}
+                for seconds, statement in self.slowest
+            ],
+        }
+
+
+def current_profile():
+    if has_request_context():
+        return getattr(g, '_profile', None)
+    return None
+
+
+def profiled_serialization(f):
+    '''Counts the time spent in f as serialization time of the request.
+    Nested calls are only counted once.'''
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        profile = current_profile()
+        if profile is None:
+            return f(*args, **kwargs)
+        start = time.time()
+        profile.serialize_depth += 1
+        try:
+            return f(*args, **kwargs)
+        finally:
+            profile.serialize_depth -= 1
+            if not profile.serialize_depth:
+                profile.serialize_time += time.time() - start
+    return decorated
+
+
+# a connection runs one statement at a time, whose cursor and start time
+# are kept until it ends or fails
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if current_profile() is not None:
+        conn.info['profile_start'] = (cursor, time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    profile = current_profile()
+    started = conn.info.pop('profile_start', None)
+    if profile is not None and started is not None and \
+            started[0] is cursor:
+        profile.add_statement(statement, time.time() - started[1])
+
+
+def handle_error(exception_context):
+    # failed statements are not timed, nor left behind for the next one
+    if exception_context.connection is not None:
+        exception_context.connection.info.pop('profile_start', None)
+
+
+class Profiler(object):
+
+    '''Records a RequestProfile for every request when PROFILE_REQUESTS is
+    set'''
+
+    _listening = False
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILE_REQUESTS', False)
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['profiler'] = {}
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+        # statements are timed on every engine, once per process
+        if not Profiler._listening:
+            event.listen(Engine, 'before_cursor_execute',
+                         before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         after_cursor_execute)
+            event.listen(Engine, 'handle_error', handle_error)
+            Profiler._listening = True
+
+    @staticmethod
+    def start_request():
+        if current_app.config['PROFILE_REQUESTS']:
+            g._profile = RequestProfile()
+
+    @staticmethod
+    def finish_request(response):
+        profile = current_profile()
+        if profile is None:
+            return response
+        g._profile = None
+        wall = time.time() - profile.start
+
+        response.headers['Server-Timing'] = ', '.join([
+            'sql;dur=%.3f;desc="%d queries"' % (
+                1000 * profile.sql_time, len(profile.statements)),
+            'serialize;dur=%.3f' % (1000 * profile.serialize_time),
+            'total;dur=%.3f' % (1000 * wall),
+        ])
+
+        endpoints = current_app.extensions['profiler']
+        endpoint = request.endpoint or 'unmatched'
+        if endpoint not in endpoints:
+            endpoints.setdefault(endpoint, EndpointMetrics())
+        endpoints[endpoint].record(profile, wall)
+        return response
+
+    @staticmethod
+    def metrics():
+        '''Returns the aggregated metrics of every endpoint'''
+        return dict(
+            (endpoint, metrics.to_json()) for endpoint, metrics in
+            current_app.extensions['profiler'].items())
@@ -0,0 +1,191 @@
+'''
+Request rate limiting with token buckets
+
+Every client gets a bucket per limited endpoint, holding up to `burst`
+tokens and refilled at `rate` tokens a second. A request takes one token;
+with none left it is refused with 429 Too Many Requests and a Retry-After
+of the time until the next token. Clients are the authenticated user, or
+the remote address before authentication (login and registration).
+
+Limits are written 'N/period', e.g. '10/minute', which allows bursts of N
+requests and N per period on average. RATELIMITS maps endpoints, or
+'METHOD endpoint' for a single method, to their limit and
+RATELIMIT_DEFAULT applies to every other limited endpoint.
+
+Endpoint limits apply once a request is authenticated, so password
+guesses are limited on their own: every username and password checked
+against the database, on any endpoint, takes a token of the
+RATELIMIT_PASSWORD_CHECKS bucket of that username and address before the
+hash runs. Clients behind one proxy or NAT share an address, but guessing
+one user's password does not lock the others out. Clients sending Basic
+auth on every request mostly hit the credential cache and take none.
+
+Buckets live in process by default. RATELIMIT_BACKEND takes any of
+werkzeug's cache clients (RedisCache, MemcachedCache, ...) to share them
+between processes, at the cost of a read and a write per request that are
+not atomic: concurrent requests of one client may both take the last token.
+'''
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, g, request
+from werkzeug.exceptions import TooManyRequests
+
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_limit(limit):
+    '''Parses 'N/period' into (rate per second, burst)'''
+    count, _, period = limit.partition('/')
+    count = int(count)
+    if count <= 0 or period.strip() not in PERIODS:
+        raise ValueError('invalid rate limit %r' % limit)
+    return float(count) / PERIODS[period.strip()], count
+
+
+def take(state, rate, burst, now):
+    '''Takes a token from a bucket state (tokens, updated), returns the new
+    state and the seconds to wait, 0 when a token was taken'''
+    if state is None:
+        tokens = burst
+    else:
+        tokens, updated = state
+        tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) / rate
+
+
+class MemoryBuckets(object):
+
+    '''Thread safe in-process buckets, the least recently used ones are
+    dropped beyond maxsize (which refills them)'''
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        with self._lock:
+            state, wait = take(
+                self._buckets.pop(key, None), rate, burst, now)
+            self._buckets[key] = state
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class CacheBuckets(object):
+
+    '''Buckets kept in a werkzeug cache client shared between processes'''
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def take(self, key, rate, burst):
+        state, wait = take(self.cache.get(key), rate, burst, time.time())
+        # a bucket left alone until full needs no entry
+        self.cache.set(key, state, timeout=int(math.ceil(burst / rate)) + 1)
+        return wait
+
+
+class RateLimitExceeded(TooManyRequests):
+
+    '''429 carrying the seconds until the client may retry'''
+
+    def __init__(self, retry_after):
+        super(RateLimitExceeded, self).__init__()
+        self.retry_after = int(math.ceil(retry_after))
+
+
+class RateLimiter(object):
+
+    '''Enforces the configured limits on the views it decorates'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_DEFAULT', None)
+        app.config.setdefault('RATELIMITS', {})
+        app.config.setdefault('RATELIMIT_SIZE', 65536)
+        app.config.setdefault('RATELIMIT_BACKEND', None)
+        app.config.setdefault('RATELIMIT_PASSWORD_CHECKS', '10/minute')
+        backend = app.config['RATELIMIT_BACKEND']
+        if backend is None:
+            buckets = MemoryBuckets(app.config['RATELIMIT_SIZE'])
+        else:
+            buckets = CacheBuckets(backend)
+        limits = dict((name, parse_limit(limit)) for name, limit in
+                      app.config['RATELIMITS'].items())
+        default = app.config['RATELIMIT_DEFAULT']
+        if default is not None:
+            default = parse_limit(default)
+        passwords = app.config['RATELIMIT_PASSWORD_CHECKS']
+        if passwords is not None:
+            passwords = parse_limit(passwords)
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['rate_limiter'] = (buckets, limits, default, passwords)
+
+    def limit(self, limit=None):
+        '''Decorator limiting a view to limit, or to the configured limit
+        of its endpoint'''
+        parsed = parse_limit(limit) if limit is not None else None
+
+        def decorator(f):
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                self.check(parsed)
+                return f(*args, **kwargs)
+            return decorated
+        return decorator
+
+    def check(self, limit=None):
+        '''Takes a token for the current client and endpoint, raises
+        RateLimitExceeded when there is none'''
+        if not current_app.config['RATELIMIT_ENABLED']:
+            return
+        buckets, limits, default, _ = current_app.extensions['rate_limiter']
+        name = '%s %s' % (request.method, request.endpoint)
+        if limit is None and name in limits:
+            limit = limits[name]
+        else:
+            name = request.endpoint
+            if limit is None:
+                limit = limits.get(name, default)
+        if limit is None:
+            return
+
+        user = getattr(g, 'user', None)
+        client = 'user:%d' % user.id if user is not None \
+            else 'ip:%s' % request.remote_addr
+        wait = buckets.take('ratelimit:%s:%s' % (name, client), *limit)
+        if wait:
+            raise RateLimitExceeded(wait)
+
+    def check_password(self, username):
+        '''Takes a token for checking the password of username sent from the
+        current address, raises RateLimitExceeded when there is none'''
+        if not current_app.config['RATELIMIT_ENABLED']:
+            return
+        buckets, _, _, limit = current_app.extensions['rate_limiter']
+        if limit is None:
+            return
+        # usernames may hold anything, cache keys may not
+        if not isinstance(username, bytes):
+            username = username.encode('utf-8')
+        user = hashlib.sha1(username).hexdigest()
+        wait = buckets.take('ratelimit:password:user:%s:ip:%s' % (
+            user, request.remote_addr), *limit)
+        if wait:
+            raise RateLimitExceeded(wait)
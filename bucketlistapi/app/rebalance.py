@@ -0,0 +1,242 @@
+'''
+Moving users and their bucketlists between shards, see app/shards.py
+
+move_user() copies a user's bucketlists and items to another shard while
+the user keeps using the old one. It then sets user.moving, which refuses
+the user's writes with 503 and holds back their jobs, waits
+SHARD_MOVE_GRACE seconds for the writes already under way, copies what
+changed in between, deletes what was deleted, points user.shard at the
+new shard clearing user.moving, and deletes the old rows. Rows keep
+their ids. Nothing is copied after the switch, so writes made on the new
+shard stay. A write still under way after SHARD_MOVE_GRACE seconds is
+lost with the old rows, and a move killed midway leaves the user's writes
+refused until it is run again.
+
+plan() decides the moves `python manage.py rebalance` makes: users still
+in the primary go to the lightest shard, then users move from the heaviest
+shard to the lightest one while that makes them closer. A user weighs its
+bucketlists plus their items, read from the item counters.
+'''
+import time
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import func, select
+
+from . import db
+from .jobs import RUNNING
+from .models import User, BucketList, BucketItem, Job, chunked
+from .shards import shard_router
+
+
+class UserBusy(Exception):
+
+    '''A job of the user was still running, the user was not moved'''
+
+
+# rows modified at the same time or later in source replace target's
+def modified(row):
+    return row['date_modified'] or datetime.min
+
+
+# inserts the rows of source_rows missing in target_rows and updates those
+# modified later in target_rows, leaves target rows newer than source's
+# alone. Returns the ids of target rows source_rows lacks.
+def apply_rows(connection, table, source_rows, target_rows):
+    target_rows = dict((row['id'], dict(row)) for row in target_rows)
+    source_ids = set()
+    inserted = []
+    for row in source_rows:
+        row = dict(row)
+        source_ids.add(row['id'])
+        old = target_rows.get(row['id'])
+        if old is None:
+            inserted.append(row)
+        elif old != row and modified(row) >= modified(old):
+            connection.execute(table.update().where(
+                table.c.id == row['id']).values(row))
+    if inserted:
+        connection.execute(table.insert(), inserted)
+    return [row_id for row_id in target_rows if row_id not in source_ids]
+
+
+def user_rows(connection, user_id):
+    '''Bucketlist and item rows of a user in one database'''
+    bucketlist = BucketList.__table__
+    item = BucketItem.__table__
+    bucketlists = connection.execute(bucketlist.select().where(
+        bucketlist.c.creator_id == user_id)).fetchall()
+    items = []
+    for ids in chunked(row['id'] for row in bucketlists):
+        items.extend(connection.execute(item.select().where(
+            item.c.bucketlist_id.in_(ids))).fetchall())
+    return bucketlists, items
+
+
+def delete_rows(connection, table, ids):
+    for chunk in chunked(ids):
+        connection.execute(table.delete().where(table.c.id.in_(chunk)))
+
+
+def delete_user_rows(connection, user_id):
+    bucketlists, items = user_rows(connection, user_id)
+    delete_rows(connection, BucketItem.__table__,
+                [item['id'] for item in items])
+    delete_rows(connection, BucketList.__table__,
+                [bucketlist['id'] for bucketlist in bucketlists])
+
+
+def sync(source, target, user_id, replace=False, mirror=False):
+    '''Copies the user's rows of source to target, in one transaction of
+    target: those target lacks, and those modified no earlier in source.
+    Target rows source lacks are kept, unless replace drops every row of
+    the user in target first, or mirror deletes them. Returns how many
+    bucketlists and items source has.'''
+    with source.connect() as reader:
+        bucketlists, items = user_rows(reader, user_id)
+    with target.begin() as writer:
+        if replace:
+            delete_user_rows(writer, user_id)
+        old_bucketlists, old_items = user_rows(writer, user_id)
+        # bucketlists before their items, and items before their lists
+        gone_bucketlists = apply_rows(
+            writer, BucketList.__table__, bucketlists, old_bucketlists)
+        gone_items = apply_rows(
+            writer, BucketItem.__table__, items, old_items)
+        if mirror:
+            delete_rows(writer, BucketItem.__table__, gone_items)
+            delete_rows(writer, BucketList.__table__, gone_bucketlists)
+    return len(bucketlists), len(items)
+
+
+def set_moving(connection, user_id, moving, **values):
+    user = User.__table__
+    connection.execute(user.update().where(user.c.id == user_id).values(
+        moving=moving, **values))
+
+
+def move_user(user_id, target):
+    '''Moves the bucketlists and items of a user to shard target. Raises
+    IntegrityError when their names are in use in target, and UserBusy when
+    a job of the user is running, leaving the user where they were. Returns
+    how many bucketlists and items moved.'''
+    if target not in shard_router.shards()[1:]:
+        raise ValueError('no shard %r' % (target,))
+    user = User.__table__
+    primary = shard_router.engine(None)
+    row = primary.execute(select([user.c.shard]).where(
+        user.c.id == user_id)).fetchall()
+    if not row:
+        raise ValueError('no user %d' % user_id)
+    source = row[0][0]
+    if source == target:
+        return 0, 0
+    old, new = shard_router.engine(source), shard_router.engine(target)
+
+    # the bulk of the copy happens while the user still uses source. Rows
+    # of the user already in target were left by an interrupted move, the
+    # user never wrote there since
+    sync(old, new, user_id, replace=True)
+
+    with primary.begin() as connection:
+        set_moving(connection, user_id, True)
+    try:
+        # writes let through before user.moving was set are under way, and
+        # jobs claimed before it are running
+        time.sleep(current_app.config['SHARD_MOVE_GRACE'])
+        job = Job.__table__
+        if primary.execute(select([func.count()]).where(
+                (job.c.creator_id == user_id) &
+                (job.c.state == RUNNING))).scalar():
+            raise UserBusy('user %d has jobs running' % user_id)
+        # source no longer changes, this copies what changed since, deletes
+        # included
+        moved = sync(old, new, user_id, mirror=True)
+    except Exception:
+        with primary.begin() as connection:
+            set_moving(connection, user_id, None)
+        raise
+    with primary.begin() as connection:
+        set_moving(connection, user_id, None, shard=target)
+
+    with old.begin() as connection:
+        delete_user_rows(connection, user_id)
+    return moved
+
+
+def loads():
+    '''Weight of every user, and the shard of every user'''
+    shards = dict(
+        shard_router.engine(None).execute(
+            select([User.__table__.c.id, User.__table__.c.shard])
+        ).fetchall())
+
+    def shard_loads(keys):
+        return db.session.query(
+            BucketList.creator_id,
+            func.count(BucketList.id) + func.coalesce(
+                func.sum(BucketList.item_count), 0)
+        ).group_by(BucketList.creator_id).all()
+
+    weights = dict.fromkeys(shards, 0)
+    groups = [(shard, None) for shard in shard_router.shards()]
+    for (shard, _), rows in zip(
+            groups, shard_router.gather(shard_loads, groups)):
+        for user_id, weight in rows:
+            # rows left behind elsewhere by an interrupted move do not count
+            if shards.get(user_id, shard) == shard:
+                weights[user_id] += weight
+    return weights, shards
+
+
+def plan(weights, shards):
+    '''Moves (user id, source shard, target shard, weight) evening out the
+    shards, given the weights and shards of users'''
+    totals = dict.fromkeys(shard_router.shards()[1:], 0)
+    if not totals:
+        return []
+    for user_id, shard in shards.items():
+        if shard is not None:
+            totals[shard] += weights[user_id]
+
+    moves = []
+    # heaviest first, so the lighter users fill in the gaps
+    for user_id in sorted(shards, key=lambda user_id: -weights[user_id]):
+        if shards[user_id] is None:
+            target = min(totals, key=totals.get)
+            moves.append((user_id, None, target, weights[user_id]))
+            totals[target] += weights[user_id]
+
+    on_shard = {}
+    for user_id, shard in shards.items():
+        if shard is not None:
+            on_shard.setdefault(shard, set()).add(user_id)
+    for move in moves:
+        on_shard.setdefault(move[2], set()).add(move[0])
+    # every move shrinks the gap between two shards, stopping after as many
+    # moves as there are users keeps this short on uneven data
+    for _ in range(len(shards)):
+        heaviest = max(totals, key=totals.get)
+        lightest = min(totals, key=totals.get)
+        gap = totals[heaviest] - totals[lightest]
+        candidates = [user_id for user_id in on_shard.get(heaviest, ())
+                      if 0 < weights[user_id] < gap]
+        if not candidates:
+            break
+        # the user closest to half the gap evens the two shards out most
+        user_id = min(candidates,
+                      key=lambda user_id: abs(gap - 2 * weights[user_id]))
+        moves.append((user_id, heaviest, lightest, weights[user_id]))
+        on_shard[heaviest].remove(user_id)
+        on_shard.setdefault(lightest, set()).add(user_id)
+        totals[heaviest] -= weights[user_id]
+        totals[lightest] += weights[user_id]
+
+    # users moved more than once go straight to where they end up
+    final = {}
+    for user_id, source, target, weight in moves:
+        if user_id in final:
+            source = final[user_id][1]
+        final[user_id] = (user_id, source, target, weight)
+    return [final.pop(move[0]) for move in moves if move[0] in final and
+            final[move[0]][1] != final[move[0]][2]]
@@ -0,0 +1,133 @@
+'''
+Read replica routing
+
+SQLALCHEMY_REPLICAS lists the URIs of databases replicating the primary
+SQLALCHEMY_DATABASE_URI. Queries of GET, HEAD and OPTIONS requests are
+sent to one of them picked at random, everything else goes to the
+primary: other requests, flushes and INSERT/UPDATE/DELETE statements, and
+work outside requests such as jobs and manage.py commands.
+
+Replicas lag behind the primary, so a client that just wrote could read
+its data from before the write. After a request that wrote, its user (and
+remote address, which covers registering and then logging in) reads from
+the primary for REPLICA_STICKY_SECONDS, which should exceed the usual
+replication lag. These marks live in process unless REPLICA_STICKY_BACKEND
+names a werkzeug cache client shared by every process.
+
+Replicas are binds named replica-<n> in SQLALCHEMY_BINDS, so they get the
+same pool options and metrics as the primary and no tables are created in
+them by db.create_all().
+'''
+import random
+
+from flask import current_app, g, has_request_context, request
+from flask import _request_ctx_stack
+from flask.ext.sqlalchemy import SignallingSession
+from sqlalchemy.sql.dml import UpdateBase
+
+from .cache import LRUCache
+from .shards import shard_router
+
+
+READ_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+class RoutingSession(SignallingSession):
+
+    '''Session sending the reads of read only requests to a replica'''
+
+    def get_bind(self, mapper=None, clause=None):
+        # sharded tables go to the shard of the current user
+        engine = shard_router.engine_for(mapper, clause)
+        if engine is not None:
+            return engine
+        # tables of other binds are not replicated
+        info = getattr(mapper.mapped_table, 'info', {}) \
+            if mapper is not None else {}
+        if info.get('bind_key') is None and has_request_context():
+            if self._flushing or isinstance(clause, UpdateBase):
+                replica_router.wrote()
+            else:
+                engine = replica_router.read_engine()
+                if engine is not None:
+                    return engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class ReplicaRouter(object):
+
+    '''Picks the engine reads of the current request go to, and keeps the
+    clients that wrote on the primary for a while'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICAS', [])
+        app.config.setdefault('REPLICA_STICKY_SECONDS', 10)
+        app.config.setdefault('REPLICA_STICKY_SIZE', 65536)
+        app.config.setdefault('REPLICA_STICKY_BACKEND', None)
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        names = []
+        for n, uri in enumerate(app.config['SQLALCHEMY_REPLICAS']):
+            names.append('replica-%d' % n)
+            binds[names[-1]] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds or None
+        backend = app.config['REPLICA_STICKY_BACKEND']
+        if backend is None:
+            backend = LRUCache(maxsize=app.config['REPLICA_STICKY_SIZE'])
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['replicas'] = (names, backend)
+        app.after_request(self.after_request)
+
+    @staticmethod
+    def client_keys():
+        user = getattr(g, 'user', None)
+        keys = ['replica-sticky:ip:%s' % request.remote_addr]
+        if user is not None:
+            keys.insert(0, 'replica-sticky:user:%d' % user.id)
+        return keys
+
+    def read_engine(self):
+        '''Returns the replica engine reads of the request go to, or None
+        for the primary'''
+        ctx = _request_ctx_stack.top
+        if request.method not in READ_METHODS or getattr(
+                ctx, 'replica_wrote', False):
+            return None
+        names, backend = current_app.extensions['replicas']
+        if not names:
+            return None
+
+        # decided once per request, and again once it is authenticated
+        user = getattr(g, 'user', None)
+        identity = user.id if user is not None else None
+        decided = getattr(ctx, 'replica', None)
+        if decided is not None and decided[0] == identity:
+            return decided[1]
+        engine = None
+        if not backend.get(self.client_keys()[0]):
+            from . import db
+            engine = db.get_engine(current_app, bind=random.choice(names))
+        ctx.replica = (identity, engine)
+        return engine
+
+    @staticmethod
+    def wrote():
+        # the rest of the request reads its own writes from the primary
+        _request_ctx_stack.top.replica_wrote = True
+
+    def after_request(self, response):
+        if getattr(_request_ctx_stack.top, 'replica_wrote', False) and \
+                response.status_code < 400:
+            names, backend = current_app.extensions['replicas']
+            if names:
+                timeout = current_app.config['REPLICA_STICKY_SECONDS']
+                for key in self.client_keys():
+                    backend.set(key, True, timeout=timeout)
+        return response
+
+
+replica_router = ReplicaRouter()
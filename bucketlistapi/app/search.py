@@ -0,0 +1,122 @@
+'''
+Indexed substring search over bucketlist and bucketitem names
+
+PostgreSQL answers name LIKE '%q%' from pg_trgm GIN indexes. SQLite mirrors
+the names into FTS5 tables using the trigram tokenizer, which serves the
+same LIKE from the full-text index. Any other database falls back to a
+plain LIKE on the table.
+'''
+from sqlalchemy import DDL, event
+from sqlalchemy.sql import table, column
+
+from . import db
+from .models import BucketList, BucketItem
+
+
+# searched tables and the FTS5 table mirroring each of them on SQLite
+SEARCHED_TABLES = {
+    'bucketlist': 'bucketlist_fts',
+    'bucketitem': 'bucketitem_fts',
+}
+
+# engines known to carry the SQLite FTS5 tables
+_fts_engines = {}
+
+
+def sqlite_fts_ddl(name, fts_name):
+    '''Returns the statements creating an FTS5 mirror of a table's names
+    along with the triggers keeping it in sync'''
+    values = dict(table=name, fts=fts_name)
+    return [
+        "CREATE VIRTUAL TABLE %(fts)s USING fts5(name, content='%(table)s', "
+        "content_rowid='id', tokenize='trigram')" % values,
+        "CREATE TRIGGER %(fts)s_ai AFTER INSERT ON %(table)s BEGIN "
+        "INSERT INTO %(fts)s(rowid, name) VALUES (new.id, new.name); "
+        "END" % values,
+        "CREATE TRIGGER %(fts)s_ad AFTER DELETE ON %(table)s BEGIN "
+        "INSERT INTO %(fts)s(%(fts)s, rowid, name) "
+        "VALUES ('delete', old.id, old.name); "
+        "END" % values,
+        "CREATE TRIGGER %(fts)s_au AFTER UPDATE OF name ON %(table)s BEGIN "
+        "INSERT INTO %(fts)s(%(fts)s, rowid, name) "
+        "VALUES ('delete', old.id, old.name); "
+        "INSERT INTO %(fts)s(rowid, name) VALUES (new.id, new.name); "
+        "END" % values,
+    ]
+
+
+def postgresql_trgm_ddl(name):
+    '''Returns the statements creating a trigram index on a table's names'''
+    return [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        'CREATE INDEX ix_%(table)s_name_trgm ON %(table)s '
+        'USING gin (name gin_trgm_ops)' % dict(table=name),
+    ]
+
+
+# the trigram tokenizer ships with SQLite 3.34 and later
+def has_trigram_tokenizer(ddl, target, bind, **kw):
+    if bind.dialect.name != 'sqlite':
+        return False
+    version = bind.dialect.dbapi.sqlite_version_info
+    return version >= (3, 34, 0)
+
+
+# keeps create_all/drop_all in step with the migration, for the tables of
+# the models and their copies in shards
+def register_ddl(table):
+    fts_name = SEARCHED_TABLES[table.name]
+    for statement in sqlite_fts_ddl(table.name, fts_name):
+        event.listen(table, 'after_create', DDL(
+            statement).execute_if(callable_=has_trigram_tokenizer))
+    for statement in postgresql_trgm_ddl(table.name):
+        event.listen(table, 'after_create', DDL(
+            statement).execute_if(dialect='postgresql'))
+    event.listen(table, 'before_drop', DDL(
+        'DROP TABLE IF EXISTS %s' % fts_name).execute_if(dialect='sqlite'))
+
+
+register_ddl(BucketList.__table__)
+register_ddl(BucketItem.__table__)
+
+
+def has_fts(engine):
+    '''Checks once per engine whether the SQLite FTS5 tables exist'''
+    if engine.dialect.name != 'sqlite':
+        return False
+    if engine not in _fts_engines:
+        _fts_engines[engine] = engine.execute(
+            "SELECT count(*) FROM sqlite_master WHERE name = ?",
+            SEARCHED_TABLES['bucketlist']).scalar() > 0
+    return _fts_engines[engine]
+
+
+# ids of the rows of a model whose name contains q
+def matching_ids(model, q):
+    name = model.__tablename__
+    engine = db.session.get_bind(model.__mapper__)
+    if has_fts(engine):
+        fts = table(SEARCHED_TABLES[name], column('rowid'), column('name'))
+        return db.select([fts.c.rowid]).where(fts.c.name.contains(q))
+    return db.select([model.id]).where(model.name.contains(q))
+
+
+def search_bucketlists(query, q, include_items=False):
+    '''Narrows a BucketList query down to bucketlists whose name contains
+    q, or that hold an item whose name contains q when include_items is set
+    '''
+    if not q:
+        return query
+    condition = BucketList.id.in_(matching_ids(BucketList, q))
+    if include_items:
+        condition = db.or_(condition, BucketList.id.in_(
+            db.select([BucketItem.bucketlist_id]).where(
+                BucketItem.id.in_(matching_ids(BucketItem, q)))))
+    return query.filter(condition)
+
+
+def search_bucketitems(query, q):
+    '''Narrows a BucketItem query down to items whose name contains q'''
+    if not q:
+        return query
+    return query.filter(BucketItem.id.in_(matching_ids(BucketItem, q)))
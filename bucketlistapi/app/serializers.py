@@ -0,0 +1,89 @@
+'''
+JSON serialization of API responses
+
+Responses are encoded compactly by orjson when it is installed and by the
+stdlib encoder otherwise, see JSON_SERIALIZER. Models format their dates
+with http_date() while building their json, so neither encoder has to fall
+back to a default() hook for datetimes.
+'''
+import json
+from datetime import datetime
+
+from flask import current_app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def http_date(value):
+    '''Formats a naive UTC datetime like werkzeug.http.http_date, which is
+    what flask.jsonify used to produce, at a fraction of the cost'''
+    if value is None:
+        return None
+    return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+        WEEKDAYS[value.weekday()], value.day, MONTHS[value.month - 1],
+        value.year, value.hour, value.minute, value.second)
+
+
+def default(obj):
+    if isinstance(obj, datetime):
+        return http_date(obj)
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+
+_encoder = json.JSONEncoder(separators=(',', ':'), default=default)
+
+
+def stdlib_dumps(obj):
+    return _encoder.encode(obj).encode('utf-8')
+
+
+def orjson_dumps(obj):
+    return orjson.dumps(
+        obj, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+BACKENDS = {
+    'json': stdlib_dumps,
+    'orjson': orjson_dumps,
+}
+
+
+class JSONSerializer(object):
+
+    '''Selects the encoder named by JSON_SERIALIZER, 'auto' picks orjson
+    when it is installed'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('JSON_SERIALIZER', 'auto')
+        backend = app.config['JSON_SERIALIZER']
+        if backend == 'auto':
+            backend = 'orjson' if orjson is not None else 'json'
+        if backend == 'orjson' and orjson is None:
+            raise RuntimeError('JSON_SERIALIZER is orjson but it is not '
+                               'installed')
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['json_serializer'] = BACKENDS[backend]
+
+
+def dumps(obj):
+    '''Encodes obj to compact utf-8 json bytes'''
+    return current_app.extensions['json_serializer'](obj)
+
+
+def jsonify(*args, **kwargs):
+    '''flask.jsonify through the configured encoder, without indentation'''
+    return current_app.response_class(
+        dumps(dict(*args, **kwargs)), mimetype='application/json')
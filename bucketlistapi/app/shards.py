@@ -0,0 +1,328 @@
+'''
+Partitioning bucketlists and items by user over several databases
+
+SHARDS lists the URIs of the shard databases, numbered from 0. Users stay
+in the primary database, each with the number of the shard holding their
+bucketlists and items in user.shard, or NULL for the primary itself, where
+everything lived before sharding. New users get a random shard, and
+`python manage.py rebalance` moves users off the primary and between
+shards until their sizes are even.
+
+Every bucketlist and item query runs on the shard of the current user:
+the authenticated user of a request, or the one selected with
+shard_router.using() by jobs and commands. Requests spanning users, such
+as GET /users/, query each shard in parallel with gather().
+
+Ids stay unique over every shard, so rows keep their id and URL when they
+move: with SHARDS set, new bucketlists and items take their ids from
+blocks reserved in the id_sequence table of the primary. Names are only
+unique within a shard: the unique indexes of bucketlist and item names no
+longer span every user once SHARDS is set, so two users on different
+shards may use the same name, and moving a user fails on names in use in
+the target.
+
+While a user is moved to another shard (app/rebalance.py) user.moving is
+set: their writes are refused with 503 Service Unavailable and their jobs
+wait in the queue.
+
+Shards are binds named shard-<n> in SQLALCHEMY_BINDS, created with
+`python manage.py create_shards`. Without SHARDS nothing changes.
+'''
+import os
+import random
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from multiprocessing.pool import ThreadPool
+
+from flask import (
+    copy_current_request_context, current_app, g, has_request_context,
+    request)
+from flask import _request_ctx_stack
+from sqlalchemy import MetaData, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.util import find_tables
+from werkzeug.exceptions import ServiceUnavailable
+
+
+SHARDED_TABLES = frozenset(['bucketlist', 'bucketitem'])
+
+# stands for an unknown shard, None being the primary
+UNKNOWN = object()
+
+# methods that write nothing, allowed while the user is moved
+SAFE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+class UserMoving(ServiceUnavailable):
+
+    '''503 refusing a write while its user is moved to another shard'''
+
+    # seconds to wait before retrying, moves are short
+    retry_after = 5
+
+
+def shard_bind(shard):
+    return 'shard-%d' % shard
+
+
+def is_sharded(mapper, clause):
+    '''Whether a statement reads or writes the sharded tables'''
+    if mapper is not None:
+        return mapper.mapped_table.name in SHARDED_TABLES
+    if clause is None:
+        return False
+    return any(getattr(table, 'name', None) in SHARDED_TABLES
+               for table in find_tables(clause, include_crud=True))
+
+
+def shard_tables():
+    '''Copies of the sharded tables without their foreign keys to users,
+    who stay in the primary'''
+    from . import search
+    from .models import BucketList, BucketItem
+    metadata = MetaData()
+    tables = []
+    for model in (BucketList, BucketItem):
+        table = model.__table__.tometadata(metadata)
+        for constraint in list(table.foreign_key_constraints):
+            referred = constraint.elements[0].target_fullname
+            if referred.split('.')[0] not in SHARDED_TABLES:
+                table.constraints.discard(constraint)
+                for element in constraint.elements:
+                    element.parent.foreign_keys.discard(element)
+                    table.foreign_keys.discard(element)
+        search.register_ddl(table)
+        tables.append(table)
+    return metadata, tables
+
+
+def allocate_ids(engine, name, count):
+    '''Reserves count ids of table name in the id_sequence table, returns
+    the first one and the one past the last'''
+    from .models import IdSequence
+    sequence = IdSequence.__table__
+    for attempt in range(2):
+        try:
+            with engine.begin() as connection:
+                # the row stays locked until commit, other processes wait
+                if not connection.execute(sequence.update().where(
+                        sequence.c.name == name).values(
+                            next_id=sequence.c.next_id + count)).rowcount:
+                    connection.execute(
+                        sequence.insert(), name=name, next_id=1 + count)
+                end = connection.scalar(select([sequence.c.next_id]).where(
+                    sequence.c.name == name))
+            return end - count, end
+        except IntegrityError:
+            # another process inserted the first row, add to it instead
+            if attempt:
+                raise
+
+
+class ShardRouter(object):
+
+    '''Routes the queries of the sharded tables to the current user's shard
+    and hands out ids unique over every shard'''
+
+    def __init__(self, app=None):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SHARDS', [])
+        app.config.setdefault('SHARD_WORKERS', 4)
+        app.config.setdefault('SHARD_ID_BLOCK', 100)
+        app.config.setdefault('SHARD_MOVE_GRACE', 5)
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        for shard, uri in enumerate(app.config['SHARDS']):
+            binds[shard_bind(shard)] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds or None
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['shards'] = len(app.config['SHARDS'])
+        # ids reserved by this process and not handed out yet, per table
+        app.extensions['shard_ids'] = {}
+
+    @property
+    def enabled(self):
+        return current_app.extensions['shards'] > 0
+
+    def shards(self):
+        '''Every place bucketlists may live in, None for the primary'''
+        return [None] + list(range(current_app.extensions['shards']))
+
+    def choose_shard(self):
+        '''Shard of a new user'''
+        return random.randrange(current_app.extensions['shards'])
+
+    def engine(self, shard):
+        from . import db
+        if shard is None:
+            return db.engine
+        return db.get_engine(current_app, bind=shard_bind(shard))
+
+    def engine_for(self, mapper, clause):
+        '''Engine of the current shard when a statement is for the sharded
+        tables, None to route it as any other'''
+        if not self.enabled or not is_sharded(mapper, clause):
+            return None
+        shard = self.current()
+        return self.engine(shard) if shard is not None else None
+
+    # current shard
+
+    def current(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack:
+            return stack[-1]
+        if has_request_context():
+            user = getattr(g, 'user', None)
+            if user is not None:
+                return self.shard_of(user)
+        return None
+
+    def shard_of(self, user):
+        '''Shard of a User, or of the AuthPrincipal of a cached token'''
+        # loading an expired user here could happen in the middle of a flush
+        shard = getattr(user, '__dict__', {}).get('shard', UNKNOWN)
+        if shard is not UNKNOWN:
+            return shard
+        # looked up once per request
+        ctx = _request_ctx_stack.top
+        cached = getattr(ctx, 'user_shard', None)
+        if cached is None or cached[0] != user.id:
+            cached = (user.id, self.lookup(user.id))
+            ctx.user_shard = cached
+        return cached[1]
+
+    def lookup(self, user_id):
+        # outside the session, which may be busy flushing
+        from .models import User
+        return self.engine(None).scalar(select([User.shard]).where(
+            User.id == user_id))
+
+    def moving(self, user_id):
+        '''Whether the bucketlists of a user are being moved to another
+        shard'''
+        from .models import User
+        return bool(self.engine(None).scalar(select([User.moving]).where(
+            User.id == user_id)))
+
+    def writable(self, f):
+        '''Decorator refusing the writes of an authenticated view with
+        UserMoving while the user is moved'''
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if (self.enabled and request.method not in SAFE_METHODS and
+                    self.moving(g.user.id)):
+                raise UserMoving()
+            return f(*args, **kwargs)
+        return decorated
+
+    @contextmanager
+    def using(self, shard):
+        '''Runs the block on shard, None for the primary'''
+        from . import db
+        stack = self._local.__dict__.setdefault('stack', [])
+        # pending changes belong to the shard they were made on
+        db.session.flush()
+        stack.append(shard)
+        try:
+            yield shard
+            db.session.flush()
+        finally:
+            stack.pop()
+
+    def for_user(self, user_id):
+        '''Runs the block on the shard of a user'''
+        if not self.enabled:
+            return self.using(None)
+        return self.using(self.lookup(user_id))
+
+    # scatter-gather
+
+    @property
+    def pool(self):
+        # a forked worker process gets a pool of its own
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ThreadPool(current_app.config['SHARD_WORKERS'])
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def gather(self, f, groups):
+        '''Calls f(keys) on the shard of every (shard, keys) pair of groups,
+        in parallel when there are several, and returns the results'''
+        groups = list(groups)
+        if len(groups) < 2:
+            return [self._call(f, shard, keys) for shard, keys in groups]
+
+        return self.pool.map(run, [
+            self._bound(f, shard, keys) for shard, keys in groups])
+
+    def _call(self, f, shard, keys):
+        with self.using(shard):
+            return f(keys)
+
+    def _bound(self, f, shard, keys):
+        # a context of its own for each call, so each thread has a session
+        # of its own
+        def call():
+            return self._call(f, shard, keys)
+        if has_request_context():
+            return copy_current_request_context(call)
+        return in_app_context(current_app._get_current_object(), call)
+
+    # ids
+
+    def next_ids(self, name, count=1):
+        '''Returns count new ids of table name, unique over every shard'''
+        blocks = current_app.extensions['shard_ids']
+        # a forked worker process must not hand out its parent's ids
+        key = (os.getpid(), name)
+        with self._lock:
+            start, end = blocks.get(key, (0, 0))
+            if end - start < count:
+                start, end = allocate_ids(
+                    self.engine(None), name,
+                    max(count, current_app.config['SHARD_ID_BLOCK']))
+            blocks[key] = (start + count, end)
+        return list(range(start, start + count))
+
+    def assign_ids(self, table, rows):
+        '''Gives rows about to be inserted into a sharded table their ids'''
+        if self.enabled and rows:
+            for row, row_id in zip(rows, self.next_ids(table.name, len(rows))):
+                row['id'] = row_id
+        return rows
+
+    # schema
+
+    def create_all(self):
+        metadata, tables = shard_tables()
+        for shard in self.shards()[1:]:
+            metadata.create_all(self.engine(shard))
+
+    def drop_all(self):
+        metadata, tables = shard_tables()
+        for shard in self.shards()[1:]:
+            metadata.drop_all(self.engine(shard))
+
+
+def run(call):
+    return call()
+
+
+def in_app_context(app, f):
+    def call(*args):
+        with app.app_context():
+            return f(*args)
+    return call
+
+
+shard_router = ShardRouter()
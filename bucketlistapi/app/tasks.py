@@ -0,0 +1,55 @@
+'''
+Handlers of the background jobs, see app/jobs.py
+'''
+import os
+
+from flask import current_app
+
+from . import db, job_runner
+from .models import BucketList, BucketItem, IN_CLAUSE_CHUNK
+from .transfer import export_bucketlists, import_bucketlists
+
+
+@job_runner.handler('delete_bucketlist')
+def delete_bucketlist(job, bucketlist_id):
+    '''Deletes a bucketlist and its items, a chunk of items per
+    transaction so none holds locks on all of them'''
+    bucketlist = BucketList.query.filter_by(
+        id=bucketlist_id, creator_id=job.creator_id).first()
+    if bucketlist is None:
+        return {'items_deleted': 0}  # deleted by an earlier attempt
+
+    deleted = 0
+    while True:
+        rows = db.session.query(BucketItem.id, BucketItem.done).filter_by(
+            bucketlist_id=bucketlist_id).limit(IN_CLAUSE_CHUNK).all()
+        if not rows:
+            break
+        BucketItem.query.filter(
+            BucketItem.id.in_([item_id for item_id, _ in rows])
+        ).delete(synchronize_session=False)
+        # the counters stay right while the bucketlist is being emptied
+        bucketlist.count_items(
+            items=-len(rows), done=-sum(bool(done) for _, done in rows))
+        db.session.commit()
+        deleted += len(rows)
+    bucketlist.delete()
+    return {'items_deleted': deleted}
+
+
+@job_runner.handler('export_bucketlists')
+def export(job, format):
+    '''Writes the bucketlists of the user with their items to a file'''
+    directory = current_app.config['JOB_RESULTS_DIR']
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    bucketlists, items = export_bucketlists(
+        job.file_path(), job.creator_id, format,
+        current_app.config['STREAM_BATCH_SIZE'])
+    return {'format': format, 'bucketlists': bucketlists, 'items': items}
+
+
+@job_runner.handler('import_bucketlists')
+def import_(job, bucketlists):
+    '''Creates the bucketlists and items of an uploaded document'''
+    return import_bucketlists(job.creator_id, bucketlists)
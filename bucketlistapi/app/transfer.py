@@ -0,0 +1,227 @@
+'''
+Exporting and importing bucketlists
+
+Exports write every bucketlist of a user with all of its items, reading a
+batch of bucketlists at a time so memory use does not grow with their
+number. Imports insert a chunk of bucketlists and their items with one
+executemany INSERT each and commit it, skipping the names already in use,
+so importing the same document again creates nothing.
+'''
+import csv
+import io
+import os
+import sys
+from datetime import datetime
+
+from . import db
+from .models import BucketList, BucketItem, chunked
+from .serializers import dumps, http_date
+from .shards import shard_router
+
+
+EXPORT_FORMATS = ('json', 'csv')
+
+# one row per item, bucketlists without items get one with no item
+CSV_COLUMNS = (
+    'bucketlist_id', 'bucketlist_name', 'bucketlist_date_created',
+    'item_id', 'item_name', 'item_done', 'item_date_created')
+
+
+if sys.version_info[0] < 3:
+    # the csv module writes bytes
+    def csv_row(values):
+        return [value.encode('utf-8') if isinstance(value, type(u''))
+                else value for value in values]
+
+    def open_csv(path, mode='w'):
+        return open(path, mode + 'b')
+else:
+    def csv_row(values):
+        return values
+
+    def open_csv(path, mode='w'):
+        return io.open(path, mode, newline='', encoding='utf-8')
+
+
+def iso_date(value):
+    return value.isoformat() if value is not None else ''
+
+
+def bucketlist_batches(creator_id, size):
+    '''Yields the bucketlists of a user size at a time, as lists of
+    (bucketlist row, its item rows)'''
+    from .api_1.streaming import batches
+    query = db.session.query(
+        BucketList.id, BucketList.name, BucketList.date_created,
+        BucketList.date_modified
+    ).filter(BucketList.creator_id == creator_id).order_by(BucketList.id)
+    for batch in batches(query, size):
+        items = {}
+        for item in BucketItem.first_rows([row.id for row in batch]):
+            items.setdefault(item.bucketlist_id, []).append(item)
+        yield [(row, items.get(row.id, [])) for row in batch]
+
+
+def export_json(path, creator_id, size):
+    bucketlists = items = 0
+    with open(path, 'wb') as f:
+        f.write(b'{"bucketlists":[')
+        separator = b''
+        for batch in bucketlist_batches(creator_id, size):
+            for row, rows in batch:
+                f.write(separator + dumps({
+                    'id': row.id,
+                    'name': row.name,
+                    'date_created': http_date(row.date_created),
+                    'last_modified': http_date(row.date_modified),
+                    'items': BucketItem.bulk_to_json(rows),
+                }))
+                separator = b','
+                bucketlists += 1
+                items += len(rows)
+        f.write(b']}')
+    return bucketlists, items
+
+
+def export_csv(path, creator_id, size):
+    bucketlists = items = 0
+    with open_csv(path) as f:
+        writer = csv.writer(f)
+        writer.writerow(csv_row(CSV_COLUMNS))
+        for batch in bucketlist_batches(creator_id, size):
+            for row, rows in batch:
+                bucketlist = [row.id, row.name, iso_date(row.date_created)]
+                if not rows:
+                    writer.writerow(csv_row(bucketlist + ['', '', '', '']))
+                for item in rows:
+                    writer.writerow(csv_row(bucketlist + [
+                        item.id, item.name, 'true' if item.done else 'false',
+                        iso_date(item.date_created)]))
+                bucketlists += 1
+                items += len(rows)
+    return bucketlists, items
+
+
+def export_bucketlists(path, creator_id, format='json', size=100):
+    '''Writes every bucketlist of a user with its items to path as json or
+    csv, returns the number of bucketlists and items written. The file
+    only appears once complete.'''
+    export = {'json': export_json, 'csv': export_csv}[format]
+    partial = path + '.part'
+    try:
+        counts = export(partial, creator_id, size)
+        os.rename(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return counts
+
+
+def parse_import(document, max_size):
+    '''Returns the bucketlists of an import document, an array or
+    {"bucketlists": [...]} of {"name": ..., "items": [{"name": ...,
+    "done": ...}]}. Raises ValueError when it is malformed or holds more
+    than max_size bucketlists and items.'''
+    from .api_1.batch import is_name
+    if isinstance(document, dict):
+        document = document.get('bucketlists')
+    if not isinstance(document, list):
+        raise ValueError('expected an array of bucketlists')
+
+    size = 0
+    bucketlists = []
+    for entry in document:
+        if not isinstance(entry, dict) or not is_name(entry.get('name')):
+            raise ValueError('bucketlists need a name')
+        items = entry.get('items', [])
+        if not isinstance(items, list):
+            raise ValueError('items are an array')
+        for item in items:
+            if not isinstance(item, dict) or not is_name(item.get('name')) \
+                    or not isinstance(item.get('done', False), bool):
+                raise ValueError('items need a name, done is true or false')
+        size += 1 + len(items)
+        if size > max_size:
+            raise ValueError('more than %d bucketlists and items' % max_size)
+        bucketlists.append({
+            'name': entry['name'],
+            'items': [{'name': item['name'], 'done': item.get('done', False)}
+                      for item in items],
+        })
+    return bucketlists
+
+
+def names_in_use(column, names):
+    in_use = set()
+    for chunk in chunked(names):
+        in_use.update(name for name, in db.session.query(column).filter(
+            column.in_(chunk)))
+    return in_use
+
+
+def import_bucketlists(creator_id, bucketlists, size=500):
+    '''Creates bucketlists from parse_import() for a user, size at a time
+    and committing each chunk. Bucketlists and items whose name is in use
+    are skipped. Returns how many were created and skipped.'''
+    counts = dict.fromkeys(
+        ('bucketlists', 'items', 'bucketlists_skipped', 'items_skipped'), 0)
+    for chunk in chunked(bucketlists, size):
+        in_use = names_in_use(
+            BucketList.name, set(entry['name'] for entry in chunk))
+        created = []
+        for entry in chunk:
+            if entry['name'] in in_use:
+                counts['bucketlists_skipped'] += 1
+                counts['items_skipped'] += len(entry['items'])
+            else:
+                in_use.add(entry['name'])
+                created.append(entry)
+        if not created:
+            continue
+
+        # the items created are known first, for the counters of their
+        # bucketlists
+        in_use = names_in_use(BucketItem.name, set(
+            item['name'] for entry in created for item in entry['items']))
+        items = {}
+        for entry in created:
+            items[entry['name']] = []
+            for item in entry['items']:
+                if item['name'] in in_use:
+                    counts['items_skipped'] += 1
+                    continue
+                in_use.add(item['name'])
+                items[entry['name']].append(item)
+
+        now = datetime.now()
+        db.session.execute(
+            BucketList.__table__.insert(), shard_router.assign_ids(
+                BucketList.__table__, [{
+                    'name': entry['name'],
+                    'creator_id': creator_id,
+                    'date_created': now,
+                    'date_modified': now,
+                    'item_count': len(items[entry['name']]),
+                    'done_count': sum(
+                        item['done'] for item in items[entry['name']])
+                } for entry in created]))
+        # names are unique, so they identify the new rows
+        ids = {}
+        for names in chunked(entry['name'] for entry in created):
+            ids.update(db.session.query(BucketList.name, BucketList.id).filter(
+                BucketList.name.in_(names)))
+
+        rows = [{
+            'name': item['name'],
+            'bucketlist_id': ids[entry['name']],
+            'done': item['done'],
+            'date_created': now,
+            'date_modified': now
+        } for entry in created for item in items[entry['name']]]
+        if rows:
+            shard_router.assign_ids(BucketItem.__table__, rows)
+            db.session.execute(BucketItem.__table__.insert(), rows)
+        db.session.commit()
+        counts['bucketlists'] += len(created)
+        counts['items'] += len(rows)
+    return counts
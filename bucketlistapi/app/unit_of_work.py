@@ -0,0 +1,52 @@
+'''
+Request scoped unit of work
+
+Models only flush their changes. A request commits everything it changed
+once, after the view returned successfully, and rolls back otherwise.
+Scripts and manage.py commands use transaction() instead.
+'''
+from contextlib import contextmanager
+
+from . import db
+
+
+class UnitOfWork(object):
+
+    '''Commits the session once per request'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.after_request(self.commit)
+        app.teardown_request(self.rollback)
+
+    @staticmethod
+    def commit(response):
+        # error responses must not persist half applied changes
+        if response.status_code < 400:
+            db.session.commit()
+        else:
+            db.session.rollback()
+        return response
+
+    @staticmethod
+    def rollback(exc):
+        if exc is not None:
+            db.session.rollback()
+
+
+unit_of_work = UnitOfWork()
+
+
+@contextmanager
+def transaction():
+    '''Commits the changes made inside the block once, or rolls them all
+    back if it raises'''
+    try:
+        yield db.session
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
@@ -0,0 +1,148 @@
+'''
+Cached external URLs for serialized resources
+
+url_for walks the url map and rebuilds the whole URL on every call, which
+adds up when every bucketlist and user on a page carries its URL. The
+first url_for of an endpoint for a given host and set of arguments is
+built with placeholders instead of values and kept as a template; later
+URLs encode their values with the rule's own converters (and the query
+string encoding of werkzeug) and join them into the template, giving the
+same string url_for would.
+
+The host comes from the Host header of each request, so templates are kept
+in an LRUCache of URL_TEMPLATES_SIZE entries: clients sending made up
+hosts only evict templates, which are rebuilt on their next use.
+'''
+from flask import _app_ctx_stack, _request_ctx_stack, url_for
+from werkzeug._compat import text_type
+from werkzeug.routing import IntegerConverter
+from werkzeug.urls import url_quote_plus
+
+from .cache import LRUCache
+
+
+# placeholders unlikely to show up anywhere else in a URL
+INT_PLACEHOLDER = 7919000000
+STRING_PLACEHOLDER = 'urltemplate%dx'
+
+# templates never go stale, they are only evicted
+TEMPLATE_TIMEOUT = 86400
+
+
+def query_to_url(value):
+    # the encoding url_encode applies to query string values
+    if not isinstance(value, bytes):
+        value = text_type(value).encode('utf-8')
+    return url_quote_plus(value)
+
+
+class URLTemplate(object):
+
+    '''An external URL split around the values of its arguments'''
+
+    def __init__(self, parts, names, encoders):
+        self.parts = parts
+        self.names = names
+        self.encoders = encoders
+
+    def build(self, **values):
+        url = [self.parts[0]]
+        for name, encode, part in zip(
+                self.names, self.encoders, self.parts[1:]):
+            url.append(encode(values[name]))
+            url.append(part)
+        return ''.join(url)
+
+
+class URLFor(object):
+
+    '''Falls back to url_for for URLs that cannot be templated'''
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+
+    def build(self, **values):
+        return url_for(self.endpoint, _external=True, **values)
+
+
+def make_template(endpoint, names, adapter):
+    '''Builds the template of endpoint with the argument names, falling
+    back to url_for when its output cannot be split around placeholders'''
+    rules = adapter.map._rules_by_endpoint.get(endpoint, ())
+    rule = next((rule for rule in rules
+                 if rule.arguments.issubset(names)), None)
+    if rule is None:
+        return URLFor(endpoint)
+
+    placeholders = {}
+    encoders = {}
+    for n, name in enumerate(names):
+        converter = rule._converters.get(name)
+        if isinstance(converter, IntegerConverter) and \
+                not converter.fixed_digits:
+            placeholders[name] = INT_PLACEHOLDER + n
+        else:
+            placeholders[name] = STRING_PLACEHOLDER % n
+        encoders[name] = converter.to_url if converter is not None \
+            else query_to_url
+    url = url_for(endpoint, _external=True, **placeholders)
+
+    # split url around the placeholders, in the order they appear
+    markers = []
+    for name in names:
+        marker = text_type(placeholders[name])
+        if url.count(marker) != 1:
+            return URLFor(endpoint)
+        markers.append((url.index(marker), marker, name))
+    parts = []
+    ordered = []
+    position = 0
+    for index, marker, name in sorted(markers):
+        parts.append(url[position:index])
+        ordered.append(name)
+        position = index + len(marker)
+    parts.append(url[position:])
+    return URLTemplate(
+        parts, ordered, [encoders[name] for name in ordered])
+
+
+class URLTemplates(object):
+
+    '''Caches URL templates per app, host and argument names'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('URL_TEMPLATES_SIZE', 1024)
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['url_templates'] = LRUCache(
+            maxsize=app.config['URL_TEMPLATES_SIZE'],
+            default_timeout=TEMPLATE_TIMEOUT)
+
+    def get(self, endpoint, *names):
+        '''Returns the URLTemplate of endpoint for the argument names'''
+        appctx = _app_ctx_stack.top
+        reqctx = _request_ctx_stack.top
+        adapter = reqctx.url_adapter if reqctx is not None \
+            else appctx.url_adapter
+        if adapter is None:
+            # no request and no SERVER_NAME, url_for explains
+            return URLFor(endpoint)
+        key = (endpoint, names, adapter.server_name, adapter.script_name,
+               adapter.url_scheme, adapter.subdomain)
+        templates = appctx.app.extensions['url_templates']
+        template = templates.get(key)
+        if template is None:
+            template = make_template(endpoint, names, adapter)
+            templates.set(key, template)
+        return template
+
+    def url_for(self, endpoint, **values):
+        '''url_for(endpoint, _external=True, **values) from the cache'''
+        # url_for leaves out empty query arguments
+        names = sorted(name for name, value in values.items()
+                       if value is not None)
+        return self.get(endpoint, *names).build(**values)
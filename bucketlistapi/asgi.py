@@ -0,0 +1,332 @@
+'''
+ASGI entry point for the API, Python 3.5 and later
+
+Flask 0.10 and SQLAlchemy 1.0 only block, so the ASGI app hands every
+request to the WSGI app on a bounded pool of ASGI_WORKERS threads, each
+using its own pooled database connection, and at most
+PASSWORD_HASH_CONCURRENCY of them hash passwords at once. The event loop
+only reads requests and writes responses, so a process holds any number of
+slow or idle connections while at most ASGI_WORKERS requests run at once.
+
+    python manage.py serve_asgi -p 5000
+    uvicorn --factory asgi:create_asgi_app
+
+The app is created from the config named by FLASK_CONFIG (default when
+unset). serve() runs a small HTTP/1.1 server on asyncio for when no ASGI
+server is installed. The app itself never imports this module.
+'''
+import asyncio
+import io
+import os
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import unquote
+
+from app import create_app
+
+
+# response reasons for the status lines of serve()
+REASONS = {
+    200: 'OK', 201: 'Created', 202: 'Accepted', 204: 'No Content',
+    304: 'Not Modified', 400: 'Bad Request', 401: 'Unauthorized',
+    403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+    409: 'Conflict', 411: 'Length Required', 429: 'Too Many Requests',
+    500: 'Internal Server Error', 503: 'Service Unavailable',
+}
+
+
+def build_environ(scope, body):
+    '''Returns the WSGI environ of an ASGI http scope'''
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        # WSGI carries the decoded path as latin-1 characters of its bytes
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    # the body is read in full, whatever its transfer encoding was
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+async def deliver(send, message):
+    # send may return any awaitable, run_coroutine_threadsafe takes
+    # coroutines only
+    await send(message)
+
+
+class ASGIApp(object):
+
+    '''Serves a WSGI app to an ASGI server from a bounded thread pool'''
+
+    def __init__(self, wsgi_app, workers):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(workers)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        else:
+            raise ValueError('unsupported scope %s' % scope['type'])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_event_loop().run_in_executor(
+                    None, self.close)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(
+            self.executor, self.run, build_environ(scope, b''.join(body)),
+            send, loop)
+
+    def run(self, environ, send, loop):
+        '''Runs the WSGI app on a worker thread. The whole response is
+        iterated on that thread, as the streamed ones hold their request
+        context in thread locals.'''
+        def emit(message):
+            asyncio.run_coroutine_threadsafe(
+                deliver(send, message), loop).result()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers]
+            return write
+
+        def start():
+            if not response.get('sent'):
+                response['sent'] = True
+                emit({'type': 'http.response.start',
+                      'status': response['status'],
+                      'headers': response['headers']})
+
+        def write(data):
+            start()
+            emit({'type': 'http.response.body', 'body': data,
+                  'more_body': True})
+
+        try:
+            chunks = self.wsgi_app(environ, start_response)
+        except Exception:
+            # raised by apps propagating exceptions, e.g. in debug mode
+            traceback.print_exc(file=environ['wsgi.errors'])
+            start_response('500 Internal Server Error',
+                           [('Content-Type', 'text/plain')])
+            chunks = [b'Internal Server Error']
+        try:
+            for chunk in chunks:
+                if chunk:
+                    write(chunk)
+            start()
+            emit({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def close(self):
+        '''Waits for the requests in flight, which need the event loop
+        running to send their responses'''
+        self.executor.shutdown(wait=True)
+
+
+def create_asgi_app(config_name=None):
+    '''Creates the app from config_name, or FLASK_CONFIG, wrapped for ASGI'''
+    app = create_app(config_name or os.environ.get('FLASK_CONFIG') or
+                     'default')
+    return ASGIApp(app.wsgi_app, app.config['ASGI_WORKERS'])
+
+
+def find_header(headers, name):
+    for header, value in headers:
+        if header == name:
+            return value
+    return None
+
+
+def parse_request_line(line):
+    '''Returns the method, target and version of a request line, raises
+    ValueError when it is malformed'''
+    method, target, version = line.decode('latin-1').split()
+    if not version.startswith('HTTP/'):
+        raise ValueError('not an HTTP request: %r' % line)
+    return method, target, version
+
+
+def parse_length(value):
+    '''Returns a Content-Length, raises ValueError when it is malformed'''
+    length = int(value or 0)
+    if length < 0:
+        raise ValueError('negative Content-Length')
+    return length
+
+
+async def refuse(writer, status):
+    # answers a request that never reaches the app, before the connection
+    # is closed
+    writer.write(('HTTP/1.1 %s\r\nContent-Length: 0\r\n'
+                  'Connection: close\r\n\r\n' % status).encode('latin-1'))
+    await writer.drain()
+
+
+async def handle_connection(app, reader, writer):
+    '''Serves the HTTP/1.1 requests of one connection to app'''
+    peer = writer.get_extra_info('peername')
+    local = writer.get_extra_info('sockname')
+    try:
+        keep_alive = True
+        while keep_alive:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                return
+            try:
+                method, target, version = parse_request_line(request_line)
+            except ValueError:
+                await refuse(writer, '400 Bad Request')
+                return
+            headers = []
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers.append((name.strip().lower().encode('latin-1'),
+                                value.strip().encode('latin-1')))
+
+            connection = (find_header(headers, b'connection') or b'').lower()
+            keep_alive = connection != b'close' if version == 'HTTP/1.1' \
+                else connection == b'keep-alive'
+            if find_header(headers, b'transfer-encoding') is not None:
+                # request bodies are only read by their Content-Length
+                await refuse(writer, '411 Length Required')
+                return
+            try:
+                length = parse_length(find_header(headers, b'content-length'))
+            except ValueError:
+                await refuse(writer, '400 Bad Request')
+                return
+            body = await reader.readexactly(length) if length else b''
+
+            path, _, query = target.partition('?')
+            scope = {
+                'type': 'http',
+                'asgi': {'version': '3.0'},
+                'http_version': version.split('/')[1],
+                'method': method,
+                'scheme': 'http',
+                'path': unquote(path),
+                'raw_path': path.encode('latin-1'),
+                'query_string': query.encode('latin-1'),
+                'root_path': '',
+                'headers': headers,
+                'server': local[:2],
+                'client': peer[:2],
+            }
+            await app(scope, partial(receive_body, [body]),
+                      partial(send_response, writer, keep_alive, {}))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def receive_body(bodies):
+    if bodies:
+        return {'type': 'http.request', 'body': bodies.pop(),
+                'more_body': False}
+    return {'type': 'http.disconnect'}
+
+
+async def send_response(writer, keep_alive, response, message):
+    if message['type'] == 'http.response.start':
+        headers = message['headers']
+        # a body without a length goes out in chunks
+        response['chunked'] = \
+            find_header(headers, b'content-length') is None
+        lines = ['HTTP/1.1 %d %s' % (
+            message['status'], REASONS.get(message['status'], 'Unknown'))]
+        lines.extend('%s: %s' % (name.decode('latin-1'),
+                                 value.decode('latin-1'))
+                     for name, value in headers)
+        if response['chunked']:
+            lines.append('Transfer-Encoding: chunked')
+        if not keep_alive:
+            lines.append('Connection: close')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    elif message['type'] == 'http.response.body':
+        body = message.get('body', b'')
+        if response['chunked']:
+            if body:
+                writer.write(b'%x\r\n%s\r\n' % (len(body), body))
+            if not message.get('more_body', False):
+                writer.write(b'0\r\n\r\n')
+        else:
+            writer.write(body)
+        await writer.drain()
+
+
+async def start_server(app, host='127.0.0.1', port=5000):
+    '''Starts serving app on host and port, returns the asyncio server'''
+    return await asyncio.start_server(
+        partial(handle_connection, app), host, port, backlog=1024)
+
+
+def serve(app, host='127.0.0.1', port=5000):
+    '''Serves app until interrupted'''
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(start_server(app, host, port))
+    print(' * Serving ASGI on http://%s:%d/' % (host, port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.run_until_complete(loop.run_in_executor(None, app.close))
@@ -0,0 +1,913 @@
+'''
+Load test for the api_1 endpoints
+
+Seeds users x bucketlists x items into a scratch database, then drives
+every api_1 route from a pool of threads, either through the Flask test
+client or through a local WSGI server, and reports throughput, latency
+percentiles, queries per request and peak memory per route. Results are
+saved as JSON so a later run can be compared against them.
+
+    python manage.py bench -u 20 -b 10 -i 10 -n 200 -c 4 -o bench.json
+    python manage.py bench --baseline bench.json
+
+The target database is dropped and recreated, point --database (or
+BENCH_DATABASE_URL) at a disposable one.
+'''
+import json
+import os
+import platform
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+from itertools import count
+
+from sqlalchemy import event
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from app import create_app, db, password_hasher
+from app.metrics import Histogram
+from app.models import User, BucketList, BucketItem, generate_auth_token
+from app.unit_of_work import transaction
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+try:
+    from http.client import HTTPConnection
+except ImportError:  # python 2
+    from httplib import HTTPConnection
+
+
+API = '/api/v1'
+PASSWORD = 'password'
+# rows per INSERT when seeding
+SEED_CHUNK = 1000
+
+
+def maxrss_kb():
+    '''Peak resident memory of the process in kilobytes'''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def insert(table, rows):
+    for start in range(0, len(rows), SEED_CHUNK):
+        db.session.execute(table.insert(), rows[start:start + SEED_CHUNK])
+
+
+def seed(users, bucketlists, items):
+    '''Recreates the schema and fills it with users x bucketlists x items.
+    Returns the user ids with their usernames and the bucketlist ids with
+    their creators.'''
+    db.drop_all()
+    db.create_all()
+    # every user shares a password, hashing it once keeps seeding fast
+    password_hash = password_hasher.encrypt(PASSWORD)
+    now = datetime.now()
+
+    with transaction():
+        insert(User.__table__, [{
+            'username': 'bench%d' % n,
+            'password_hash': password_hash,
+            'date_created': now
+        } for n in range(users)])
+        usernames = dict(db.session.query(User.id, User.username))
+
+        insert(BucketList.__table__, [{
+            'name': 'bench-list-%d-%d' % (user_id, n),
+            'creator_id': user_id,
+            'date_created': now,
+            'date_modified': now,
+            'item_count': items
+        } for user_id in usernames for n in range(bucketlists)])
+        creators = db.session.query(
+            BucketList.id, BucketList.creator_id).order_by(BucketList.id).all()
+
+        rows = []
+        for bucketlist_id, _ in creators:
+            rows.extend({
+                'name': 'bench-item-%d-%d' % (bucketlist_id, n),
+                'bucketlist_id': bucketlist_id,
+                'done': False,
+                'date_created': now,
+                'date_modified': now
+            } for n in range(items))
+            if len(rows) >= SEED_CHUNK:
+                insert(BucketItem.__table__, rows)
+                rows = []
+        insert(BucketItem.__table__, rows)
+
+    db.session.remove()
+    return usernames, creators
+
+
+class Fixture(object):
+
+    '''Seeded rows handed out to the routes of the benchmark'''
+
+    def __init__(self, usernames, creators):
+        self.usernames = usernames
+        self.creators = creators
+        self.tokens = dict(
+            (user_id, self.token(user_id)) for user_id in usernames)
+        # seeded items, consumed from the end by destructive routes
+        self.items = db.session.query(
+            BucketItem.id, BucketItem.bucketlist_id,
+            BucketList.creator_id
+        ).join(
+            BucketList, BucketItem.bucketlist_id == BucketList.id
+        ).order_by(BucketItem.id).all()
+        db.session.remove()
+        self._names = count()
+
+    @staticmethod
+    def token(user_id):
+        return generate_auth_token(
+            user_id, expiration=3600).decode('ascii')
+
+    def name(self, prefix):
+        return '%s-%d' % (prefix, next(self._names))
+
+    def user(self, n):
+        user_ids = sorted(self.usernames)
+        return user_ids[n % len(user_ids)]
+
+    def bucketlist(self, n):
+        return self.creators[n % len(self.creators)]
+
+    def item(self, n):
+        return self.items[n % len(self.items)]
+
+    def pop_item(self):
+        return self.items.pop() if self.items else (0, 0, self.user(0))
+
+    def pop_bucketlist(self):
+        return self.creators.pop() if len(self.creators) > 1 \
+            else (0, self.user(0))
+
+    def headers(self, user_id=None):
+        headers = {
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'
+        }
+        if user_id is not None:
+            headers['Authorization'] = 'Bearer ' + self.tokens[user_id]
+        return headers
+
+
+# every route as (name, request builder). A builder takes the fixture and
+# the request number and returns (method, path, user id, json body).
+# Destructive routes come last since they consume seeded rows.
+def routes():
+    def bucketlist_path(f, n, suffix=''):
+        bucketlist_id, user_id = f.bucketlist(n)
+        return '%s/bucketlists/%d/%s' % (API, bucketlist_id, suffix), user_id
+
+    def read(path):
+        return lambda f, n: ('GET', API + path, f.user(n), None)
+
+    def get_bucketlist(f, n):
+        path, user_id = bucketlist_path(f, n)
+        return 'GET', path, user_id, None
+
+    def list_items(query=''):
+        def build(f, n):
+            path, user_id = bucketlist_path(f, n, 'items/' + query)
+            return 'GET', path, user_id, None
+        return build
+
+    def get_user(f, n):
+        user_id = f.user(n)
+        return ('GET', '%s/users/%s/' % (API, f.usernames[user_id]),
+                user_id, None)
+
+    def register(f, n):
+        return 'POST', API + '/auth/register/', None, {
+            'username': f.name('bench-user'), 'password': PASSWORD}
+
+    def login(f, n):
+        return 'POST', API + '/auth/login/', None, {
+            'username': f.usernames[f.user(n)], 'password': PASSWORD}
+
+    def create_bucketlist(f, n):
+        return 'POST', API + '/bucketlists/', f.user(n), {
+            'name': f.name('bench-new-list')}
+
+    def rename_bucketlist(f, n):
+        path, user_id = bucketlist_path(f, n)
+        return 'PUT', path, user_id, {'name': f.name('bench-renamed')}
+
+    def add_item(f, n):
+        path, user_id = bucketlist_path(f, n, 'items/')
+        return 'POST', path, user_id, {'name': f.name('bench-new-item')}
+
+    def update_item(f, n):
+        item_id, bucketlist_id, user_id = f.item(n)
+        return 'PUT', '%s/bucketlists/%d/items/%d/' % (
+            API, bucketlist_id, item_id), user_id, {'done': True}
+
+    def batch_create(f, n):
+        path, user_id = bucketlist_path(f, n, 'items/batch/')
+        return 'POST', path, user_id, [
+            {'name': f.name('bench-batch-item')} for _ in range(10)]
+
+    def batch_update(f, n):
+        item_id, bucketlist_id, user_id = f.item(n)
+        return 'PATCH', '%s/bucketlists/%d/items/batch/' % (
+            API, bucketlist_id), user_id, [{'id': item_id, 'done': True}]
+
+    def delete_item(f, n):
+        item_id, bucketlist_id, user_id = f.pop_item()
+        return 'DELETE', '%s/bucketlists/%d/items/%d/' % (
+            API, bucketlist_id, item_id), user_id, None
+
+    def batch_delete(f, n):
+        item_id, bucketlist_id, user_id = f.pop_item()
+        return 'DELETE', '%s/bucketlists/%d/items/batch/' % (
+            API, bucketlist_id), user_id, [item_id]
+
+    def delete_bucketlist(f, n):
+        bucketlist_id, user_id = f.pop_bucketlist()
+        return 'DELETE', '%s/bucketlists/%d/' % (
+            API, bucketlist_id), user_id, None
+
+    def logout(f, n):
+        user_id = f.user(n)
+        # a fresh token per request, logging out revokes it
+        f.tokens[user_id] = f.token(user_id)
+        return 'POST', API + '/auth/logout/', user_id, None
+
+    return [
+        ('health_db', read('/_health/db')),
+        ('get_users', read('/users/')),
+        ('get_user', get_user),
+        ('list_bucketlists', read('/bucketlists/')),
+        ('list_bucketlists_no_count', read('/bucketlists/?count=false')),
+        ('search_bucketlists', read('/bucketlists/?q=list')),
+        ('search_bucketlists_items',
+         read('/bucketlists/?q=item&search_items=true')),
+        ('export_bucketlists', read('/bucketlists/export/')),
+        ('list_bucketlists_cursor', read('/bucketlists/?cursor=')),
+        ('get_bucketlist', get_bucketlist),
+        ('list_items', list_items()),
+        ('filter_items', list_items('?done=false&q=item&count=true')),
+        ('login', login),
+        ('register', register),
+        ('create_bucketlist', create_bucketlist),
+        ('rename_bucketlist', rename_bucketlist),
+        ('add_item', add_item),
+        ('update_item', update_item),
+        ('batch_create_items', batch_create),
+        ('batch_update_items', batch_update),
+        ('metrics', read('/_metrics')),
+        ('delete_item', delete_item),
+        ('batch_delete_items', batch_delete),
+        ('delete_bucketlist', delete_bucketlist),
+        ('logout', logout),
+    ]
+
+
+class TestClient(object):
+
+    '''Sends requests through the Flask test client'''
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def open(self, method, path, headers, body):
+        response = self.client.open(
+            path, method=method, headers=headers, data=body)
+        response.get_data()
+        return response.status_code
+
+
+class HTTPClient(object):
+
+    '''Sends requests to a local WSGI server'''
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def open(self, method, path, headers, body):
+        connection = HTTPConnection(self.host, self.port)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    '''Leaves out the access log'''
+
+    def log_request(self, *args):
+        pass
+
+
+class WSGIServer(object):
+
+    '''Serves the app on an ephemeral local port from a thread'''
+
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True,
+                                  request_handler=QuietHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self.server.server_port
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.thread.join()
+
+
+class ASGIServer(object):
+
+    '''Serves the app through asgi.py on an ephemeral local port from an
+    event loop thread, Python 3 only'''
+
+    def __init__(self, app):
+        import asyncio
+        import asgi
+
+        self.app = asgi.ASGIApp(app.wsgi_app, app.config['ASGI_WORKERS'])
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            asgi.start_server(self.app, '127.0.0.1', 0))
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self.server.sockets[0].getsockname()[1]
+
+    def __exit__(self, *exc_info):
+        import asyncio
+
+        self.app.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        # connections left open by the clients
+        tasks = asyncio.Task.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(
+            *tasks, loop=self.loop, return_exceptions=True))
+        self.loop.close()
+
+
+class PreforkServer(object):
+
+    '''Serves the app through prefork.py on an ephemeral local port from a
+    forked master process'''
+
+    def __init__(self, app, workers):
+        import prefork
+
+        self.prefork = prefork
+        self.app = app
+        self.workers = workers
+        self.listener = prefork.listen('127.0.0.1', 0)
+        self.pid = None
+
+    def __enter__(self):
+        # the forked processes must not share pooled connections with us
+        self.prefork.dispose_engines(self.app)
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                self.prefork.PreforkServer(
+                    self.app, self.listener, self.workers,
+                    handler=QuietHandler).run()
+            finally:
+                os._exit(0)
+        return self.listener.getsockname()[1]
+
+    def __exit__(self, *exc_info):
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        self.listener.close()
+
+
+class QueryCounter(object):
+
+    '''Counts the statements sent by an engine'''
+
+    def __init__(self, engine):
+        self.statements = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        with self._lock:
+            self.statements += 1
+
+
+class StatementRecorder(object):
+
+    '''Keeps the first parameters of every distinct statement an engine
+    sends, along with the route that sent it'''
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.route = None
+        self.statements = {}
+        event.listen(engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context,
+               executemany):
+        if not executemany and statement.lstrip().upper().startswith(
+                ('SELECT', 'UPDATE', 'DELETE')):
+            self.statements.setdefault(statement, (self.route, parameters))
+
+    def remove(self):
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+
+
+def explain(connection, statement, parameters):
+    '''Returns the query plan of a statement as lines of text'''
+    if connection.dialect.name == 'sqlite':
+        return [row[3] for row in connection.execute(
+            'EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()]
+    return [row[0] for row in connection.execute(
+        'EXPLAIN ' + statement, parameters).fetchall()]
+
+
+def full_scans(plan, tables):
+    '''Returns the tables a plan reads in full rather than through an
+    index. Scans of subqueries, virtual tables and catalogs are left out
+    as they are not in tables.'''
+    scans = []
+    for line in plan:
+        words = line.split()
+        if line.startswith('SCAN ') and len(words) == 2:  # sqlite
+            table = words[1]
+        elif 'Seq Scan on ' in line:  # postgresql
+            table = line.split('Seq Scan on ')[1].split()[0]
+        else:
+            continue
+        if table in tables and table not in scans:
+            scans.append(table)
+    return scans
+
+
+def query_plans(users=5, bucketlists=5, items=5, requests=2,
+                database=None):
+    '''Seeds the database, sends every route a few requests and returns
+    the plan of every distinct statement they ran'''
+    app = create_app('benchmark')
+    if database:
+        app.config['SQLALCHEMY_DATABASE_URI'] = database
+    app_context = app.app_context()
+    app_context.push()
+    try:
+        fixture = Fixture(*seed(users, bucketlists, items))
+        recorder = StatementRecorder(db.engine)
+        client = TestClient(app)
+        try:
+            for name, build in routes():
+                recorder.route = name
+                for n in range(requests):
+                    method, path, user_id, body = build(fixture, n)
+                    client.open(
+                        method, path, fixture.headers(user_id),
+                        json.dumps(body) if body is not None else None)
+        finally:
+            recorder.remove()
+
+        tables = set(db.metadata.tables)
+        plans = []
+        with db.engine.connect() as connection:
+            if connection.dialect.name == 'postgresql':
+                # a few seeded rows are cheaper to read in full, make the
+                # planner show the indexes it would use on real tables
+                connection.execute('SET enable_seqscan = off')
+            for statement, (route, parameters) in sorted(
+                    recorder.statements.items(), key=lambda s: s[1][0]):
+                plan = explain(connection, statement, parameters)
+                plans.append({
+                    'route': route,
+                    'statement': ' '.join(statement.split()),
+                    'plan': plan,
+                    'full_scans': full_scans(plan, tables),
+                })
+        return plans
+    finally:
+        db.session.remove()
+        app_context.pop()
+
+
+def plans_report(plans):
+    lines = []
+    for plan in plans:
+        if plan['full_scans']:
+            lines.append('%s: full scan of %s' % (
+                plan['route'], ', '.join(plan['full_scans'])))
+            lines.append('  ' + plan['statement'])
+            lines.extend('    ' + line for line in plan['plan'])
+    lines.append('%d statements, %d with full table scans' % (
+        len(plans), len([plan for plan in plans if plan['full_scans']])))
+    return '\n'.join(lines)
+
+
+def run_route(make_client, fixture, build, requests, concurrency, counter):
+    '''Sends requests requests built by build from concurrency threads and
+    returns the measurements'''
+    # requests are built up front so building them is not timed
+    planned = []
+    for n in range(requests):
+        method, path, user_id, body = build(fixture, n)
+        planned.append((method, path, fixture.headers(user_id),
+                        json.dumps(body) if body is not None else None))
+
+    latency = Histogram()
+    statuses = {}
+    errors = []
+    lock = threading.Lock()
+
+    def worker(share):
+        client = make_client()
+        for method, path, headers, body in share:
+            start = time.time()
+            try:
+                status = client.open(method, path, headers, body)
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+                continue
+            latency.observe(time.time() - start)
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [
+        threading.Thread(target=worker, args=(planned[n::concurrency],))
+        for n in range(concurrency)
+    ]
+    statements = counter.statements
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    statements = counter.statements - statements
+
+    return {
+        'requests': requests,
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(requests / elapsed, 1) if elapsed else 0.0,
+        'latency': latency.to_json(),
+        'queries_per_request': round(float(statements) / requests, 2),
+        'statuses': dict((str(status), n) for status, n in statuses.items()),
+        'errors': len(errors) + sum(
+            n for status, n in statuses.items() if status >= 500),
+        'exceptions': errors[:5],
+        'maxrss_kb': maxrss_kb(),
+    }
+
+
+def run(users=10, bucketlists=10, items=10, requests=100, concurrency=4,
+        server=False, database=None, only=None):
+    '''Seeds the database and benchmarks every route, returns the results'''
+    app = create_app('benchmark')
+    if database:
+        app.config['SQLALCHEMY_DATABASE_URI'] = database
+    app_context = app.app_context()
+    app_context.push()
+    try:
+        start = time.time()
+        fixture = Fixture(*seed(users, bucketlists, items))
+        seconds = time.time() - start
+        counter = QueryCounter(db.engine)
+
+        results = {
+            'created': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'database': db.engine.dialect.name,
+            'transport': 'wsgi' if server else 'test_client',
+            'concurrency': concurrency,
+            'seed': {
+                'users': users,
+                'bucketlists': users * bucketlists,
+                'items': users * bucketlists * items,
+                'seconds': round(seconds, 3),
+            },
+            'routes': {},
+        }
+
+        def bench(make_client):
+            for name, build in routes():
+                if only and name not in only:
+                    continue
+                results['routes'][name] = run_route(
+                    make_client, fixture, build, requests, concurrency,
+                    counter)
+
+        if server:
+            with WSGIServer(app) as port:
+                bench(lambda: HTTPClient('127.0.0.1', port))
+        else:
+            bench(lambda: TestClient(app))
+        results['maxrss_kb'] = maxrss_kb()
+        return results
+    finally:
+        db.session.remove()
+        app_context.pop()
+
+
+# routes of the concurrency benchmark: hashing bound, then database bound
+CONCURRENCY_ROUTES = ('login', 'list_bucketlists', 'get_bucketlist')
+
+
+def concurrency(users=10, bucketlists=10, items=10, requests=200,
+                levels=(1, 8, 32, 64), database=None):
+    '''Seeds the database and measures the same routes served by the
+    threaded WSGI server and by asgi.py at each level of concurrency'''
+    app = create_app('benchmark')
+    if database:
+        app.config['SQLALCHEMY_DATABASE_URI'] = database
+    app_context = app.app_context()
+    app_context.push()
+    try:
+        fixture = Fixture(*seed(users, bucketlists, items))
+        counter = QueryCounter(db.engine)
+        results = {
+            'created': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'database': db.engine.dialect.name,
+            'asgi_workers': app.config['ASGI_WORKERS'],
+            'modes': {},
+        }
+        routes_by_name = dict(routes())
+        for mode, make_server in (('wsgi', WSGIServer), ('asgi', ASGIServer)):
+            results['modes'][mode] = {}
+            with make_server(app) as port:
+                for level in levels:
+                    results['modes'][mode][str(level)] = dict(
+                        (name, run_route(
+                            lambda: HTTPClient('127.0.0.1', port), fixture,
+                            routes_by_name[name], requests, level, counter))
+                        for name in CONCURRENCY_ROUTES)
+        results['maxrss_kb'] = maxrss_kb()
+        return results
+    finally:
+        db.session.remove()
+        app_context.pop()
+
+
+def concurrency_report(results):
+    lines = [
+        'python %(python)s, %(database)s, %(asgi_workers)d asgi workers'
+        % results,
+        '%-18s %6s %10s %10s %9s %9s %7s' % (
+            'route', 'conc', 'wsgi rps', 'asgi rps', 'wsgi p99', 'asgi p99',
+            'errors'),
+    ]
+    wsgi = results['modes']['wsgi']
+    asgi = results['modes']['asgi']
+    for level in sorted(wsgi, key=int):
+        for name in CONCURRENCY_ROUTES:
+            before, after = wsgi[level][name], asgi[level][name]
+            lines.append('%-18s %6s %10.1f %10.1f %8.1fms %8.1fms %7d' % (
+                name, level, before['throughput_rps'],
+                after['throughput_rps'],
+                before['latency']['p99_ms'],
+                after['latency']['p99_ms'],
+                before['errors'] + after['errors']))
+    return '\n'.join(lines)
+
+
+def servers(users=10, bucketlists=10, items=10, requests=200,
+            concurrency=16, workers=None, database=None):
+    '''Seeds the database and measures the same routes served by one
+    threaded process and by the pre-fork server'''
+    import prefork
+
+    workers = workers or prefork.cpu_count()
+    app = create_app('benchmark')
+    if database:
+        app.config['SQLALCHEMY_DATABASE_URI'] = database
+    app_context = app.app_context()
+    app_context.push()
+    try:
+        fixture = Fixture(*seed(users, bucketlists, items))
+        counter = QueryCounter(db.engine)
+        results = {
+            'created': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'database': db.engine.dialect.name,
+            'concurrency': concurrency,
+            'workers': workers,
+            'modes': {},
+        }
+        routes_by_name = dict(routes())
+        for mode, make_server in (
+                ('single', WSGIServer),
+                ('prefork', lambda app: PreforkServer(app, workers))):
+            with make_server(app) as port:
+                results['modes'][mode] = dict(
+                    (name, run_route(
+                        lambda: HTTPClient('127.0.0.1', port), fixture,
+                        routes_by_name[name], requests, concurrency,
+                        counter))
+                    for name in CONCURRENCY_ROUTES)
+        return results
+    finally:
+        db.session.remove()
+        app_context.pop()
+
+
+def servers_report(results):
+    lines = [
+        'python %(python)s, %(database)s, %(concurrency)d clients, '
+        '%(workers)d workers' % results,
+        '%-18s %11s %11s %8s %11s %11s' % (
+            'route', 'single rps', 'prefork rps', 'speedup', 'single p99',
+            'prefork p99'),
+    ]
+    single = results['modes']['single']
+    forked = results['modes']['prefork']
+    for name in CONCURRENCY_ROUTES:
+        before, after = single[name], forked[name]
+        lines.append('%-18s %11.1f %11.1f %7.1fx %9.1fms %9.1fms' % (
+            name, before['throughput_rps'], after['throughput_rps'],
+            after['throughput_rps'] / before['throughput_rps']
+            if before['throughput_rps'] else 0.0,
+            before['latency']['p99_ms'], after['latency']['p99_ms']))
+    return '\n'.join(lines)
+
+
+def change(now, before):
+    if not before:
+        return ''
+    return '%+.0f%%' % (100.0 * (now - before) / before)
+
+
+def report(results, baseline=None):
+    '''Formats the results as a table, with the change from baseline'''
+    previous = baseline['routes'] if baseline else {}
+    lines = [
+        '%-28s %9s %8s %9s %9s %8s %7s' % (
+            'route', 'req/s', '', 'p95 ms', '', 'queries', 'errors')
+    ]
+    order = [name for name, _ in routes()]
+    for name in sorted(results['routes'], key=order.index):
+        result = results['routes'][name]
+        before = previous.get(name, {})
+        lines.append('%-28s %9.1f %8s %9.3f %9s %8.2f %7d' % (
+            name,
+            result['throughput_rps'],
+            change(result['throughput_rps'], before.get('throughput_rps')),
+            result['latency']['p95_ms'],
+            change(result['latency']['p95_ms'],
+                   before.get('latency', {}).get('p95_ms')),
+            result['queries_per_request'],
+            result['errors']))
+    lines.append('peak memory: %s kB' % results['maxrss_kb'])
+    return '\n'.join(lines)
+
+
+def timed(f, rounds):
+    '''Returns the result of f and the best of rounds timings'''
+    best = None
+    for _ in range(rounds):
+        start = time.time()
+        result = f()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def with_datetimes(bucketlists):
+    '''A page as built before dates were formatted up front'''
+    now = datetime.now()
+    page = []
+    for bucketlist in bucketlists:
+        bucketlist = dict(bucketlist, date_created=now, last_modified=now)
+        bucketlist['items'] = [
+            dict(item, date_created=now, last_modified=now)
+            for item in bucketlist['items']]
+        page.append(bucketlist)
+    return page
+
+
+def serialization(bucketlists=100, items=20, rounds=20, database=None):
+    '''Measures building and encoding one large page of bucketlists with
+    each json encoder, returns bytes/sec per step'''
+    from flask import json as flask_json
+    from app import serializers
+
+    app = create_app('benchmark')
+    if database:
+        app.config['SQLALCHEMY_DATABASE_URI'] = database
+    with app.test_request_context('/'):
+        seed(1, bucketlists, items)
+        query = BucketList.query.order_by(BucketList.id).limit(bucketlists)
+
+        page, objects = timed(
+            lambda: BucketList.bulk_to_json(query.all()), rounds)
+        page, rows = timed(lambda: BucketList.bulk_to_json(
+            BucketList.json_rows(query).all()), rounds)
+        legacy = with_datetimes(page)
+
+        # flask.jsonify indents its output in flask 0.10
+        encoders = [
+            ('flask.jsonify', lambda: flask_json.dumps(
+                {'bucketlists': legacy}, indent=2).encode('utf-8')),
+            ('json', lambda: serializers.stdlib_dumps({'bucketlists': page})),
+        ]
+        if serializers.orjson is not None:
+            encoders.append(('orjson', lambda: serializers.orjson_dumps(
+                {'bucketlists': page})))
+
+        results = {
+            'python': platform.python_version(),
+            'bucketlists': bucketlists,
+            'items': bucketlists * items,
+            'build_ms': {
+                'objects': round(1000 * objects, 3),
+                'rows': round(1000 * rows, 3),
+            },
+            'encode': {},
+        }
+        for name, encode in encoders:
+            body, seconds = timed(encode, rounds)
+            results['encode'][name] = {
+                'bytes': len(body),
+                'ms': round(1000 * seconds, 3),
+                'mb_per_sec': round(len(body) / seconds / 1e6, 1),
+            }
+        db.session.remove()
+        return results
+
+
+def serialization_report(results):
+    lines = [
+        'page of %(bucketlists)d bucketlists, %(items)d items, '
+        'python %(python)s' % results,
+        'build from objects %(objects).3f ms, from rows %(rows).3f ms'
+        % results['build_ms'],
+        '%-16s %9s %9s %9s' % ('encoder', 'bytes', 'ms', 'MB/s'),
+    ]
+    for name, result in sorted(results['encode'].items(),
+                               key=lambda item: item[1]['ms'], reverse=True):
+        lines.append('%-16s %9d %9.3f %9.1f' % (
+            name, result['bytes'], result['ms'], result['mb_per_sec']))
+    return '\n'.join(lines)
+
+
+def urls(count=1000, rounds=20):
+    '''Times building count bucketlist and user URLs with url_for and with
+    the cached templates'''
+    from flask import url_for
+    from app import url_templates
+
+    app = create_app('benchmark')
+    with app.test_request_context('/'):
+        cases = [
+            ('api_1.bucketlist', 'bucketlist_id', list(range(count))),
+            ('api_1.get_user', 'username',
+             ['user %d' % n for n in range(count)]),
+        ]
+        results = {'urls': count, 'endpoints': {}}
+        for endpoint, name, values in cases:
+            expected, before = timed(lambda: [
+                url_for(endpoint, _external=True, **{name: value})
+                for value in values], rounds)
+
+            def templated():
+                template = url_templates.get(endpoint, name)
+                return [template.build(**{name: value}) for value in values]
+            built, after = timed(templated, rounds)
+            assert built == expected
+            results['endpoints'][endpoint] = {
+                'url_for_ms': round(1000 * before, 3),
+                'template_ms': round(1000 * after, 3),
+                'speedup': round(before / after, 1),
+            }
+        return results
+
+
+def urls_report(results):
+    lines = ['%d urls per endpoint' % results['urls'],
+             '%-20s %12s %12s %8s' % (
+                 'endpoint', 'url_for ms', 'template ms', 'speedup')]
+    for endpoint, result in sorted(results['endpoints'].items()):
+        lines.append('%-20s %12.3f %12.3f %7.1fx' % (
+            endpoint, result['url_for_ms'], result['template_ms'],
+            result['speedup']))
+    return '\n'.join(lines)
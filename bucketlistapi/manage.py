@@ -1,9 +1,13 @@
 '''
 Commandline scripting settings
 '''
+import sys
+
 from app import create_app, db
 from app.models import User, BucketList, BucketItem
-from flask.ext.script import Manager, Shell
+from app.shards import shard_router
+from app.unit_of_work import transaction
+from flask.ext.script import Manager, Shell, Command, Option
 from flask.ext.migrate import Migrate, MigrateCommand
 
 
@@ -18,7 +22,8 @@ def make_shell_context():
     return dict(
         app=app, db=db, User=User,
         BucketList=BucketList,
-        BucketItem=BucketItem
+        BucketItem=BucketItem,
+        transaction=transaction
     )
 manager.add_command("shell", Shell(make_context=make_shell_context))
 manager.add_command('db', MigrateCommand)
@@ -31,5 +36,305 @@ def test():
     tests = unittest.TestLoader().discover('tests')
     unittest.TextTestRunner(verbosity=2).run(tests)
 
+
+@manager.option('-u', '--users', type=int, default=10,
+                help='users to seed')
+@manager.option('-b', '--bucketlists', type=int, default=10,
+                help='bucketlists per user')
+@manager.option('-i', '--items', type=int, default=10,
+                help='items per bucketlist')
+@manager.option('-n', '--requests', type=int, default=100,
+                help='requests per route')
+@manager.option('-c', '--concurrency', type=int, default=4,
+                help='client threads')
+@manager.option('-s', '--server', action='store_true', default=False,
+                help='go through a local WSGI server instead of the '
+                'test client')
+@manager.option('-d', '--database', default=None,
+                help='database url, it is dropped and reseeded')
+@manager.option('-r', '--route', dest='only', action='append',
+                help='only benchmark this route, may be repeated')
+@manager.option('-o', '--output', default=None,
+                help='file to save the results to as json')
+@manager.option('--baseline', default=None,
+                help='results of an earlier run to compare against')
+def bench(users, bucketlists, items, requests, concurrency, server,
+          database, only, output, baseline):
+    """Load test the api_1 endpoints."""
+    import json
+    import benchmark
+    results = benchmark.run(users, bucketlists, items, requests,
+                            concurrency, server, database, only)
+    if baseline:
+        with open(baseline) as f:
+            baseline = json.load(f)
+    print(benchmark.report(results, baseline))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+@manager.option('-b', '--bucketlists', type=int, default=100,
+                help='bucketlists on the page')
+@manager.option('-i', '--items', type=int, default=20,
+                help='items per bucketlist')
+@manager.option('-n', '--rounds', type=int, default=20,
+                help='timings to take the best of')
+@manager.option('-d', '--database', default=None,
+                help='database url, it is dropped and reseeded')
+def bench_json(bucketlists, items, rounds, database):
+    """Measure json bytes/sec of a large page of bucketlists."""
+    import benchmark
+    print(benchmark.serialization_report(
+        benchmark.serialization(bucketlists, items, rounds, database)))
+
+
+@manager.option('-n', '--count', type=int, default=1000,
+                help='urls to build per endpoint')
+def bench_urls(count):
+    """Compare url_for with the cached url templates."""
+    import benchmark
+    print(benchmark.urls_report(benchmark.urls(count)))
+
+
+@manager.option('-d', '--database', default=None,
+                help='database url, it is dropped and reseeded')
+def bench_plans(database):
+    """Show the api_1 statements whose plan reads a whole table."""
+    import benchmark
+    print(benchmark.plans_report(benchmark.query_plans(database=database)))
+
+
+@manager.option('-h', '--host', default='127.0.0.1')
+@manager.option('-p', '--port', type=int, default=5000)
+@manager.option('-w', '--workers', type=int, default=None,
+                help='worker processes, SERVER_WORKERS by default')
+@manager.option('--max-requests', dest='max_requests', type=int,
+                default=None,
+                help='requests before a worker is replaced, '
+                'SERVER_MAX_REQUESTS by default')
+def serve(host, port, workers, max_requests):
+    """Serve the app from pre-forked worker processes."""
+    import prefork
+    prefork.PreforkServer(
+        app, prefork.listen(host, port),
+        workers or app.config['SERVER_WORKERS'],
+        max_requests or app.config['SERVER_MAX_REQUESTS']).run()
+
+
+@manager.option('-h', '--host', default='127.0.0.1')
+@manager.option('-p', '--port', type=int, default=5000)
+def serve_asgi(host, port):
+    """Serve the app through asgi.py (Python 3)."""
+    import asgi
+    asgi.serve(asgi.ASGIApp(app.wsgi_app, app.config['ASGI_WORKERS']),
+               host, port)
+
+
+@manager.option('-u', '--users', type=int, default=10,
+                help='users to seed')
+@manager.option('-b', '--bucketlists', type=int, default=10,
+                help='bucketlists per user')
+@manager.option('-i', '--items', type=int, default=10,
+                help='items per bucketlist')
+@manager.option('-n', '--requests', type=int, default=200,
+                help='requests per route and level')
+@manager.option('-c', '--concurrency', dest='levels', type=int,
+                action='append', help='client threads, may be repeated')
+@manager.option('-d', '--database', default=None,
+                help='database url, it is dropped and reseeded')
+def bench_async(users, bucketlists, items, requests, levels, database):
+    """Compare WSGI and ASGI serving under concurrent clients (Python 3)."""
+    import benchmark
+    print(benchmark.concurrency_report(benchmark.concurrency(
+        users, bucketlists, items, requests, levels or (1, 8, 32, 64),
+        database)))
+
+
+@manager.option('-u', '--users', type=int, default=10,
+                help='users to seed')
+@manager.option('-b', '--bucketlists', type=int, default=10,
+                help='bucketlists per user')
+@manager.option('-i', '--items', type=int, default=10,
+                help='items per bucketlist')
+@manager.option('-n', '--requests', type=int, default=200,
+                help='requests per route')
+@manager.option('-c', '--concurrency', type=int, default=16,
+                help='client threads')
+@manager.option('-w', '--workers', type=int, default=None,
+                help='worker processes, one per core by default')
+@manager.option('-d', '--database', default=None,
+                help='database url, it is dropped and reseeded')
+def bench_serve(users, bucketlists, items, requests, concurrency, workers,
+                database):
+    """Compare the pre-fork server with a single threaded process."""
+    import benchmark
+    print(benchmark.servers_report(benchmark.servers(
+        users, bucketlists, items, requests, concurrency, workers,
+        database)))
+
+
+@manager.option('-w', '--workers', type=int, default=None,
+                help='threads running jobs, JOB_WORKERS by default')
+@manager.option('--once', action='store_true', default=False,
+                help='run the queued jobs and exit')
+def worker(workers, once):
+    """Run the queued background jobs."""
+    from app import job_runner
+    from app.jobs import WorkerPool
+    if once:
+        with app.app_context():
+            print('%d jobs run' % job_runner.run_pending())
+        return
+    WorkerPool(app, job_runner, workers or app.config['JOB_WORKERS']).run()
+
+
+def bulk_engine(database):
+    # the app's database, or the one at url database
+    import sqlalchemy
+    return sqlalchemy.create_engine(database) if database else db.engine
+
+
+def bulk_shards(database):
+    # the shards of the app's database, a database at a url has none
+    if database:
+        return {}
+    return dict((shard, shard_router.engine(shard))
+                for shard in shard_router.shards()[1:])
+
+
+def print_report(timer, path):
+    # the dump itself may be going to stdout
+    out = sys.stderr if path == '-' else sys.stdout
+    out.write(timer.report() + '\n')
+
+
+@manager.option('-o', '--output', default='-',
+                help='file to write, a directory for csv, - for stdout')
+@manager.option('-f', '--format', default='ndjson', choices=('ndjson', 'csv'))
+@manager.option('-d', '--database', default=None,
+                help='database url, the app database and shards by default')
+@manager.option('-b', '--batch-size', dest='size', type=int, default=10000,
+                help='rows read at a time')
+def export(output, format, database, size):
+    """Dump every user, bucketlist and item as ndjson or csv."""
+    from app import bulk
+    with app.app_context():
+        shards = bulk_shards(database)
+        print_report(bulk.dump(
+            bulk_engine(database), output, format, size,
+            [shards[shard] for shard in sorted(shards)]), output)
+
+
+class Import(Command):
+    """Load a dump written by export into an empty database."""
+
+    # a class, import being a keyword
+    option_list = (
+        Option('-i', '--input', dest='path', default='-',
+               help='file to read, a directory for csv, - for stdin'),
+        Option('-f', '--format', default='ndjson',
+               choices=('ndjson', 'csv')),
+        Option('-d', '--database', default=None,
+               help='database url, the app database and shards by default'),
+        Option('-b', '--batch-size', dest='size', type=int, default=10000,
+               help='rows inserted at a time'),
+    )
+
+    def run(self, path, format, database, size):
+        from app import bulk
+        with app.app_context():
+            print_report(bulk.load(
+                bulk_engine(database), path, format, size,
+                bulk_shards(database)), path)
+manager.add_command('import', Import())
+
+
+@manager.option('-b', '--batch-size', dest='size', type=int, default=1000,
+                help='bucketlists recounted per transaction')
+def recount_items(size):
+    """Set the item counters of every bucketlist from its items."""
+    from app.models import chunked
+    total = 0
+    for shard in shard_router.shards():
+        with shard_router.using(shard):
+            ids = [bucketlist_id for bucketlist_id, in db.session.query(
+                BucketList.id).order_by(BucketList.id)]
+            for chunk in chunked(ids, size):
+                with transaction():
+                    db.session.execute(
+                        BucketList.recount(BucketList.id.in_(chunk)))
+        total += len(ids)
+    print('%d bucketlists recounted' % total)
+
+
+@manager.option('--fix', action='store_true', default=False,
+                help='recount the bucketlists found')
+def check_counts(fix):
+    """List bucketlists whose item counters differ from their items."""
+    from app.models import chunked
+    total = 0
+    for shard in shard_router.shards():
+        with shard_router.using(shard):
+            drift = BucketList.count_drift()
+            for bucketlist_id, item_count, done_count, items, done in drift:
+                print('bucketlist %d: %d items, %d done, '
+                      'counted %d and %d' % (
+                          bucketlist_id, items, done, item_count,
+                          done_count))
+            if fix:
+                for chunk in chunked(row[0] for row in drift):
+                    with transaction():
+                        db.session.execute(
+                            BucketList.recount(BucketList.id.in_(chunk)))
+        total += len(drift)
+    if fix:
+        print('%d bucketlists recounted' % total)
+        return
+    print('%d bucketlists drifted' % total)
+    # a non-zero exit status for cron and monitoring
+    return 1 if total else 0
+
+
+@manager.command
+def create_shards():
+    """Create the bucketlist and item tables in every shard."""
+    shard_router.create_all()
+    print('%d shards created' % (len(shard_router.shards()) - 1))
+
+
+@manager.option('-n', '--dry-run', dest='dry_run', action='store_true',
+                default=False, help='only print the moves')
+def rebalance(dry_run):
+    """Move users off the primary and between shards to even them out."""
+    from sqlalchemy.exc import IntegrityError
+    from app.rebalance import loads, plan, move_user, UserBusy
+    moves = plan(*loads())
+    for user_id, source, target, weight in moves:
+        print('user %d (%d rows): %s -> shard %d' % (
+            user_id, weight,
+            'primary' if source is None else 'shard %d' % source, target))
+        if not dry_run:
+            try:
+                move_user(user_id, target)
+            except IntegrityError:
+                # a name of the user is in use in target, nothing was moved
+                print('user %d skipped, names in use in shard %d' % (
+                    user_id, target))
+            except UserBusy:
+                print('user %d skipped, jobs running' % user_id)
+    print('%d moves' % len(moves))
+
+
+@manager.option('-u', '--user', dest='user_id', type=int, required=True)
+@manager.option('-s', '--shard', type=int, required=True,
+                help='shard to move the user to')
+def move_user(user_id, shard):
+    """Move the bucketlists and items of a user to another shard."""
+    from app import rebalance
+    print('%d bucketlists and %d items moved' % rebalance.move_user(
+        user_id, shard))
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,27 @@
+"""bucketitem listing indexes
+
+Revision ID: 3c9e5d1a7b42
+Revises: 8f0170cc3339
+Create Date: 2026-10-18 14:02:10.118000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c9e5d1a7b42'
+down_revision = '8f0170cc3339'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # keyset pages of the items of one bucketlist, and its done filter
+    op.create_index('ix_bucketitem_bucketlist_id_id', 'bucketitem',
+                    ['bucketlist_id', 'id'], unique=False)
+    op.create_index('ix_bucketitem_bucketlist_id_done', 'bucketitem',
+                    ['bucketlist_id', 'done'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_bucketitem_bucketlist_id_done', table_name='bucketitem')
+    op.drop_index('ix_bucketitem_bucketlist_id_id', table_name='bucketitem')
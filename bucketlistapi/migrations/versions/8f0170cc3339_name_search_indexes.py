@@ -0,0 +1,75 @@
+"""name search indexes
+
+Revision ID: 8f0170cc3339
+Revises: 592dfb7afe41
+Create Date: 2026-10-18 09:12:31.402000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8f0170cc3339'
+down_revision = '592dfb7afe41'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+TABLES = (('bucketlist', 'bucketlist_fts'), ('bucketitem', 'bucketitem_fts'))
+
+
+# the trigram tokenizer came with SQLite 3.34, older ones search with LIKE
+# as app/search.py does
+def has_trigram_tokenizer(bind):
+    return bind.dialect.dbapi.sqlite_version_info >= (3, 34, 0)
+
+
+def upgrade():
+    bind = op.get_bind()
+    dialect = bind.dialect.name
+    if dialect == 'postgresql':
+        # trigram GIN indexes serve name LIKE '%q%' lookups
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table, _ in TABLES:
+            op.execute(
+                'CREATE INDEX ix_%(table)s_name_trgm ON %(table)s '
+                'USING gin (name gin_trgm_ops)' % dict(table=table))
+    elif dialect == 'sqlite' and has_trigram_tokenizer(bind):
+        # FTS5 trigram mirrors of the names, kept in sync by triggers
+        for table, fts in TABLES:
+            values = dict(table=table, fts=fts)
+            op.execute(
+                "CREATE VIRTUAL TABLE %(fts)s USING fts5(name, "
+                "content='%(table)s', content_rowid='id', "
+                "tokenize='trigram')" % values)
+            op.execute(
+                "CREATE TRIGGER %(fts)s_ai AFTER INSERT ON %(table)s BEGIN "
+                "INSERT INTO %(fts)s(rowid, name) VALUES (new.id, new.name); "
+                "END" % values)
+            op.execute(
+                "CREATE TRIGGER %(fts)s_ad AFTER DELETE ON %(table)s BEGIN "
+                "INSERT INTO %(fts)s(%(fts)s, rowid, name) "
+                "VALUES ('delete', old.id, old.name); "
+                "END" % values)
+            op.execute(
+                "CREATE TRIGGER %(fts)s_au AFTER UPDATE OF name ON %(table)s "
+                "BEGIN "
+                "INSERT INTO %(fts)s(%(fts)s, rowid, name) "
+                "VALUES ('delete', old.id, old.name); "
+                "INSERT INTO %(fts)s(rowid, name) VALUES (new.id, new.name); "
+                "END" % values)
+            # index the rows that already exist
+            op.execute(
+                "INSERT INTO %(fts)s(%(fts)s) VALUES ('rebuild')" % values)
+
+
+def downgrade():
+    bind = op.get_bind()
+    dialect = bind.dialect.name
+    if dialect == 'postgresql':
+        for table, _ in TABLES:
+            op.drop_index('ix_%s_name_trgm' % table, table_name=table)
+    elif dialect == 'sqlite' and has_trigram_tokenizer(bind):
+        for table, fts in TABLES:
+            for suffix in ('ai', 'ad', 'au'):
+                op.execute('DROP TRIGGER IF EXISTS %s_%s' % (fts, suffix))
+            op.execute('DROP TABLE IF EXISTS %s' % fts)
@@ -0,0 +1,27 @@
+"""delete orphaned bucketitems
+
+Revision ID: a9d3e6b0c215
+Revises: e5b92d7a3c18
+Create Date: 2026-10-18 20:41:37.415000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a9d3e6b0c215'
+down_revision = 'e5b92d7a3c18'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # deleting a bucketlist used to set the bucketlist_id of its items to
+    # NULL instead of deleting them, those items belong to no bucketlist
+    # and are never listed again
+    op.execute('DELETE FROM bucketitem WHERE bucketlist_id IS NULL OR '
+               'bucketlist_id NOT IN (SELECT id FROM bucketlist)')
+
+
+def downgrade():
+    # the deleted items cannot be brought back
+    pass
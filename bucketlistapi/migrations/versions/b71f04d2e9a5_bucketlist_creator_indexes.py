@@ -0,0 +1,29 @@
+"""bucketlist creator indexes
+
+Revision ID: b71f04d2e9a5
+Revises: 3c9e5d1a7b42
+Create Date: 2026-10-18 15:20:44.530000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b71f04d2e9a5'
+down_revision = '3c9e5d1a7b42'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # bucketlists of a user, in id order for keyset pages
+    op.create_index('ix_bucketlist_creator_id_id', 'bucketlist',
+                    ['creator_id', 'id'], unique=False)
+    # and in cursor order, so pages seek instead of sorting
+    op.create_index('ix_bucketlist_creator_id_date_created_id', 'bucketlist',
+                    ['creator_id', 'date_created', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_bucketlist_creator_id_date_created_id',
+                  table_name='bucketlist')
+    op.drop_index('ix_bucketlist_creator_id_id', table_name='bucketlist')
@@ -0,0 +1,23 @@
+"""user moving
+
+Revision ID: c5e8a2f1d7b3
+Revises: f3a6c1d8b9e4
+Create Date: 2026-10-18 23:48:05.262000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c5e8a2f1d7b3'
+down_revision = 'f3a6c1d8b9e4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('user', sa.Column('moving', sa.Boolean(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('moving')
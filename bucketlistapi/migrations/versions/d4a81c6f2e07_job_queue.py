@@ -0,0 +1,42 @@
+"""job queue
+
+Revision ID: d4a81c6f2e07
+Revises: b71f04d2e9a5
+Create Date: 2026-10-18 17:05:12.118000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd4a81c6f2e07'
+down_revision = 'b71f04d2e9a5'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'job',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('date_created', sa.DateTime(), nullable=True),
+        sa.Column('kind', sa.String(length=64), nullable=True),
+        sa.Column('state', sa.String(length=16), nullable=True),
+        sa.Column('creator_id', sa.Integer(), nullable=True),
+        sa.Column('payload', sa.Text(), nullable=True),
+        sa.Column('result', sa.Text(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=True),
+        sa.Column('date_started', sa.DateTime(), nullable=True),
+        sa.Column('date_finished', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['creator_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_job_state_id', 'job', ['state', 'id'], unique=False)
+    op.create_index('ix_job_creator_id_id', 'job', ['creator_id', 'id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_job_creator_id_id', table_name='job')
+    op.drop_index('ix_job_state_id', table_name='job')
+    op.drop_table('job')
@@ -0,0 +1,35 @@
+"""bucketlist item counters
+
+Revision ID: e5b92d7a3c18
+Revises: d4a81c6f2e07
+Create Date: 2026-10-18 19:42:31.504000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e5b92d7a3c18'
+down_revision = 'd4a81c6f2e07'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('bucketlist', sa.Column(
+        'item_count', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('bucketlist', sa.Column(
+        'done_count', sa.Integer(), nullable=False, server_default='0'))
+    # backfill, large tables may run `python manage.py recount_items`
+    # in batches instead once the columns exist
+    op.execute(
+        'UPDATE bucketlist SET '
+        'item_count = (SELECT count(*) FROM bucketitem '
+        'WHERE bucketitem.bucketlist_id = bucketlist.id), '
+        'done_count = (SELECT count(*) FROM bucketitem '
+        'WHERE bucketitem.bucketlist_id = bucketlist.id AND bucketitem.done)')
+
+
+def downgrade():
+    with op.batch_alter_table('bucketlist') as batch_op:
+        batch_op.drop_column('done_count')
+        batch_op.drop_column('item_count')
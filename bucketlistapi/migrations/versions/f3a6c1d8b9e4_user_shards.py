@@ -0,0 +1,35 @@
+"""user shards
+
+Revision ID: f3a6c1d8b9e4
+Revises: a9d3e6b0c215
+Create Date: 2026-10-18 21:16:48.907000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f3a6c1d8b9e4'
+down_revision = 'a9d3e6b0c215'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('user', sa.Column('shard', sa.Integer(), nullable=True))
+    op.create_table(
+        'id_sequence',
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('next_id', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    # ids handed out once SHARDS is set follow those already in use
+    for table in ('bucketlist', 'bucketitem'):
+        op.execute(
+            "INSERT INTO id_sequence (name, next_id) "
+            "SELECT '%s', COALESCE(MAX(id), 0) + 1 FROM %s" % (table, table))
+
+
+def downgrade():
+    op.drop_table('id_sequence')
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('shard')
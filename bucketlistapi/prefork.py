@@ -0,0 +1,251 @@
+'''
+Pre-fork production server
+
+    python manage.py serve -p 5000 -w 4 --max-requests 1000
+
+The master process loads the app once, opens the listening socket and forks
+the workers, which inherit both and take turns accepting connections from
+the socket. Every worker opens database connections of its own: the master
+empties the connection pools before forking and each worker starts from
+fresh ones, so no database socket is shared between processes. A worker
+exits after max_requests requests (plus up to 10% so they do not all
+restart together) and the master forks a replacement.
+
+Signals to the master:
+
+    HUP        zero downtime reload: the master re-executes itself, keeping
+               the listening socket open, reloads the code and config, forks
+               new workers and only then stops the old ones gracefully
+    TERM, INT  stop the workers gracefully and exit
+
+Workers finish the request they are serving when told to stop. POSIX only.
+'''
+import errno
+import os
+import random
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from app import db
+
+try:
+    from http.server import HTTPServer
+except ImportError:  # python 2
+    from BaseHTTPServer import HTTPServer
+
+
+# environment of a master re-executed by HUP
+LISTENER_FD = 'PREFORK_LISTENER_FD'
+OLD_WORKERS = 'PREFORK_OLD_WORKERS'
+
+
+def log(message, *args):
+    sys.stderr.write('[%d] %s\n' % (os.getpid(), message % args))
+    sys.stderr.flush()
+
+
+def listen(host, port, backlog=1024):
+    '''Returns the listening socket, or the one inherited over a reload'''
+    fd = os.environ.pop(LISTENER_FD, None)
+    if fd is not None:
+        listener = socket.fromfd(int(fd), socket.AF_INET, socket.SOCK_STREAM)
+        os.close(int(fd))  # fromfd duplicated it
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, port))
+        listener.listen(backlog)
+    # workers poll it, whichever accepts first serves the connection
+    listener.setblocking(False)
+    return listener
+
+
+def dispose_engines(app):
+    '''Closes the pooled connections of every engine of app'''
+    with app.app_context():
+        binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or ())
+        for bind in binds:
+            db.get_engine(app, bind).dispose()
+
+
+class WorkerServer(BaseWSGIServer):
+
+    '''Serves app from a listening socket opened by the master and counts
+    the requests it handled'''
+
+    def __init__(self, listener, app, handler=None):
+        self.address_family = listener.family
+        # the socket is already listening, skip binding one
+        HTTPServer.__init__(self, listener.getsockname(),
+                            handler or WSGIRequestHandler,
+                            bind_and_activate=False)
+        self.socket.close()
+        self.socket = listener
+        self.server_name, self.server_port = self.server_address[:2]
+        self.app = app
+        self.passthrough_errors = False
+        self.shutdown_signal = False
+        self.ssl_context = None
+        self.handled = 0
+
+    def get_request(self):
+        # raises EAGAIN when another worker accepted the connection first
+        connection, address = self.socket.accept()
+        connection.setblocking(True)
+        return connection, address
+
+    def finish_request(self, request, client_address):
+        self.handled += 1
+        BaseWSGIServer.finish_request(self, request, client_address)
+
+
+class Worker(object):
+
+    '''A forked process serving requests until told to stop or recycled'''
+
+    def __init__(self, app, listener, max_requests, handler=None):
+        self.app = app
+        self.listener = listener
+        self.max_requests = max_requests
+        self.handler = handler
+        self.alive = True
+
+    def stop(self, signum, frame):
+        self.alive = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        # a stop lets the request being served finish
+        signal.siginterrupt(signal.SIGTERM, False)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        # fresh connection pools, none of the master's sockets
+        dispose_engines(self.app)
+
+        limit = None
+        if self.max_requests:
+            limit = self.max_requests + random.randint(
+                0, self.max_requests // 10)
+        server = WorkerServer(self.listener, self.app, self.handler)
+        server.timeout = 0.5  # to notice stop() while idle
+        while self.alive and (limit is None or server.handled < limit):
+            server.handle_request()
+
+
+class PreforkServer(object):
+
+    '''Forks and supervises the workers serving app from listener'''
+
+    def __init__(self, app, listener, workers=None, max_requests=None,
+                 handler=None):
+        self.app = app
+        self.listener = listener
+        self.workers = workers or cpu_count()
+        self.max_requests = max_requests
+        self.handler = handler
+        self.pids = set()
+        self.stopping = False
+        self.reloading = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        log('serving on http://%s:%d/ with %d workers',
+            self.listener.getsockname()[0], self.listener.getsockname()[1],
+            self.workers)
+
+        old_workers = os.environ.pop(OLD_WORKERS, None)
+        self.spawn()
+        if old_workers:
+            # a reload: the new workers are up, retire the previous ones
+            for pid in old_workers.split(','):
+                self.kill(int(pid), signal.SIGTERM)
+
+        while not self.stopping:
+            if self.reloading:
+                self.reexec()
+            self.reap()
+            self.spawn()
+            time.sleep(0.1)
+
+        for pid in self.pids:
+            self.kill(pid, signal.SIGTERM)
+        while self.pids:
+            self.reap(block=True)
+        log('stopped')
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def reload(self, signum, frame):
+        self.reloading = True
+
+    def spawn(self):
+        if len(self.pids) < self.workers:
+            # no pooled connection may be inherited by a worker
+            dispose_engines(self.app)
+        while len(self.pids) < self.workers:
+            pid = os.fork()
+            if pid == 0:
+                status = 0
+                try:
+                    Worker(self.app, self.listener, self.max_requests,
+                           self.handler).run()
+                except Exception:
+                    traceback.print_exc()
+                    status = 1
+                finally:
+                    os._exit(status)
+            self.pids.add(pid)
+
+    def reap(self, block=False):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid == 0:
+                return
+            self.pids.discard(pid)
+            if block:
+                return
+
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def reexec(self):
+        '''Replaces the master with a fresh copy of itself that inherits the
+        listening socket and the running workers'''
+        self.reloading = False
+        log('reloading')
+        fd = self.listener.fileno()
+        if hasattr(os, 'set_inheritable'):
+            os.set_inheritable(fd, True)
+        os.environ[LISTENER_FD] = str(fd)
+        os.environ[OLD_WORKERS] = ','.join(str(pid) for pid in self.pids)
+        # ignored signals stay ignored across exec, until run() handles
+        # them again, so another HUP cannot kill the master meanwhile
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
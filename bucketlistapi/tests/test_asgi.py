@@ -0,0 +1,190 @@
+'''
+Test file to test serving the api through asgi.py
+'''
+import json
+import socket
+import sys
+import unittest
+from base64 import b64encode
+
+from flask import g
+
+from app import create_app, db
+from app.models import User, BucketList, BucketItem
+from app.unit_of_work import transaction
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from http.client import HTTPConnection
+    import asgi
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asgi.py needs Python 3.5')
+class TestASGI(unittest.TestCase):
+    default_username = 'lade'
+    default_password = 'password'
+
+    def setUp(self):
+        self.app = create_app('testing')
+        # requests arrive for whatever host the server listens on
+        self.app.config['SERVER_NAME'] = None
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        with transaction():
+            u = User(username=self.default_username)
+            u.hash_password(self.default_password)
+            u.save()
+            g.user = u
+            bucketlist = BucketList(name='asgi bucketlist')
+            bucketlist.create()
+            bucketlist.save()
+            item = BucketItem(name='asgi item', bucketlist_id=bucketlist.id)
+            item.create()
+            item.save()
+        self.asgi_app = asgi.ASGIApp(self.app.wsgi_app, 2)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        # requests in flight finish on the loop
+        self.loop.run_until_complete(
+            self.loop.run_in_executor(None, self.asgi_app.close))
+        self.loop.close()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get_api_headers(self):
+        return {
+            'Authorization': 'Basic ' + b64encode(
+                ('%s:%s' % (self.default_username, self.default_password))
+                .encode('utf-8')).decode('utf-8'),
+            'Content-Type': 'application/json',
+        }
+
+    def call(self, method, path, query_string=b'', body=b''):
+        # drives the ASGI app directly, returns the messages it sent
+        scope = {
+            'type': 'http', 'http_version': '1.1', 'method': method,
+            'path': path, 'query_string': query_string,
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in self.get_api_headers().items()],
+        }
+        messages = []
+
+        # plain functions returning futures, as Python 2 reads this file
+        def done(result):
+            future = self.loop.create_future()
+            future.set_result(result)
+            return future
+
+        def receive():
+            return done({'type': 'http.request', 'body': body})
+
+        def send(message):
+            messages.append(message)
+            return done(None)
+
+        self.loop.run_until_complete(self.asgi_app(scope, receive, send))
+        return messages
+
+    def test_get_bucketlists(self):
+        # test a request goes through the WSGI app on the worker threads
+        messages = self.call('GET', '/api/v1/bucketlists/',
+                             query_string=b'fields=name')
+        self.assertEqual(messages[0]['type'], 'http.response.start')
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertTrue(
+            (b'content-type', b'application/json') in messages[0]['headers'])
+        self.assertFalse(messages[-1].get('more_body', False))
+        data = json.loads(b''.join(
+            message.get('body', b'') for message in messages[1:]).decode())
+        self.assertEqual(data['bucketlists'], [{'name': 'asgi bucketlist'}])
+
+    def test_post_and_errors(self):
+        # test request bodies reach the app and errors come back as json
+        messages = self.call('POST', '/api/v1/bucketlists/',
+                             body=json.dumps({'name': 'posted'}).encode())
+        self.assertEqual(messages[0]['status'], 200)
+        messages = self.call('GET', '/api/v1/bucketlists/99/')
+        self.assertEqual(messages[0]['status'], 404)
+
+    def test_serve_over_http(self):
+        # test the asyncio server keeps connections alive and streams
+        server = self.loop.run_until_complete(
+            asgi.start_server(self.asgi_app, '127.0.0.1', 0))
+        port = server.sockets[0].getsockname()[1]
+
+        def client():
+            connection = HTTPConnection('127.0.0.1', port)
+            try:
+                results = []
+                for path in ('/api/v1/bucketlists/',
+                             '/api/v1/bucketlists/export/'):
+                    connection.request('GET', path,
+                                       headers=self.get_api_headers())
+                    response = connection.getresponse()
+                    results.append((response.status,
+                                    response.getheader('Transfer-Encoding'),
+                                    response.read()))
+                return results
+            finally:
+                connection.close()
+
+        try:
+            results = self.loop.run_until_complete(
+                self.loop.run_in_executor(None, client))
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+        (status, chunked, body), (export_status, export_chunked, export) = \
+            results
+        self.assertEqual(status, 200)
+        self.assertTrue(chunked is None)
+        self.assertEqual(
+            json.loads(body.decode())['bucketlists'][0]['name'],
+            'asgi bucketlist')
+        self.assertEqual(export_status, 200)
+        self.assertEqual(export_chunked, 'chunked')
+        self.assertTrue(b'asgi item' in export)
+
+    def test_malformed_requests(self):
+        # test malformed request lines and lengths are answered with 400
+        server = self.loop.run_until_complete(
+            asgi.start_server(self.asgi_app, '127.0.0.1', 0))
+        port = server.sockets[0].getsockname()[1]
+
+        def send(request):
+            connection = socket.create_connection(('127.0.0.1', port))
+            try:
+                connection.sendall(request)
+                response = b''
+                while True:
+                    data = connection.recv(4096)
+                    if not data:
+                        return response
+                    response += data
+            finally:
+                connection.close()
+
+        requests = [
+            b'GARBAGE\r\n\r\n',
+            b'GET / SPDY/3\r\n\r\n',
+            b'POST /api/v1/bucketlists/ HTTP/1.1\r\n'
+            b'Content-Length: many\r\n\r\n',
+            b'POST /api/v1/bucketlists/ HTTP/1.1\r\n'
+            b'Content-Length: -1\r\n\r\n',
+        ]
+        try:
+            responses = [self.loop.run_until_complete(
+                self.loop.run_in_executor(None, send, request))
+                for request in requests]
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+        for response in responses:
+            self.assertTrue(
+                response.startswith(b'HTTP/1.1 400 Bad Request\r\n'))
+
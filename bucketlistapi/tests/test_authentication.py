@@ -2,13 +2,16 @@
 Test file to test authentication endpoints
 '''
 import json
+import threading
+import time
 import unittest
 from base64 import b64encode
 
 from flask import url_for, g
 
-from app import create_app, db
-from app.models import User, BucketList, BucketItem
+from app import create_app, db, password_hasher, token_cache
+from app.models import User, BucketList, BucketItem, AuthPrincipal
+from app.unit_of_work import transaction
 
 
 class TestAPI(unittest.TestCase):
@@ -23,18 +26,19 @@ class TestAPI(unittest.TestCase):
         self.app_context.push()
         db.drop_all()
         db.create_all()
-        u = User(username=self.default_username)
-        u.hash_password(self.default_password)
-        u.save()
-        g.user = u
-        bucketlist = BucketList(name=self.default_bucketlist)
-        bucketlist.create()
-        bucketlist.save()
-        item = BucketItem(
-            name=self.default_bucketlistitem, bucketlist_id=bucketlist.id
-        )
-        item.create()
-        item.save()
+        with transaction():
+            u = User(username=self.default_username)
+            u.hash_password(self.default_password)
+            u.save()
+            g.user = u
+            bucketlist = BucketList(name=self.default_bucketlist)
+            bucketlist.create()
+            bucketlist.save()
+            item = BucketItem(
+                name=self.default_bucketlistitem, bucketlist_id=bucketlist.id
+            )
+            item.create()
+            item.save()
         self.client = self.app.test_client()
 
     def tearDown(self):
@@ -89,6 +93,76 @@ class TestAPI(unittest.TestCase):
             headers=self.get_api_headers(token, 'password'))
         self.assertTrue(response.status_code == 200)
 
+    def test_deleted_user_token_error(self):
+        # test a cached token stops working once its user is deleted
+        token = self.get_token()
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            headers=self.get_api_headers(token, 'password'))
+        self.assertTrue(response.status_code == 200)
+        User.query.filter_by(username='lade').first().delete()
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            headers=self.get_api_headers(token, 'password'))
+        self.assertTrue(response.status_code == 401)
+
+    def test_concurrent_tokens_invalidated(self):
+        # test tokens cached by concurrent logins of a user are all dropped
+        # with the user
+        principal = AuthPrincipal(1, 'lade')
+        tokens = ['token.%d' % n for n in range(50)]
+        app = self.app
+
+        def cache(token):
+            with app.app_context():
+                token_cache.set(token, principal, time.time() + 600)
+        threads = [threading.Thread(target=cache, args=(token,))
+                   for token in tokens]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(token_cache.get(token) == principal
+                            for token in tokens))
+        token_cache.invalidate_user(1)
+        self.assertEqual([token for token in tokens
+                          if token_cache.get(token) is not None], [])
+        # tokens verified again are cached again
+        token_cache.set(tokens[0], principal, time.time() + 600)
+        self.assertEqual(token_cache.get(tokens[0]), principal)
+
+    def test_bearer_token(self):
+        # test authenticating with a bearer token header
+        token = self.get_token()
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            headers={'Authorization': 'Bearer ' + token})
+        self.assertTrue(response.status_code == 200)
+
+    def test_repeated_basic_auth_skips_hashing(self):
+        # test verified credentials are not hashed again
+        verify = password_hasher.verify
+        calls = []
+
+        def counting_verify(password, password_hash):
+            calls.append(password)
+            return verify(password, password_hash)
+
+        password_hasher.verify = counting_verify
+        try:
+            for _ in range(3):
+                response = self.client.get(
+                    url_for('api_1.bucketlists'),
+                    headers=self.get_api_headers('lade', 'password'))
+                self.assertTrue(response.status_code == 200)
+            response = self.client.get(
+                url_for('api_1.bucketlists'),
+                headers=self.get_api_headers('lade', 'wrong'))
+            self.assertTrue(response.status_code == 401)
+        finally:
+            password_hasher.verify = verify
+        self.assertEqual(calls, ['password', 'wrong'])
+
     # test errors
     def test_login_error(self):
         # test invalid username or password
@@ -98,6 +172,13 @@ class TestAPI(unittest.TestCase):
             data=json.dumps({'username': 'lad', 'password': 'pass'}))
         self.assertTrue(response.status_code == 200)
 
+    def test_bearer_token_error(self):
+        # test bearer header with an invalid token
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            headers={'Authorization': 'Bearer lade'})
+        self.assertTrue(response.status_code == 401)
+
     def test_registration_error(self):
         # test double registration
         response = self.client.post(
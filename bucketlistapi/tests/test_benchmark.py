@@ -0,0 +1,56 @@
+'''
+Test file to smoke test the load test behind manage.py bench
+'''
+import os
+import sys
+import tempfile
+import unittest
+
+import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_run_and_compare(self):
+        # test every selected route is measured and compared to a baseline
+        results = benchmark.run(
+            users=2, bucketlists=2, items=2, requests=4, concurrency=2,
+            database='sqlite:///' + self.path,
+            only=['list_bucketlists', 'add_item', 'delete_item'])
+        self.assertEqual(results['seed']['items'], 8)
+        self.assertEqual(
+            sorted(results['routes']),
+            ['add_item', 'delete_item', 'list_bucketlists'])
+        for result in results['routes'].values():
+            self.assertEqual(result['errors'], 0)
+            self.assertEqual(result['latency']['count'], 4)
+            self.assertTrue(result['throughput_rps'] > 0)
+            self.assertTrue(result['queries_per_request'] > 0)
+        self.assertEqual(
+            results['routes']['add_item']['statuses'], {'200': 4})
+
+        report = benchmark.report(results, baseline=results)
+        self.assertTrue('list_bucketlists' in report)
+        self.assertTrue('+0%' in report)
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'asgi.py needs Python 3.5')
+    def test_concurrency(self):
+        # test both serving modes are measured at every level
+        results = benchmark.concurrency(
+            users=2, bucketlists=2, items=2, requests=4, levels=(1, 2),
+            database='sqlite:///' + self.path)
+        for mode in ('wsgi', 'asgi'):
+            self.assertEqual(sorted(results['modes'][mode]), ['1', '2'])
+            for level in results['modes'][mode].values():
+                for name in benchmark.CONCURRENCY_ROUTES:
+                    self.assertEqual(level[name]['errors'], 0)
+                    self.assertEqual(level[name]['statuses'], {'200': 4})
+        self.assertTrue('get_bucketlist' in
+                        benchmark.concurrency_report(results))
@@ -0,0 +1,109 @@
+'''
+Test file to test bulk exports and imports between databases
+'''
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import sqlalchemy
+from flask import g
+from sqlalchemy.exc import IntegrityError
+
+from app import create_app, db
+from app import bulk
+from app.models import User, BucketList, BucketItem
+from app.unit_of_work import transaction
+
+
+class TestBulk(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        with transaction():
+            for username in ('lade', 'dave'):
+                u = User(username=username)
+                u.hash_password('password')
+                u.save()
+                g.user = u
+                bucketlist = BucketList(name=u'%s, "quoted" \xe9' % username)
+                bucketlist.create()
+                bucketlist.save()
+                for n in range(3):
+                    item = BucketItem(name='%s item\n%d' % (username, n),
+                                      bucketlist_id=bucketlist.id)
+                    item.create()
+                    item.done = n == 1
+                    item.save()
+            # NULLs survive
+            item.date_modified = None
+            # the items were added without counting them
+            db.session.execute(BucketList.recount())
+        self.directory = tempfile.mkdtemp()
+        self.target = sqlalchemy.create_engine(
+            'sqlite:///' + os.path.join(self.directory, 'target.sqlite'))
+        db.metadata.create_all(self.target)
+
+    def tearDown(self):
+        self.target.dispose()
+        shutil.rmtree(self.directory)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def rows(self, engine):
+        with engine.connect() as connection:
+            return dict((table.name, connection.execute(
+                db.select(list(table.c)).order_by(table.c.id)).fetchall())
+                for table in bulk.TABLES)
+
+    def assertCopied(self, timer):
+        self.assertEqual(self.rows(self.target), self.rows(db.engine))
+        self.assertEqual([(name, rows) for name, rows, _ in timer.tables],
+                         [('user', 2), ('bucketlist', 2), ('bucketitem', 6)])
+        self.assertTrue('total' in timer.report())
+
+    def test_ndjson(self):
+        # test a dump loads back unchanged, in small batches
+        path = os.path.join(self.directory, 'dump.ndjson')
+        bulk.dump(db.engine, path, 'ndjson', size=4)
+        self.assertCopied(bulk.load(self.target, path, 'ndjson', size=4))
+
+    def test_csv(self):
+        # test a csv dump loads back unchanged
+        path = os.path.join(self.directory, 'dump')
+        bulk.dump(db.engine, path, 'csv', size=4)
+        self.assertEqual(sorted(os.listdir(path)),
+                         ['bucketitem.csv', 'bucketlist.csv', 'user.csv'])
+        self.assertCopied(bulk.load(self.target, path, 'csv', size=4))
+
+    def test_load_is_one_transaction(self):
+        # test a load failing on its last table leaves nothing behind
+        path = os.path.join(self.directory, 'dump.ndjson')
+        bulk.dump(db.engine, path)
+        with self.target.begin() as connection:
+            connection.execute(BucketItem.__table__.insert(),
+                               {'id': 6, 'name': 'in the way'})
+        self.assertRaises(IntegrityError, bulk.load, self.target, path)
+        rows = self.rows(self.target)
+        self.assertEqual((len(rows['user']), len(rows['bucketitem'])), (0, 1))
+
+    def test_values(self):
+        # test values written by PostgreSQL's COPY are read too
+        self.assertEqual(bulk.parse_datetime('2015-10-24 16:17:25.5'),
+                         datetime(2015, 10, 24, 16, 17, 25, 500000))
+        self.assertEqual(bulk.parse_datetime('2015-10-24T16:17:25'),
+                         datetime(2015, 10, 24, 16, 17, 25))
+        self.assertRaises(ValueError, bulk.parse_datetime, '24/10/2015')
+        load = bulk.loader(BucketItem.__table__.c.done)
+        self.assertEqual([load(value) for value in ('t', 'f', True, '')],
+                         [True, False, True, None])
+        stream = bulk.CSVStream([[1, u'a, "b"', None, 'true']])
+        self.assertEqual(stream.read(5) + stream.read(),
+                         b'1,"a, ""b""",,true\r\n')
+        self.assertEqual(stream.count, 1)
@@ -0,0 +1,133 @@
+'''
+Test file to test the item counters of bucketlists
+'''
+import json
+import unittest
+from base64 import b64encode
+
+from flask import url_for, g
+
+from app import create_app, db, job_runner
+from app.models import User, BucketList, BucketItem
+from app.unit_of_work import transaction
+
+
+class TestCounters(unittest.TestCase):
+    default_username = 'lade'
+    default_password = 'password'
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        with transaction():
+            u = User(username=self.default_username)
+            u.hash_password(self.default_password)
+            u.save()
+            g.user = u
+            bucketlist = BucketList(name='counted')
+            bucketlist.create()
+            bucketlist.save()
+            self.bucketlist_id = bucketlist.id
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get_api_headers(self):
+        return {
+            'Authorization': 'Basic ' + b64encode(
+                ('%s:%s' % (self.default_username,
+                            self.default_password)).encode('utf-8')
+            ).decode('utf-8'),
+            'Content-Type': 'application/json'
+        }
+
+    def request(self, method, endpoint, data=None, **values):
+        response = getattr(self.client, method)(
+            url_for(endpoint, bucketlist_id=self.bucketlist_id, **values),
+            headers=self.get_api_headers(),
+            data=json.dumps(data) if data is not None else None)
+        self.assertTrue(response.status_code < 300)
+        return json.loads(response.data)
+
+    def counts(self):
+        # as listed, without loading the items
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            query_string={'fields': 'id,item_count,done_count'},
+            headers=self.get_api_headers())
+        bucketlist, = json.loads(response.data)['bucketlists']
+        self.assertEqual(sorted(bucketlist),
+                         ['done_count', 'id', 'item_count'])
+        self.assertEqual(BucketList.count_drift(), [])
+        return bucketlist['item_count'], bucketlist['done_count']
+
+    def test_single_items(self):
+        # test adding, updating and deleting an item keeps the counters
+        item = self.request('post', 'api_1.add_bucketitem',
+                            {'name': 'first'})['item']
+        self.request('post', 'api_1.add_bucketitem', {'name': 'second'})
+        self.assertEqual(self.counts(), (2, 0))
+
+        for done, counts in ((True, (2, 1)), (True, (2, 1)),
+                             (False, (2, 0)), (True, (2, 1))):
+            self.request('put', 'api_1.bucketitem', {'done': done},
+                         bucketitem_id=item['id'])
+            self.assertEqual(self.counts(), counts)
+
+        self.request('delete', 'api_1.bucketitem', bucketitem_id=item['id'])
+        self.assertEqual(self.counts(), (1, 0))
+
+    def test_batches(self):
+        # test batches count what they applied and nothing else
+        items = self.request('post', 'api_1.bucketitems_batch', [
+            {'name': 'a'}, {'name': 'b'}, {'name': 'c'}, {'name': 'a'},
+            {}])['items']
+        ids = [result['item']['id'] for result in items[:3]]
+        self.assertEqual(self.counts(), (3, 0))
+
+        self.request('patch', 'api_1.bucketitems_batch', [
+            {'id': ids[0], 'done': True}, {'id': ids[1], 'done': True},
+            {'id': ids[1], 'done': False}, {'id': ids[2], 'done': False},
+            {'id': 0, 'done': True}])
+        self.assertEqual(self.counts(), (3, 1))
+
+        self.request('delete', 'api_1.bucketitems_batch',
+                     [ids[0], ids[2], ids[2], 0])
+        self.assertEqual(self.counts(), (1, 0))
+
+    def test_jobs(self):
+        # test imports count their items and background deletes empty the
+        # counters as they go
+        with transaction():
+            job_runner.enqueue('import_bucketlists', g.user.id, bucketlists=[
+                {'name': 'imported', 'items': [
+                    {'name': 'x', 'done': True}, {'name': 'y', 'done': False}
+                ]}])
+        job_runner.run_pending()
+        imported = BucketList.query.filter_by(name='imported').first()
+        self.assertEqual((imported.item_count, imported.done_count), (2, 1))
+        self.assertEqual(BucketList.count_drift(), [])
+
+        with transaction():
+            job_runner.enqueue('delete_bucketlist', g.user.id,
+                               bucketlist_id=imported.id)
+        job_runner.run_pending()
+        self.assertEqual(BucketItem.query.count(), 0)
+
+    def test_drift(self):
+        # test drifted counters are found and recounted
+        self.request('post', 'api_1.add_bucketitem', {'name': 'first'})
+        with transaction():
+            db.session.execute(BucketItem.__table__.update().values(
+                done=True))
+        self.assertEqual(BucketList.count_drift(),
+                         [(self.bucketlist_id, 1, 0, 1, 1)])
+        with transaction():
+            db.session.execute(BucketList.recount())
+        self.assertEqual(self.counts(), (1, 1))
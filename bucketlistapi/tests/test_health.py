@@ -0,0 +1,52 @@
+'''
+Test file to test the health endpoints and pool instrumentation
+'''
+import json
+import unittest
+
+from flask import url_for
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+from app import create_app, db
+from app.pool import instrumented, pool_status
+
+
+class TestHealth(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_health_db(self):
+        # test the database health check reports the pool
+        response = self.client.get(url_for('api_1.health_db'))
+        self.assertTrue(response.status_code == 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['status'], 'ok')
+        self.assertTrue(data['pool']['checkouts'] > 0)
+        self.assertEqual(data['pool']['checked_out'], 0)
+
+    def test_queue_pool_status(self):
+        # test queue pools report their size, overflow and checkout latency
+        engine = create_engine(
+            'sqlite://', poolclass=instrumented(QueuePool, pre_ping=True),
+            pool_size=2, max_overflow=3)
+        connections = [engine.connect() for _ in range(3)]
+        status = pool_status(engine)
+        self.assertEqual(status['size'], 2)
+        self.assertEqual(status['overflow'], 1)
+        self.assertEqual(status['checked_out'], 3)
+        self.assertEqual(status['checkout_latency']['count'], 3)
+        for connection in connections:
+            connection.close()
+        self.assertEqual(pool_status(engine)['checked_out'], 0)
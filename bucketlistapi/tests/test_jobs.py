@@ -0,0 +1,264 @@
+'''
+Test file to test background jobs
+'''
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from base64 import b64encode
+from datetime import datetime, timedelta
+
+from flask import url_for, g
+
+from app import create_app, db, job_runner
+from app.jobs import WorkerPool
+from app.models import User, BucketList, BucketItem, Job
+from app.unit_of_work import transaction
+
+
+class TestJobs(unittest.TestCase):
+    default_username = 'lade'
+    default_password = 'password'
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.results_dir = tempfile.mkdtemp()
+        self.app.config['JOB_RESULTS_DIR'] = self.results_dir
+        self.app.config['BACKGROUND_DELETE_ITEMS'] = 2
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        with transaction():
+            for username in (self.default_username, 'dave'):
+                u = User(username=username)
+                u.hash_password(self.default_password)
+                u.save()
+            g.user = User.query.filter_by(
+                username=self.default_username).first()
+            for name, items in (('big', 3), ('small', 1)):
+                bucketlist = BucketList(name=name)
+                bucketlist.create()
+                bucketlist.save()
+                for n in range(items):
+                    item = BucketItem(name='%s item %d' % (name, n),
+                                      bucketlist_id=bucketlist.id)
+                    item.create()
+                    item.save()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        job_runner.handlers.pop('fail', None)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.results_dir)
+
+    def get_api_headers(self, username=None):
+        return {
+            'Authorization': 'Basic ' + b64encode(
+                ('%s:%s' % (username or self.default_username,
+                            self.default_password)).encode('utf-8')
+            ).decode('utf-8'),
+            'Content-Type': 'application/json'
+        }
+
+    def bucketlist_id(self, name):
+        return BucketList.query.filter_by(name=name).first().id
+
+    def get_job(self, url, username=None):
+        response = self.client.get(
+            url, headers=self.get_api_headers(username))
+        return response.status_code, json.loads(response.data).get('job')
+
+    def test_large_delete_in_background(self):
+        # test deleting a large bucketlist answers 202 and a worker deletes
+        # it with its items
+        bucketlist_id = self.bucketlist_id('big')
+        response = self.client.delete(
+            url_for('api_1.bucketlist', bucketlist_id=bucketlist_id),
+            headers=self.get_api_headers())
+        self.assertEqual(response.status_code, 202)
+        job = json.loads(response.data)['job']
+        self.assertEqual(job['state'], 'queued')
+        self.assertEqual(response.headers['Location'], job['job_url'])
+
+        # deleting it again while queued reuses the job
+        response = self.client.delete(
+            url_for('api_1.bucketlist', bucketlist_id=bucketlist_id),
+            headers=self.get_api_headers())
+        self.assertEqual(json.loads(response.data)['job']['id'], job['id'])
+
+        # only its creator sees the job
+        self.assertEqual(self.get_job(job['job_url'], 'dave')[0], 404)
+
+        self.assertEqual(job_runner.run_pending(), 1)
+        status, job = self.get_job(job['job_url'])
+        self.assertEqual(job['state'], 'done')
+        self.assertEqual(job['result'], {'items_deleted': 3})
+        self.assertEqual(job['attempts'], 1)
+        self.assertTrue(job['date_finished'])
+        self.assertEqual(BucketList.query.get(bucketlist_id), None)
+        self.assertEqual(BucketItem.query.filter(
+            BucketItem.name.like('big %')).count(), 0)
+
+    def test_small_delete_removes_items(self):
+        # test bucketlists deleted in the request leave no orphaned items
+        response = self.client.delete(
+            url_for('api_1.bucketlist',
+                    bucketlist_id=self.bucketlist_id('small')),
+            headers=self.get_api_headers())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(BucketItem.query.count(), 3)
+        self.assertEqual(BucketItem.query.filter_by(
+            bucketlist_id=None).count(), 0)
+
+    def test_export(self):
+        # test exports are written in the background and downloaded
+        response = self.client.post(
+            url_for('api_1.export_job'), query_string={'format': 'csv'},
+            headers=self.get_api_headers())
+        self.assertEqual(response.status_code, 202)
+        job_url = json.loads(response.data)['job']['job_url']
+        job_runner.run_pending()
+        status, job = self.get_job(job_url)
+        self.assertEqual(job['result'],
+                         {'format': 'csv', 'bucketlists': 2, 'items': 4})
+
+        response = self.client.get(
+            job['result_url'], headers=self.get_api_headers())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/csv')
+        rows = list(csv.DictReader(
+            io.StringIO(response.data.decode('utf-8'))))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(
+            set(row['item_name'] for row in rows if row['bucketlist_name']
+                == 'big'), set(['big item 0', 'big item 1', 'big item 2']))
+
+        response = self.client.post(
+            url_for('api_1.export_job'), headers=self.get_api_headers())
+        job_url = json.loads(response.data)['job']['job_url']
+        job_runner.run_pending()
+        response = self.client.get(
+            self.get_job(job_url)[1]['result_url'],
+            headers=self.get_api_headers())
+        bucketlists = json.loads(response.data)['bucketlists']
+        self.assertEqual([len(bucketlist['items'])
+                          for bucketlist in bucketlists], [3, 1])
+
+        response = self.client.post(
+            url_for('api_1.export_job'), query_string={'format': 'xml'},
+            headers=self.get_api_headers())
+        self.assertEqual(response.status_code, 400)
+
+    def test_expired_exports(self):
+        # test idle workers delete exports once they expired, which can no
+        # longer be downloaded
+        response = self.client.post(
+            url_for('api_1.export_job'), headers=self.get_api_headers())
+        job = json.loads(response.data)['job']
+        job_runner.run_pending()
+        job = self.get_job(job['job_url'])[1]
+        path = Job.query.get(job['id']).file_path()
+        self.assertTrue(os.path.exists(path))
+
+        self.app.config['JOB_RESULTS_TTL'] = 3600
+        old = time.time() - 7200
+        os.utime(path, (old, old))
+        with transaction():
+            finished = Job.query.get(job['id'])
+            finished.date_finished = datetime.now() - timedelta(hours=2)
+        job_runner.run_next()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.get_job(job['job_url'])[1]['result_url'], None)
+        response = self.client.get(
+            job['result_url'], headers=self.get_api_headers())
+        self.assertEqual(response.status_code, 404)
+
+    def test_import(self):
+        # test imports create what is new and skip names in use
+        document = {'bucketlists': [
+            {'name': 'imported', 'items': [
+                {'name': 'imported item', 'done': True},
+                {'name': 'big item 0'}]},
+            {'name': 'small', 'items': [{'name': 'skipped item'}]},
+        ]}
+        response = self.client.post(
+            url_for('api_1.import_job'), headers=self.get_api_headers(),
+            data=json.dumps(document))
+        self.assertEqual(response.status_code, 202)
+        job_url = json.loads(response.data)['job']['job_url']
+        job_runner.run_pending()
+        self.assertEqual(self.get_job(job_url)[1]['result'], {
+            'bucketlists': 1, 'items': 1,
+            'bucketlists_skipped': 1, 'items_skipped': 2})
+        bucketlist = BucketList.query.filter_by(name='imported').first()
+        self.assertEqual(bucketlist.creator_id, g.user.id)
+        self.assertEqual(
+            [(item.name, item.done) for item in bucketlist.bucketitems],
+            [('imported item', True)])
+
+        for document in ({'bucketlists': [{'items': []}]},
+                         [{'name': 'x', 'items': [{'name': 'y',
+                                                   'done': 'yes'}]}],
+                         'bucketlists'):
+            response = self.client.post(
+                url_for('api_1.import_job'), headers=self.get_api_headers(),
+                data=json.dumps(document))
+            self.assertEqual(response.status_code, 400)
+
+    def test_failed_and_lost_jobs(self):
+        # test a handler raising fails its job, and jobs lost with their
+        # worker run again until they were attempted too often
+        @job_runner.handler('fail')
+        def fail(job):
+            raise RuntimeError('broken')
+
+        with transaction():
+            failing = job_runner.enqueue('fail', g.user.id)
+            lost = job_runner.enqueue(
+                'delete_bucketlist', g.user.id,
+                bucketlist_id=self.bucketlist_id('small'))
+        failing_id, lost_id = failing.id, lost.id
+        job_runner.run_next()
+        failing = Job.query.get(failing_id)
+        self.assertEqual(failing.state, 'failed')
+        self.assertEqual(failing.error, 'RuntimeError: broken')
+
+        # a worker claimed the job and died with it
+        queue = job_runner.queue
+        self.assertEqual(queue.claim().id, lost_id)
+        self.assertEqual(queue.claim(), None)
+        for attempts, state in ((1, 'queued'), (3, 'failed')):
+            with transaction():
+                lost = Job.query.get(lost_id)
+                lost.state = 'running'
+                lost.attempts = attempts
+                lost.date_started = datetime.now() - timedelta(hours=2)
+            queue.requeue_lost(3600, 3)
+            self.assertEqual(Job.query.get(lost_id).state, state)
+
+    def test_worker_pool(self):
+        # test worker threads run the jobs queued
+        self.app.config['JOB_POLL_INTERVAL'] = 0.05
+        with transaction():
+            job_id = job_runner.enqueue(
+                'delete_bucketlist', g.user.id,
+                bucketlist_id=self.bucketlist_id('big')).id
+        pool = WorkerPool(self.app, job_runner, 2)
+        pool.start()
+        try:
+            deadline = time.time() + 10
+            while time.time() < deadline:
+                db.session.remove()
+                if Job.query.get(job_id).state == 'done':
+                    break
+                time.sleep(0.05)
+        finally:
+            pool.stop()
+        self.assertEqual(Job.query.get(job_id).state, 'done')
@@ -0,0 +1,87 @@
+'''
+Test file to test the pre-fork server behind manage.py serve
+'''
+import json
+import os
+import signal
+import unittest
+
+from flask import g
+
+from app import create_app, db
+from app.models import User
+from app.unit_of_work import transaction
+import benchmark
+import prefork
+
+try:
+    from http.client import HTTPConnection
+except ImportError:  # python 2
+    from httplib import HTTPConnection
+
+
+@unittest.skipIf(not hasattr(os, 'fork'), 'the pre-fork server needs fork')
+class TestPrefork(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        # requests arrive for whatever host the server listens on
+        self.app.config['SERVER_NAME'] = None
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        with transaction():
+            u = User(username='lade')
+            u.hash_password('password')
+            u.save()
+            g.user = u
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def start(self, workers, max_requests):
+        # forks a master process, returns its pid and port
+        listener = prefork.listen('127.0.0.1', 0)
+        prefork.dispose_engines(self.app)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                prefork.PreforkServer(
+                    self.app, listener, workers, max_requests,
+                    handler=benchmark.QuietHandler).run()
+            finally:
+                os._exit(0)
+        port = listener.getsockname()[1]
+        listener.close()
+        return pid, port
+
+    def request(self, port, method, path, body=None):
+        connection = HTTPConnection('127.0.0.1', port)
+        try:
+            connection.request(method, path, body,
+                               {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            return response.status, json.loads(response.read().decode())
+        finally:
+            connection.close()
+
+    def test_serve_recycle_and_stop(self):
+        # test workers keep serving past their request limit and the
+        # master stops cleanly
+        pid, port = self.start(workers=2, max_requests=2)
+        try:
+            for n in range(12):
+                status, data = self.request(
+                    port, 'POST', '/api/v1/auth/login/',
+                    json.dumps({'username': 'lade', 'password': 'password'}))
+                self.assertEqual(status, 200)
+                self.assertTrue(data['token'])
+            status, data = self.request(port, 'GET', '/api/v1/_health/db')
+            self.assertEqual(status, 200)
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            _, exit_status = os.waitpid(pid, 0)
+        self.assertEqual(exit_status, 0)
@@ -0,0 +1,102 @@
+'''
+Test file to test request profiling and the metrics endpoint
+'''
+import json
+import unittest
+from base64 import b64encode
+
+from flask import url_for, g
+
+from app import create_app, db
+from app.models import User, BucketList
+from app.profiling import RequestProfile
+from app.unit_of_work import transaction
+
+
+class TestProfiling(unittest.TestCase):
+    default_username = 'lade'
+    default_password = 'password'
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['PROFILE_REQUESTS'] = True
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        with transaction():
+            u = User(username=self.default_username)
+            u.hash_password(self.default_password)
+            u.save()
+            g.user = u
+            BucketList(name='travel', creator_id=u.id).save()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get_api_headers(self, username, password):
+        return {
+            'Authorization':
+                'Basic ' + b64encode(
+                    (username + ':' + password).encode('utf-8')).decode('utf-8'),
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'
+        }
+
+    def test_server_timing(self):
+        # test profiled responses carry a Server-Timing header
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            headers=self.get_api_headers('lade', 'password'))
+        self.assertTrue(response.status_code == 200)
+        timing = response.headers['Server-Timing']
+        self.assertTrue('sql;dur=' in timing)
+        self.assertTrue('serialize;dur=' in timing)
+        self.assertTrue('total;dur=' in timing)
+
+    def test_no_server_timing_when_disabled(self):
+        # test profiling is opt in
+        self.app.config['PROFILE_REQUESTS'] = False
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            headers=self.get_api_headers('lade', 'password'))
+        self.assertFalse('Server-Timing' in response.headers)
+
+    def test_metrics(self):
+        # test the metrics endpoint reports per endpoint percentiles
+        headers = self.get_api_headers('lade', 'password')
+        for _ in range(3):
+            self.client.get(url_for('api_1.bucketlists'), headers=headers)
+        response = self.client.get(url_for('api_1.metrics'), headers=headers)
+        self.assertTrue(response.status_code == 200)
+        data = json.loads(response.data)
+        self.assertTrue(data['profiling'])
+        bucketlists = data['endpoints']['api_1.bucketlists']
+        self.assertEqual(bucketlists['requests'], 3)
+        self.assertEqual(bucketlists['wall']['count'], 3)
+        self.assertTrue(bucketlists['wall']['p99_ms'] > 0)
+        self.assertTrue(bucketlists['queries_per_request'] > 0)
+        self.assertTrue(bucketlists['slowest_statements'])
+        self.assertTrue(bucketlists['serialize']['max_ms'] > 0)
+
+    def test_metrics_requires_login(self):
+        # test the metrics are not public
+        response = self.client.get(url_for('api_1.metrics'))
+        self.assertTrue(response.status_code == 401)
+
+    def test_failed_statement_timing(self):
+        # test a failing statement leaves nothing behind on its connection
+        with self.app.test_request_context():
+            g._profile = RequestProfile()
+            with db.engine.connect() as connection:
+                with self.assertRaises(Exception):
+                    connection.execute('SELECT * FROM missing')
+                self.assertFalse('profile_start' in connection.info)
+                connection.execute('SELECT 1')
+                self.assertEqual(
+                    [statement for _, statement in g._profile.statements],
+                    ['SELECT 1'])
+
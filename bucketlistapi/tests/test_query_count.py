@@ -0,0 +1,160 @@
+'''
+Test file to check the number of queries issued by list endpoints
+'''
+import json
+import unittest
+from base64 import b64encode
+
+from flask import url_for, g
+from sqlalchemy import event
+
+from app import create_app, db
+from app.models import User, BucketList, BucketItem
+from app.unit_of_work import transaction
+
+
+class TestQueryCount(unittest.TestCase):
+    default_username = 'lade'
+    default_password = 'password'
+    items_per_bucketlist = 3
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        with transaction():
+            u = User(username=self.default_username)
+            u.hash_password(self.default_password)
+            u.save()
+            g.user = u
+        self.client = self.app.test_client()
+        self.token = self.get_token()
+        # the first request with the token caches it
+        self.client.get(
+            url_for('api_1.bucketlists'),
+            headers=self.get_api_headers(self.token, 'password'))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get_api_headers(self, username, password):
+        return {
+            'Authorization':
+                'Basic ' + b64encode(
+                    (username + ':' + password).encode('utf-8')).decode('utf-8'),
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'
+        }
+
+    def get_token(self):
+        # calls the login function and returns the token generated
+        response = self.client.post(
+            url_for('api_1.login'),
+            headers=self.get_api_headers('lade', 'password'),
+            data=json.dumps({'username': 'lade', 'password': 'password'}))
+        token = json.loads(response.data)['token']
+        return token
+
+    def add_bucketlists(self, count):
+        # creates bucketlists each holding a few items
+        start = BucketList.query.count()
+        with transaction():
+            for number in range(start, start + count):
+                bucketlist = BucketList(name='bucketlist %d' % number)
+                bucketlist.create()
+                bucketlist.save()
+                for item_number in range(self.items_per_bucketlist):
+                    item = BucketItem(
+                        name='item %d-%d' % (number, item_number),
+                        bucketlist_id=bucketlist.id
+                    )
+                    item.create()
+                    item.save()
+
+    def record_queries(self, url, method='get', query_string=None):
+        # returns the statements executed while serving url
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, many):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = getattr(self.client, method)(
+                url, headers=self.get_api_headers(self.token, 'password'),
+                query_string=query_string)
+            # streamed responses run their queries as they are read
+            response.get_data()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertTrue(response.status_code == 200)
+        return statements
+
+    def count_queries(self, url, method='get'):
+        # returns the number of statements executed while serving url
+        return len(self.record_queries(url, method))
+
+    def test_bucketlists_query_count_is_constant(self):
+        # test listing bucketlists costs the same for any page size
+        url = url_for('api_1.bucketlists')
+        self.add_bucketlists(2)
+        small_page = self.count_queries(url)
+        self.add_bucketlists(15)
+        large_page = self.count_queries(url)
+        self.assertEqual(small_page, large_page)
+
+    def test_users_query_count_is_constant(self):
+        # test listing users costs the same for any number of bucketlists
+        url = url_for('api_1.get_users')
+        self.add_bucketlists(2)
+        few_bucketlists = self.count_queries(url)
+        self.add_bucketlists(40)
+        many_bucketlists = self.count_queries(url)
+        self.assertEqual(few_bucketlists, many_bucketlists)
+
+    def test_sparse_bucketlists_skip_unrequested_data(self):
+        # test unrequested columns and relations are never selected
+        url = url_for('api_1.bucketlists')
+        self.add_bucketlists(3)
+        full = self.record_queries(url)
+        sparse = self.record_queries(url, query_string={'fields': 'id,name'})
+        self.assertEqual(len(sparse), len(full) - 2)
+        for statement in sparse:
+            self.assertFalse('bucketitem.name' in statement)
+            self.assertFalse('bucketlist.creator_id AS' in statement)
+            self.assertFalse('"user"' in statement)
+
+    def test_users_without_items_skip_items(self):
+        # test users embed their bucketlists without querying items
+        url = url_for('api_1.get_users')
+        self.add_bucketlists(3)
+        statements = self.record_queries(
+            url, query_string={'include_items': 'false'})
+        self.assertTrue(
+            any('FROM bucketlist' in statement for statement in statements))
+        self.assertFalse(
+            any('bucketitem' in statement for statement in statements))
+        statements = self.record_queries(
+            url, query_string={'fields': 'username'})
+        self.assertFalse(
+            any('bucketlist' in statement for statement in statements))
+
+    def test_bulk_to_json_matches_to_json(self):
+        # test bulk serialization returns the same output as to_json
+        self.add_bucketlists(3)
+        bucketlists = BucketList.query.order_by(BucketList.id).all()
+        with self.app.test_request_context():
+            self.assertEqual(
+                BucketList.bulk_to_json(bucketlists),
+                [bucketlist.to_json() for bucketlist in bucketlists])
+            self.assertEqual(
+                len(User.query.first().to_json()['bucketlists']), 3)
+
+    def test_cached_token_costs_no_queries(self):
+        # test authenticating with a verified token skips the database
+        url = url_for('api_1.logout')
+        self.assertEqual(self.count_queries(url, method='post'), 0)
@@ -0,0 +1,38 @@
+'''
+Test file to keep the api_1 queries on indexes
+'''
+import os
+import tempfile
+import unittest
+
+import benchmark
+
+
+# (route, table) pairs whose full scan is the point of the route
+EXPECTED_SCANS = set([
+    ('get_users', 'user'),  # lists every user
+])
+
+
+class TestQueryPlans(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_no_full_table_scans(self):
+        # test no statement of the seeded benchmark reads a whole table
+        plans = benchmark.query_plans(database='sqlite:///' + self.path)
+        # statements are kept for the first route sending them
+        routes = set(plan['route'] for plan in plans)
+        for route in ('get_user', 'list_bucketlists', 'get_bucketlist',
+                      'list_items', 'filter_items', 'delete_bucketlist'):
+            self.assertTrue(route in routes, route)
+        unexpected = [
+            plan for plan in plans
+            if set((plan['route'], table) for table in plan['full_scans'])
+            - EXPECTED_SCANS]
+        self.assertEqual(unexpected, [], benchmark.plans_report(unexpected))
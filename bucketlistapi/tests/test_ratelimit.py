@@ -0,0 +1,174 @@
+'''
+Test file to test rate limiting
+'''
+import json
+import unittest
+from base64 import b64encode
+
+from flask import g, url_for
+from werkzeug.contrib.cache import SimpleCache
+
+from app import create_app, db, password_hasher, rate_limiter
+from app.models import User
+from app.ratelimit import CacheBuckets, MemoryBuckets, parse_limit, take
+from app.unit_of_work import transaction
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_parse_limit(self):
+        # test limits parse to tokens per second and burst
+        self.assertEqual(parse_limit('10/minute'), (10 / 60.0, 10))
+        self.assertEqual(parse_limit('2/second'), (2.0, 2))
+        for limit in ('10', '0/minute', 'ten/minute', '10/fortnight'):
+            self.assertRaises(ValueError, parse_limit, limit)
+
+    def test_take_and_refill(self):
+        # test a bucket empties after its burst and refills at its rate
+        state = None
+        for now in (0, 0, 0):
+            state, wait = take(state, 1.0, 3, now)
+            self.assertEqual(wait, 0)
+        state, wait = take(state, 1.0, 3, 0.25)
+        self.assertAlmostEqual(wait, 0.75)
+        state, wait = take(state, 1.0, 3, 1.0)
+        self.assertEqual(wait, 0)
+        # never beyond the burst, however long it was left alone
+        state, wait = take(state, 1.0, 3, 100)
+        self.assertEqual(state[0], 2)
+
+    def test_memory_buckets(self):
+        # test keys have buckets of their own and old ones are dropped
+        buckets = MemoryBuckets(maxsize=2)
+        self.assertEqual(buckets.take('a', 0.001, 1), 0)
+        self.assertTrue(buckets.take('a', 0.001, 1) > 0)
+        self.assertEqual(buckets.take('b', 0.001, 1), 0)
+        self.assertEqual(buckets.take('c', 0.001, 1), 0)
+        self.assertEqual(len(buckets._buckets), 2)
+        self.assertEqual(buckets.take('a', 0.001, 1), 0)
+
+    def test_cache_buckets(self):
+        # test buckets in a shared cache are seen by every process
+        cache = SimpleCache()
+        first, second = CacheBuckets(cache), CacheBuckets(cache)
+        self.assertEqual(first.take('a', 0.001, 1), 0)
+        self.assertTrue(second.take('a', 0.001, 1) > 0)
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['RATELIMIT_ENABLED'] = True
+        self.app.config['RATELIMITS'] = {
+            'api_1.login': '2/minute',
+            'POST api_1.bucketlists': '1/minute',
+        }
+        self.app.config['RATELIMIT_DEFAULT'] = None
+        self.app.config['RATELIMIT_PASSWORD_CHECKS'] = '3/minute'
+        rate_limiter.init_app(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        with transaction():
+            for username in ('lade', 'dave'):
+                user = User(username=username)
+                user.hash_password('password')
+                user.save()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get_api_headers(self, username, password='password'):
+        return {
+            'Authorization': 'Basic ' + b64encode(
+                (username + ':' + password).encode('utf-8')).decode('utf-8'),
+            'Content-Type': 'application/json'
+        }
+
+    def login(self):
+        response = self.client.post(
+            url_for('api_1.login'), headers=self.get_api_headers('lade'),
+            data=json.dumps({'username': 'lade', 'password': 'password'}))
+        # requests share the test's g, where login leaves the user
+        if hasattr(g, 'user'):
+            del g.user
+        return response
+
+    def test_login_limited(self):
+        # test logging in too often is refused with a Retry-After
+        for n in range(2):
+            self.assertEqual(self.login().status_code, 200)
+        response = self.login()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(json.loads(response.data)['error'],
+                         'Too Many Requests')
+        retry_after = int(response.headers['Retry-After'])
+        self.assertTrue(0 < retry_after <= 30)
+
+    def test_disabled(self):
+        # test nothing is limited with RATELIMIT_ENABLED off
+        self.app.config['RATELIMIT_ENABLED'] = False
+        for n in range(3):
+            self.assertEqual(self.login().status_code, 200)
+
+    def test_limits_per_user_and_method(self):
+        # test a user's writes are limited without affecting other users
+        # or other methods of the endpoint
+        def create(username, name):
+            return self.client.post(
+                url_for('api_1.bucketlists'),
+                headers=self.get_api_headers(username),
+                data=json.dumps({'name': name})).status_code
+
+        self.assertEqual(create('lade', 'first'), 200)
+        self.assertEqual(create('lade', 'second'), 429)
+        self.assertEqual(create('dave', 'third'), 200)
+        response = self.client.get(
+            url_for('api_1.bucketlists'), headers=self.get_api_headers('lade'))
+        self.assertEqual(response.status_code, 200)
+        # the refused request changed nothing
+        self.assertEqual(
+            len(json.loads(response.data)['bucketlists']), 1)
+
+    def test_password_guesses_limited(self):
+        # test wrong passwords sent to any protected endpoint are limited
+        # per username and address before they reach the hash
+        verify = password_hasher.verify
+        hashes = []
+
+        def counting_verify(password, password_hash):
+            hashes.append(password)
+            return verify(password, password_hash)
+        password_hasher.verify = counting_verify
+
+        def get(password, address='10.0.0.1', username='lade'):
+            response = self.client.get(
+                url_for('api_1.bucketlists'),
+                headers=self.get_api_headers(username, password),
+                environ_base={'REMOTE_ADDR': address})
+            if hasattr(g, 'user'):
+                del g.user
+            return response
+
+        try:
+            statuses = [get('guess %d' % n).status_code for n in range(30)]
+            self.assertEqual(statuses, [401] * 3 + [429] * 27)
+            self.assertEqual(len(hashes), 3)
+            self.assertTrue(int(get('password').headers['Retry-After']) > 0)
+
+            # other addresses, other users of the same address, and clients
+            # whose credentials are cached, are not affected
+            for n in range(5):
+                self.assertEqual(
+                    get('password', '10.0.0.2').status_code, 200)
+            self.assertEqual(len(hashes), 4)
+            self.assertEqual(get('password', username='dave').status_code,
+                             200)
+            self.assertEqual(len(hashes), 5)
+        finally:
+            password_hasher.verify = verify
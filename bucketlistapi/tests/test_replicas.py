@@ -0,0 +1,138 @@
+'''
+Test file to test reads routed to a replica
+'''
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from base64 import b64encode
+
+from flask import url_for, g
+
+from app import create_app, db
+from app.models import User, BucketList
+from app.replicas import replica_router
+from app.unit_of_work import transaction
+
+
+class TestReplicas(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.directory = tempfile.mkdtemp()
+        self.app.config['SQLALCHEMY_REPLICAS'] = [
+            'sqlite:///' + os.path.join(self.directory, 'replica.sqlite')]
+        replica_router.init_app(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        with transaction():
+            for username in ('lade', 'dave'):
+                user = User(username=username)
+                user.hash_password('password')
+                user.save()
+            g.user = User.query.filter_by(username='lade').first()
+            bucketlist = BucketList(name='on the primary')
+            bucketlist.create()
+            bucketlist.save()
+        del g.user
+
+        # the replica has the users, and has not seen the bucketlist yet
+        self.replica = db.get_engine(self.app, bind='replica-0')
+        db.metadata.create_all(self.replica)
+        with self.replica.begin() as connection:
+            connection.execute(User.__table__.insert(), [
+                dict(row) for row in db.session.execute(
+                    User.__table__.select()).fetchall()])
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.replica.dispose()
+        shutil.rmtree(self.directory)
+
+    def get_api_headers(self, username):
+        return {
+            'Authorization': 'Basic ' + b64encode(
+                (username + ':password').encode('utf-8')).decode('utf-8'),
+            'Content-Type': 'application/json'
+        }
+
+    def request(self, method, url, username='lade', data=None):
+        response = getattr(self.client, method)(
+            url, headers=self.get_api_headers(username),
+            data=json.dumps(data) if data is not None else None)
+        # requests share the test's g, where authentication leaves the user
+        if hasattr(g, 'user'):
+            del g.user
+        return response
+
+    def bucketlist_names(self, username='lade'):
+        response = self.request('get', url_for('api_1.bucketlists'), username)
+        self.assertEqual(response.status_code, 200)
+        return [bucketlist['name'] for bucketlist in
+                json.loads(response.data)['bucketlists']]
+
+    def test_reads_from_replica(self):
+        # test GET requests read from the replica
+        self.assertEqual(self.bucketlist_names(), [])
+
+    def test_reads_own_writes(self):
+        # test writes go to the primary, and their user reads from it for a
+        # while after
+        response = self.request('post', url_for('api_1.bucketlists'),
+                                data={'name': 'new'})
+        self.assertEqual(response.status_code, 200)
+        with self.replica.connect() as connection:
+            self.assertEqual(connection.execute(
+                BucketList.__table__.select()).fetchall(), [])
+        self.assertEqual(self.bucketlist_names(),
+                         ['on the primary', 'new'])
+
+        # other users still read from the replica
+        self.assertEqual(self.bucketlist_names('dave'), [])
+
+        # until the marks expire
+        self.app.extensions['replicas'][1].clear()
+        self.assertEqual(self.bucketlist_names(), [])
+
+    def test_failed_writes_do_not_stick(self):
+        # test requests that wrote nothing leave their user on the replica
+        response = self.request('post', url_for('api_1.bucketlists'),
+                                data={'name': ''})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.bucketlist_names(), [])
+
+    def test_health_db(self):
+        # test the health check reports every replica, and fails with one
+        response = self.client.get(url_for('api_1.health_db'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(replica['replica'], replica['status']) for replica in
+             json.loads(response.data)['replicas']], [('replica-0', 'ok')])
+
+        binds = self.app.config['SQLALCHEMY_BINDS']
+        uri = binds['replica-0']
+        binds['replica-0'] = 'sqlite:///' + os.path.join(
+            self.directory, 'gone', 'replica.sqlite')
+        try:
+            response = self.client.get(url_for('api_1.health_db'))
+        finally:
+            binds['replica-0'] = uri
+        self.assertEqual(response.status_code, 503)
+        data = json.loads(response.data)
+        self.assertEqual(data['status'], 'unavailable')
+        self.assertEqual(data['replicas'][0]['status'], 'unavailable')
+
+    def test_registered_user_logs_in(self):
+        # test a user registered on the primary can authenticate right
+        # away, the address that registered reads from the primary
+        response = self.client.post(
+            url_for('api_1.new_user'), headers=self.get_api_headers('lade'),
+            data=json.dumps({'username': 'new', 'password': 'password'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.bucketlist_names('new'), [])
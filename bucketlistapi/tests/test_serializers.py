@@ -0,0 +1,68 @@
+'''
+Test file to test json serialization of responses
+'''
+import json
+import unittest
+from datetime import datetime
+
+from werkzeug.http import http_date as werkzeug_http_date
+
+from app import create_app
+from app import serializers
+from app.serializers import dumps, http_date, jsonify
+
+
+class TestSerializers(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_http_date(self):
+        # test dates are formatted exactly like werkzeug formats them
+        for value in (datetime(2015, 10, 24, 16, 17, 25),
+                      datetime(2016, 2, 29, 0, 0, 0, 999999),
+                      datetime(1999, 12, 31, 23, 59, 59),
+                      datetime.now()):
+            self.assertEqual(http_date(value), werkzeug_http_date(value))
+        self.assertEqual(http_date(None), None)
+
+    def test_dumps_is_compact(self):
+        # test responses carry no whitespace and datetimes are http dates
+        body = dumps({'a': [1, 2], 'date': datetime(2015, 10, 24, 16, 17)})
+        self.assertEqual(
+            body, b'{"a":[1,2],"date":"Sat, 24 Oct 2015 16:17:00 GMT"}')
+
+    def test_jsonify(self):
+        # test jsonify returns a json response of its arguments
+        response = jsonify({'name': u'caf\xe9'}, done=True)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(
+            json.loads(response.get_data(as_text=True)),
+            {'name': u'caf\xe9', 'done': True})
+
+    @unittest.skipIf(serializers.orjson is None, 'orjson is not installed')
+    def test_orjson_matches_stdlib(self):
+        # test both encoders produce the same document
+        obj = {'bucketlists': [{
+            'id': 1, 'name': u'caf\xe9', 'done': False, 'items': [],
+            'date_created': datetime(2015, 10, 24, 16, 17, 25)}]}
+        self.assertEqual(
+            json.loads(serializers.orjson_dumps(obj).decode('utf-8')),
+            json.loads(serializers.stdlib_dumps(obj).decode('utf-8')))
+
+    def test_unavailable_backend(self):
+        # test asking for orjson without it installed fails loudly
+        orjson = serializers.orjson
+        serializers.orjson = None
+        try:
+            app = create_app('testing')
+            app.config['JSON_SERIALIZER'] = 'orjson'
+            self.assertRaises(RuntimeError,
+                              serializers.JSONSerializer, app)
+        finally:
+            serializers.orjson = orjson
@@ -0,0 +1,345 @@
+'''
+Test file to test bucketlists partitioned over shards by user
+'''
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from base64 import b64encode
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from flask import url_for, g
+from sqlalchemy import func, select
+
+from app import bulk, create_app, db, job_runner, rebalance
+from app.models import User, BucketList, BucketItem, IdSequence, Job
+from app.rebalance import loads, plan, move_user, sync, UserBusy
+from app.shards import shard_router, shard_tables
+from app.unit_of_work import transaction
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.directory = tempfile.mkdtemp()
+        self.app.config['SHARDS'] = [
+            'sqlite:///' + os.path.join(self.directory, 'shard-%d.sqlite' % n)
+            for n in range(2)]
+        self.app.config['SHARD_MOVE_GRACE'] = 0
+        shard_router.init_app(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        shard_router.create_all()
+        # users are committed before anything reserves ids, which SQLite
+        # would otherwise lock out
+        with transaction():
+            for username, shard in (('lade', 0), ('dave', 1), ('old', None)):
+                user = User(username=username, shard=shard)
+                user.hash_password('password')
+                user.save()
+            # created before sharding
+            db.session.execute(User.__table__.update().where(
+                User.username == 'old').values(shard=None))
+        self.users = dict(db.session.query(User.username, User.id))
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        rebalance.time = time
+        rebalance.sync = sync
+        db.session.remove()
+        shard_router.drop_all()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def get_api_headers(self, username):
+        return {
+            'Authorization': 'Basic ' + b64encode(
+                (username + ':password').encode('utf-8')).decode('utf-8'),
+            'Content-Type': 'application/json'
+        }
+
+    def request(self, method, url, username='lade', data=None):
+        response = getattr(self.client, method)(
+            url, headers=self.get_api_headers(username),
+            data=json.dumps(data) if data is not None else None)
+        # requests share the test's g, where authentication leaves the user
+        if hasattr(g, 'user'):
+            del g.user
+        self.assertTrue(response.status_code < 300)
+        return json.loads(response.data)
+
+    def create(self, username, name, items=()):
+        bucketlist = self.request(
+            'post', url_for('api_1.bucketlists'), username,
+            {'name': name})['bucketlist']
+        for item in items:
+            self.request('post', url_for(
+                'api_1.add_bucketitem', bucketlist_id=bucketlist['id']),
+                username, {'name': item})
+        return bucketlist['id']
+
+    def names(self, username):
+        return [bucketlist['name'] for bucketlist in self.request(
+            'get', url_for('api_1.bucketlists'), username)['bucketlists']]
+
+    def rows(self, shard, table=BucketList.__table__):
+        return shard_router.engine(shard).execute(
+            select([func.count()]).select_from(table)).scalar()
+
+    def test_routing(self):
+        # test bucketlists and items are written to and read from the shard
+        # of their user, with ids unique over every shard
+        ids = [self.create('lade', 'first', ['a', 'b']),
+               self.create('dave', 'second', ['c'])]
+        self.assertEqual(len(set(ids)), 2)
+        self.assertEqual([self.rows(shard) for shard in (None, 0, 1)],
+                         [0, 1, 1])
+        self.assertEqual(
+            [self.rows(shard, BucketItem.__table__)
+             for shard in (None, 0, 1)], [0, 2, 1])
+        self.assertEqual(self.names('lade'), ['first'])
+        self.assertEqual(self.names('dave'), ['second'])
+
+        # batches take their ids from the same sequence
+        items = self.request('post', url_for(
+            'api_1.bucketitems_batch', bucketlist_id=ids[1]), 'dave',
+            [{'name': 'd'}, {'name': 'e'}])['items']
+        item_ids = [result['item']['id'] for result in items]
+        with shard_router.using(1):
+            self.assertEqual(sorted(item_ids), sorted(
+                item_id for item_id, in db.session.query(BucketItem.id).filter(
+                    BucketItem.name.in_(['d', 'e']))))
+
+    def test_new_users_get_a_shard(self):
+        # test registered users are placed on a shard
+        self.client.post(
+            url_for('api_1.new_user'), headers=self.get_api_headers('lade'),
+            data=json.dumps({'username': 'new', 'password': 'password'}))
+        self.assertIn(User.query.filter_by(username='new').first().shard,
+                      [0, 1])
+
+    def test_get_users(self):
+        # test users list the bucketlists of every shard
+        self.create('lade', 'first')
+        self.create('dave', 'second')
+        with shard_router.using(None):
+            with transaction():
+                db.session.add(BucketList(
+                    name='legacy', creator_id=self.users['old']))
+        users = self.request('get', url_for('api_1.get_users'))['users']
+        self.assertEqual(
+            dict((user['user']['username'],
+                  [bucketlist['name'] for bucketlist in
+                   user['user']['bucketlists']]) for user in users),
+            {'lade': ['first'], 'dave': ['second'], 'old': ['legacy']})
+
+    def test_jobs(self):
+        # test jobs run on the shard of their creator
+        with transaction():
+            job_runner.enqueue(
+                'import_bucketlists', self.users['dave'], bucketlists=[
+                    {'name': 'imported', 'items': [
+                        {'name': 'x', 'done': True}]}])
+        job_runner.run_pending()
+        self.assertEqual([self.rows(shard) for shard in (None, 0, 1)],
+                         [0, 0, 1])
+        self.assertEqual(self.names('dave'), ['imported'])
+
+    def test_move_user(self):
+        # test a moved user keeps their bucketlists, items and ids
+        bucketlist_id = self.create('lade', 'first', ['a', 'b'])
+        self.assertEqual(move_user(self.users['lade'], 1), (1, 2))
+        self.assertEqual([self.rows(shard) for shard in (0, 1)], [0, 1])
+        self.assertEqual(
+            [self.rows(shard, BucketItem.__table__) for shard in (0, 1)],
+            [0, 2])
+        bucketlist = self.request('get', url_for(
+            'api_1.bucketlist', bucketlist_id=bucketlist_id))['bucketlist']
+        self.assertEqual(sorted(item['name'] for item in bucketlist['items']),
+                         ['a', 'b'])
+
+    def test_writes_during_move(self):
+        # test writes are refused while a user is moved, and those made
+        # before or after are all on the new shard
+        bucketlist_id = self.create('lade', 'first', ['a'])
+        test = self
+
+        class Clock(object):
+            # the grace period is when writes reach the moving user
+            def sleep(self, seconds):
+                response = test.client.post(
+                    url_for('api_1.bucketlists'),
+                    headers=test.get_api_headers('lade'),
+                    data=json.dumps({'name': 'refused'}))
+                del g.user
+                test.assertEqual(response.status_code, 503)
+                test.assertEqual(response.headers['Retry-After'], '5')
+                # reads go on
+                test.assertEqual(test.names('lade'), ['first'])
+                # a request let through just before is still writing
+                with shard_router.using(0):
+                    with transaction():
+                        db.session.add(BucketList(
+                            name='late', creator_id=test.users['lade']))
+
+        rebalance.time = Clock()
+        self.assertEqual(move_user(self.users['lade'], 1), (2, 1))
+        self.assertFalse(shard_router.moving(self.users['lade']))
+        # written right after the switch
+        self.request('put', url_for(
+            'api_1.bucketlist', bucketlist_id=bucketlist_id), 'lade',
+            {'name': 'renamed'})
+        self.create('lade', 'after')
+        self.assertEqual([self.rows(shard) for shard in (0, 1)], [0, 3])
+        self.assertEqual(sorted(self.names('lade')),
+                         ['after', 'late', 'renamed'])
+
+    def test_deletes_during_move(self):
+        # test what the user deletes after the first copy is deleted from
+        # the new shard too
+        first_id = self.create('lade', 'first', ['a'])
+        second_id = self.create('lade', 'second', ['b', 'c'])
+        with shard_router.using(0):
+            item_id = BucketItem.query.filter_by(name='a').first().id
+        test = self
+
+        def first_copy(*args, **kwargs):
+            moved = sync(*args, **kwargs)
+            if kwargs.get('replace'):
+                for url in (url_for(
+                        'api_1.bucketlist', bucketlist_id=second_id),
+                        url_for('api_1.bucketitem', bucketlist_id=first_id,
+                                bucketitem_id=item_id)):
+                    response = test.client.delete(
+                        url, headers=test.get_api_headers('lade'))
+                    del g.user
+                    test.assertEqual(response.status_code, 200)
+            return moved
+
+        rebalance.sync = first_copy
+        self.assertEqual(move_user(self.users['lade'], 1), (1, 0))
+        self.assertEqual(self.names('lade'), ['first'])
+        self.assertEqual(
+            [self.rows(shard, BucketItem.__table__) for shard in (0, 1)],
+            [0, 0])
+
+    def test_jobs_wait_for_move(self):
+        # test jobs of a moving user stay queued, and a running job stops
+        # the move
+        engine = shard_router.engine(None)
+        engine.execute(User.__table__.update().where(
+            User.id == self.users['dave']).values(moving=True))
+        with transaction():
+            job_id = job_runner.enqueue(
+                'import_bucketlists', self.users['dave'],
+                bucketlists=[{'name': 'imported', 'items': []}]).id
+        self.assertEqual(job_runner.run_next(), None)
+        self.assertEqual(Job.query.get(job_id).state, 'queued')
+
+        engine.execute(User.__table__.update().where(
+            User.id == self.users['dave']).values(moving=None))
+        self.create('dave', 'second')
+        self.assertEqual(job_runner.queue.claim().id, job_id)
+        self.assertRaises(UserBusy, move_user, self.users['dave'], 0)
+        self.assertFalse(shard_router.moving(self.users['dave']))
+        self.assertEqual(User.query.get(self.users['dave']).shard, 1)
+        self.assertEqual(self.names('dave'), ['second'])
+
+    def test_sync_keeps_newer_rows(self):
+        # test syncing leaves the target rows newer than the source's or
+        # missing in it alone
+        bucketlist_id = self.create('lade', 'first')
+        old, new = shard_router.engine(0), shard_router.engine(1)
+        sync(old, new, self.users['lade'])
+        table = BucketList.__table__
+        new.execute(table.update().where(table.c.id == bucketlist_id).values(
+            name='newer', date_modified=datetime.now() + timedelta(hours=1)))
+        new.execute(table.insert().values(
+            id=bucketlist_id + 100, name='only',
+            creator_id=self.users['lade']))
+        sync(old, new, self.users['lade'])
+        self.assertEqual(
+            sorted(name for name, in new.execute(
+                select([table.c.name])).fetchall()),
+            ['newer', 'only'])
+
+    def test_export_import(self):
+        # test dumps hold every shard and load back onto the same shards
+        self.create('lade', 'first', ['a', 'b'])
+        self.create('dave', 'second', ['c'])
+        path = os.path.join(self.directory, 'dump.ndjson')
+        bulk.dump(db.engine, path, shards=[
+            shard_router.engine(shard) for shard in (0, 1)])
+        engines = dict(
+            (shard, sqlalchemy.create_engine('sqlite:///' + os.path.join(
+                self.directory, 'target-%s.sqlite' % shard)))
+            for shard in (None, 0, 1))
+        db.metadata.create_all(engines[None])
+        for shard in (0, 1):
+            shard_tables()[0].create_all(engines[shard])
+        timer = bulk.load(engines[None], path, shards={
+            0: engines[0], 1: engines[1]})
+        self.assertEqual([(name, rows) for name, rows, _ in timer.tables],
+                         [('user', 3), ('bucketlist', 2), ('bucketitem', 3)])
+
+        def count(engine, table):
+            return engine.execute(
+                select([func.count()]).select_from(table)).scalar()
+        self.assertEqual(
+            [(count(engines[shard], BucketList.__table__),
+              count(engines[shard], BucketItem.__table__))
+             for shard in (None, 0, 1)], [(0, 0), (1, 2), (1, 1)])
+        sequence = IdSequence.__table__
+        self.assertEqual(
+            dict(engines[None].execute(select(
+                [sequence.c.name, sequence.c.next_id])).fetchall()),
+            {'bucketlist': 3, 'bucketitem': 4})
+        for engine in engines.values():
+            engine.dispose()
+
+    def test_health_db(self):
+        # test the health check reports every shard
+        response = self.client.get(url_for('api_1.health_db'))
+        self.assertEqual(response.status_code, 200)
+        shards = json.loads(response.data)['shards']
+        self.assertEqual([(shard['shard'], shard['status'])
+                          for shard in shards], [(0, 'ok'), (1, 'ok')])
+
+    def test_rebalance(self):
+        # test users on the primary are moved to the lightest shard
+        self.create('lade', 'first', ['a', 'b', 'c'])
+        with shard_router.using(None):
+            with transaction():
+                db.session.add(BucketList(
+                    name='legacy', creator_id=self.users['old']))
+        weights, shards = loads()
+        self.assertEqual(weights, {
+            self.users['lade']: 4, self.users['dave']: 0,
+            self.users['old']: 1})
+        moves = plan(weights, shards)
+        self.assertEqual(moves, [(self.users['old'], None, 1, 1)])
+        for user_id, source, target, weight in moves:
+            move_user(user_id, target)
+        self.assertEqual([self.rows(shard) for shard in (None, 0, 1)],
+                         [0, 1, 1])
+        self.assertEqual(self.names('old'), ['legacy'])
+
+    def test_plan(self):
+        # test moves even out the shards
+        weights = {1: 10, 2: 6, 3: 4, 4: 1}
+        moves = plan(weights, {1: 0, 2: 0, 3: 0, 4: None})
+        totals = {0: 0, 1: 0}
+        shards = {1: 0, 2: 0, 3: 0, 4: None}
+        for user_id, source, target, weight in moves:
+            self.assertEqual(shards[user_id], source)
+            shards[user_id] = target
+        for user_id, shard in shards.items():
+            totals[shard] += weights[user_id]
+        self.assertEqual(sorted(totals.values()), [10, 11])
@@ -0,0 +1,111 @@
+'''
+Test file to check every request commits exactly once
+'''
+import json
+import unittest
+from base64 import b64encode
+
+from flask import url_for, g
+from sqlalchemy import event
+
+from app import create_app, db
+from app.models import User, BucketList, BucketItem
+from app.unit_of_work import transaction
+
+
+class TestUnitOfWork(unittest.TestCase):
+    default_username = 'lade'
+    default_password = 'password'
+    default_bucketlist = 'This is a default bucketlist'
+    default_bucketlistitem = 'This is a default bucketlist item'
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        with transaction():
+            u = User(username=self.default_username)
+            u.hash_password(self.default_password)
+            u.save()
+            g.user = u
+            bucketlist = BucketList(name=self.default_bucketlist)
+            bucketlist.create()
+            bucketlist.save()
+            item = BucketItem(
+                name=self.default_bucketlistitem, bucketlist_id=bucketlist.id
+            )
+            item.create()
+            item.save()
+        self.client = self.app.test_client()
+        self.headers = self.get_api_headers('lade', 'password')
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get_api_headers(self, username, password):
+        return {
+            'Authorization':
+                'Basic ' + b64encode(
+                    (username + ':' + password).encode('utf-8')).decode('utf-8'),
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'
+        }
+
+    def count_commits(self, method, url, data=None):
+        # returns the number of database commits made while serving url
+        commits = []
+
+        def record(conn):
+            commits.append(conn)
+
+        event.listen(db.engine, 'commit', record)
+        try:
+            response = getattr(self.client, method)(
+                url, headers=self.headers,
+                data=json.dumps(data) if data is not None else None)
+        finally:
+            event.remove(db.engine, 'commit', record)
+        self.assertTrue(response.status_code < 400)
+        return len(commits)
+
+    def test_create_bucketlist_commits_once(self):
+        self.assertEqual(self.count_commits(
+            'post', url_for('api_1.bucketlists'), {'name': 'new list'}), 1)
+
+    def test_rename_bucketlist_commits_once(self):
+        self.assertEqual(self.count_commits(
+            'put', url_for('api_1.bucketlist', bucketlist_id=1),
+            {'name': 'renamed list'}), 1)
+
+    def test_delete_bucketlist_commits_once(self):
+        self.assertEqual(self.count_commits(
+            'delete', url_for('api_1.bucketlist', bucketlist_id=1)), 1)
+
+    def test_bucketitem_endpoints_commit_once(self):
+        self.assertEqual(self.count_commits(
+            'post', url_for('api_1.add_bucketitem', bucketlist_id=1),
+            {'name': 'new item'}), 1)
+        self.assertEqual(self.count_commits(
+            'put', url_for('api_1.bucketitem',
+                           bucketlist_id=1, bucketitem_id=1),
+            {'done': True}), 1)
+        self.assertEqual(self.count_commits(
+            'delete', url_for('api_1.bucketitem',
+                              bucketlist_id=1, bucketitem_id=1)), 1)
+
+    def test_batch_commits_once(self):
+        self.assertEqual(self.count_commits(
+            'post', url_for('api_1.bucketitems_batch', bucketlist_id=1),
+            [{'name': 'batch item %d' % number} for number in range(10)]), 1)
+
+    def test_transaction_rolls_back_on_error(self):
+        # test a failing transaction discards everything it flushed
+        with self.assertRaises(ValueError):
+            with transaction():
+                BucketList(name='never committed').save()
+                raise ValueError('abort')
+        self.assertEqual(BucketList.query.count(), 1)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''
+Test file to check cached URL templates build the URLs url_for builds
+'''
+import unittest
+
+from flask import url_for
+
+from app import create_app, url_templates
+from app.urls import URLFor, URLTemplate
+
+
+class TestURLTemplates(unittest.TestCase):
+    usernames = [
+        'lade', 'with space', u'caf\xe9', 'slash/name', 'per%cent',
+        'q?x=1&y#frag', '7919000000', 'urltemplate0x', '',
+    ]
+
+    def setUp(self):
+        self.app = create_app('testing')
+        # urls follow the host of each request
+        self.app.config['SERVER_NAME'] = None
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def assertSameURLs(self, endpoint, values):
+        expected = url_for(endpoint, _external=True, **values)
+        self.assertEqual(url_templates.url_for(endpoint, **values), expected)
+        self.assertEqual(type(url_templates.url_for(endpoint, **values)),
+                         type(expected))
+
+    def test_same_as_url_for(self):
+        # test templated urls are identical to url_for for every host
+        for base_url in ('http://localhost/', 'https://example.com:8443/',
+                         'http://example.com/mounted/app/'):
+            with self.app.test_request_context(base_url=base_url):
+                for bucketlist_id in (0, 1, 42, 7919000000, 10 ** 12):
+                    self.assertSameURLs(
+                        'api_1.bucketlist', {'bucketlist_id': bucketlist_id})
+                for username in self.usernames:
+                    self.assertSameURLs(
+                        'api_1.get_user', {'username': username})
+                for page in (1, 2, 100):
+                    self.assertSameURLs('api_1.bucketlists', {'page': page})
+                self.assertSameURLs('api_1.bucketlists', {
+                    'cursor': 'eyJpZCI6IDF9-_', 'limit': 20,
+                    'q': u'run a marath\xf3n & more'})
+                self.assertSameURLs('api_1.bucketlists', {
+                    'cursor': 'eyJpZCI6IDF9', 'limit': 20, 'q': None})
+
+    def test_templates_are_cached_per_host(self):
+        # test a template is built once per endpoint and host
+        with self.app.test_request_context(base_url='http://one.com/'):
+            template = url_templates.get('api_1.bucketlist', 'bucketlist_id')
+            self.assertTrue(isinstance(template, URLTemplate))
+            self.assertTrue(template is url_templates.get(
+                'api_1.bucketlist', 'bucketlist_id'))
+            self.assertEqual(template.build(bucketlist_id=3),
+                             'http://one.com/api/v1/bucketlists/3/')
+        with self.app.test_request_context(base_url='http://two.com/'):
+            template = url_templates.get('api_1.bucketlist', 'bucketlist_id')
+            self.assertEqual(template.build(bucketlist_id=3),
+                             'http://two.com/api/v1/bucketlists/3/')
+
+    def test_templates_are_bounded(self):
+        # test made up hosts cannot grow the cache past its size
+        self.app.config['URL_TEMPLATES_SIZE'] = 8
+        url_templates.init_app(self.app)
+        for n in range(50):
+            base_url = 'http://host%d.example.com/' % n
+            with self.app.test_request_context(base_url=base_url):
+                self.assertSameURLs('api_1.bucketlist', {'bucketlist_id': n})
+        self.assertEqual(len(self.app.extensions['url_templates']), 8)
+
+    def test_falls_back_to_url_for(self):
+        # test a host containing a placeholder is not templated
+        with self.app.test_request_context(
+                base_url='http://7919000000.example.com/'):
+            template = url_templates.get('api_1.bucketlist', 'bucketlist_id')
+            self.assertTrue(isinstance(template, URLFor))
+            self.assertSameURLs('api_1.bucketlist', {'bucketlist_id': 5})
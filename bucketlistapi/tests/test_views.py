@@ -9,6 +9,7 @@ from flask import url_for, g
 
 from app import create_app, db
 from app.models import User, BucketList, BucketItem
+from app.unit_of_work import transaction
 
 
 class TestAPI(unittest.TestCase):
@@ -24,21 +25,22 @@ class TestAPI(unittest.TestCase):
         self.app_context.push()
         db.drop_all()
         db.create_all()
-        u = User(username=self.default_username)
-        u.hash_password(self.default_password)
-        u.save()
-        g.user = u
-        new_u = User(username=self.new_user)
-        new_u.hash_password(self.default_password)
-        new_u.save()
-        bucketlist = BucketList(name=self.default_bucketlist)
-        bucketlist.create()
-        bucketlist.save()
-        item = BucketItem(
-            name=self.default_bucketlistitem, bucketlist_id=bucketlist.id
-        )
-        item.create()
-        item.save()
+        with transaction():
+            u = User(username=self.default_username)
+            u.hash_password(self.default_password)
+            u.save()
+            g.user = u
+            new_u = User(username=self.new_user)
+            new_u.hash_password(self.default_password)
+            new_u.save()
+            bucketlist = BucketList(name=self.default_bucketlist)
+            bucketlist.create()
+            bucketlist.save()
+            item = BucketItem(
+                name=self.default_bucketlistitem, bucketlist_id=bucketlist.id
+            )
+            item.create()
+            item.save()
         self.client = self.app.test_client()
 
     def tearDown(self):
@@ -72,6 +74,29 @@ class TestAPI(unittest.TestCase):
             headers=self.get_api_headers(token, 'password'))
         self.assertTrue(response.status_code == 200)
 
+    def test_get_users_ndjson(self):
+        # test stream all users as newline delimited json
+        token = self.get_token()
+        response = self.client.get(
+            url_for('api_1.get_users'),
+            headers=self.get_api_headers(token, 'password'),
+            query_string={'format': 'ndjson'})
+        self.assertTrue(response.status_code == 200)
+        lines = response.data.decode('utf-8').splitlines()
+        users = [json.loads(line)['user']['username'] for line in lines]
+        self.assertEqual(users, ['lade', 'dave'])
+
+    def test_export_bucketlists(self):
+        # test stream every bucketlist of the user
+        token = self.get_token()
+        response = self.client.get(
+            url_for('api_1.export_bucketlists'),
+            headers=self.get_api_headers(token, 'password'))
+        self.assertTrue(response.status_code == 200)
+        bucketlists = json.loads(response.data)['bucketlists']
+        self.assertEqual(len(bucketlists), 1)
+        self.assertEqual(len(bucketlists[0]['items']), 1)
+
     def test_get_user(self):
         # test return a user
         token = self.get_token()
@@ -112,6 +137,103 @@ class TestAPI(unittest.TestCase):
             headers=self.get_api_headers(token, 'password'))
         self.assertTrue(response.status_code == 200)
 
+    def test_get_bucketlists_with_cursor(self):
+        # test walking bucketlists page by page with a cursor
+        token = self.get_token()
+        for number in range(4):
+            self.client.post(
+                url_for('api_1.bucketlists'),
+                headers=self.get_api_headers(token, 'password'),
+                data=json.dumps({'name': 'cursor bucketlist %d' % number}))
+        names = []
+        cursor = ''
+        while cursor is not None:
+            response = self.client.get(
+                url_for('api_1.bucketlists'),
+                headers=self.get_api_headers(token, 'password'),
+                query_string={'cursor': cursor, 'limit': 2})
+            self.assertTrue(response.status_code == 200)
+            data = json.loads(response.data)
+            self.assertFalse('count' in data)
+            names.extend(b['name'] for b in data['bucketlists'])
+            cursor = data['next_cursor']
+        self.assertEqual(len(names), 5)
+        self.assertEqual(len(set(names)), 5)
+
+    def test_bucketlists_cursor_keeps_arguments(self):
+        # test following next keeps the fields and search of the first page
+        token = self.get_token()
+        for number in range(3):
+            self.client.post(
+                url_for('api_1.bucketlists'),
+                headers=self.get_api_headers(token, 'password'),
+                data=json.dumps({'name': 'kept bucketlist %d' % number}))
+        url = url_for('api_1.bucketlists', cursor='', limit=1, q='kept',
+                      fields='id,name')
+        names = []
+        while url is not None:
+            # the test client drops query strings left in the url
+            path, _, query = url.partition('?')
+            response = self.client.get(
+                path, headers=self.get_api_headers(token, 'password'),
+                query_string=query)
+            self.assertTrue(response.status_code == 200)
+            data = json.loads(response.data)
+            for bucketlist in data['bucketlists']:
+                self.assertEqual(sorted(bucketlist), ['id', 'name'])
+                names.append(bucketlist['name'])
+            url = data['next']
+        self.assertEqual(sorted(names), [
+            'kept bucketlist %d' % number for number in range(3)])
+
+    def test_get_bucketlists_without_count(self):
+        # test page mode can skip the total count
+        token = self.get_token()
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            headers=self.get_api_headers(token, 'password'),
+            query_string={'count': 'false'})
+        self.assertTrue(response.status_code == 200)
+        data = json.loads(response.data)
+        self.assertTrue(data['count'] is None)
+        self.assertEqual(len(data['bucketlists']), 1)
+
+    def test_search_bucketlists(self):
+        # test q matches part of a bucketlist name through the index
+        token = self.get_token()
+        self.client.put(
+            url_for('api_1.bucketlist', bucketlist_id=1),
+            headers=self.get_api_headers(token, 'password'),
+            data=json.dumps({'name': 'Visit the pyramids'}))
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            headers=self.get_api_headers(token, 'password'),
+            query_string={'q': 'pyram'})
+        data = json.loads(response.data)
+        self.assertEqual(len(data['bucketlists']), 1)
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            headers=self.get_api_headers(token, 'password'),
+            query_string={'q': 'default'})
+        data = json.loads(response.data)
+        self.assertEqual(len(data['bucketlists']), 0)
+
+    def test_search_bucketlists_by_item(self):
+        # test q matches bucketlists through their items when asked to
+        token = self.get_token()
+        query_string = {'q': 'bucketlist item'}
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            headers=self.get_api_headers(token, 'password'),
+            query_string=query_string)
+        self.assertEqual(len(json.loads(response.data)['bucketlists']), 0)
+        query_string['search_items'] = 'true'
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            headers=self.get_api_headers(token, 'password'),
+            query_string=query_string)
+        self.assertEqual(len(json.loads(response.data)['bucketlists']), 1)
+
     def test_create_bucketlist(self):
         # test create bucketlist
         token = self.get_token()
@@ -129,6 +251,141 @@ class TestAPI(unittest.TestCase):
             headers=self.get_api_headers(token, 'password'))
         self.assertTrue(response.status_code == 200)
 
+    def test_get_bucketlists_fields(self):
+        # test only the requested fields are returned
+        token = self.get_token()
+        headers = self.get_api_headers(token, 'password')
+        response = self.client.get(
+            url_for('api_1.bucketlists'), headers=headers,
+            query_string={'fields': 'id,name'})
+        self.assertTrue(response.status_code == 200)
+        bucketlist = json.loads(response.data)['bucketlists'][0]
+        self.assertEqual(sorted(bucketlist), ['id', 'name'])
+
+        response = self.client.get(
+            url_for('api_1.bucketlists'), headers=headers,
+            query_string={'fields': 'name,items.done'})
+        bucketlist = json.loads(response.data)['bucketlists'][0]
+        self.assertEqual(sorted(bucketlist), ['items', 'name'])
+        self.assertEqual(bucketlist['items'], [{'done': False}])
+
+    def test_get_bucketlists_without_items(self):
+        # test include_items=false leaves the items out
+        token = self.get_token()
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            headers=self.get_api_headers(token, 'password'),
+            query_string={'include_items': 'false'})
+        bucketlist = json.loads(response.data)['bucketlists'][0]
+        self.assertFalse('items' in bucketlist)
+        self.assertEqual(bucketlist['name'], self.default_bucketlist)
+        self.assertEqual(bucketlist['created_by'], self.default_username)
+
+    def test_get_bucketlist_fields(self):
+        # test field selection on a single bucketlist
+        token = self.get_token()
+        response = self.client.get(
+            url_for('api_1.bucketlist', bucketlist_id=1),
+            headers=self.get_api_headers(token, 'password'),
+            query_string={'fields': 'name,created_by', 'expand': ''})
+        self.assertTrue(response.status_code == 200)
+        self.assertEqual(json.loads(response.data)['bucketlist'], {
+            'name': self.default_bucketlist,
+            'created_by': self.default_username})
+
+    def test_get_user_expand(self):
+        # test a user embeds bucketlists without their items on request
+        token = self.get_token()
+        headers = self.get_api_headers(token, 'password')
+        response = self.client.get(
+            url_for('api_1.get_user', username='lade'), headers=headers,
+            query_string={'expand': 'bucketlists'})
+        self.assertTrue(response.status_code == 200)
+        user = json.loads(response.data)['user']
+        self.assertEqual(len(user['bucketlists']), 1)
+        self.assertFalse('items' in user['bucketlists'][0])
+
+        response = self.client.get(
+            url_for('api_1.get_user', username='lade'), headers=headers,
+            query_string={'fields': 'username,user_url'})
+        self.assertEqual(
+            sorted(json.loads(response.data)['user']),
+            ['user_url', 'username'])
+
+    def test_get_users_fields(self):
+        # test field selection on the streamed list of users
+        token = self.get_token()
+        response = self.client.get(
+            url_for('api_1.get_users'),
+            headers=self.get_api_headers(token, 'password'),
+            query_string={'fields': 'username'})
+        self.assertEqual(
+            json.loads(response.data)['users'],
+            [{'user': {'username': 'lade'}}, {'user': {'username': 'dave'}}])
+
+    def test_get_bucketlist_not_modified(self):
+        # test conditional get of an unchanged bucketlist
+        token = self.get_token()
+        headers = self.get_api_headers(token, 'password')
+        response = self.client.get(
+            url_for('api_1.bucketlist', bucketlist_id=1), headers=headers)
+        etag = response.headers['ETag']
+        headers['If-None-Match'] = etag
+        response = self.client.get(
+            url_for('api_1.bucketlist', bucketlist_id=1), headers=headers)
+        self.assertTrue(response.status_code == 304)
+        self.assertEqual(response.data, b'')
+
+        # changing an item changes the etag
+        self.client.post(
+            url_for('api_1.add_bucketitem', bucketlist_id=1),
+            headers=headers,
+            data=json.dumps({'name': 'I changed the bucketlist'}))
+        response = self.client.get(
+            url_for('api_1.bucketlist', bucketlist_id=1), headers=headers)
+        self.assertTrue(response.status_code == 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(response.data)['bucketlist']['items']), 2)
+
+    def test_get_bucketlists_not_modified(self):
+        # test conditional get of an unchanged page of bucketlists
+        token = self.get_token()
+        headers = self.get_api_headers(token, 'password')
+        response = self.client.get(
+            url_for('api_1.bucketlists'), headers=headers)
+        headers['If-None-Match'] = response.headers['ETag']
+        response = self.client.get(
+            url_for('api_1.bucketlists'), headers=headers)
+        self.assertTrue(response.status_code == 304)
+
+    def test_get_bucketlists_modified_by_delete(self):
+        # test deleting the newest bucketlist is not answered with a 304,
+        # which its unchanged dates could not tell
+        token = self.get_token()
+        headers = self.get_api_headers(token, 'password')
+        self.client.post(
+            url_for('api_1.bucketlists'), headers=headers,
+            data=json.dumps({'name': 'newest bucketlist'}))
+        response = self.client.get(
+            url_for('api_1.bucketlists'), headers=headers)
+        self.assertFalse('Last-Modified' in response.headers)
+        newest = json.loads(response.data)['bucketlists'][-1]
+        self.client.delete(
+            url_for('api_1.bucketlist', bucketlist_id=newest['id']),
+            headers=headers)
+
+        headers['If-None-Match'] = response.headers['ETag']
+        headers['If-Modified-Since'] = newest['last_modified']
+        response = self.client.get(
+            url_for('api_1.bucketlists'), headers=headers)
+        self.assertTrue(response.status_code == 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['count'], 1)
+        del headers['If-None-Match']
+        response = self.client.get(
+            url_for('api_1.bucketlists'), headers=headers)
+        self.assertTrue(response.status_code == 200)
+
     def test_update_bucketlist(self):
         # test update a bucketlist name
         token = self.get_token()
@@ -184,7 +441,180 @@ class TestAPI(unittest.TestCase):
             headers=self.get_api_headers(token, 'password'))
         self.assertTrue(response.status_code == 200)
 
+    def test_batch_create_bucketitems(self):
+        # test create many bucketitems at once
+        token = self.get_token()
+        response = self.client.post(
+            url_for('api_1.bucketitems_batch', bucketlist_id=1),
+            headers=self.get_api_headers(token, 'password'),
+            data=json.dumps([
+                {'name': 'first batch item'},
+                {'name': 'second batch item'},
+                {'name': 'first batch item'},
+                {'name': ''}
+            ]))
+        self.assertTrue(response.status_code == 200)
+        statuses = [
+            result['status'] for result in json.loads(response.data)['items']]
+        self.assertEqual(statuses, [201, 201, 409, 400])
+        self.assertEqual(
+            BucketItem.query.filter_by(bucketlist_id=1).count(), 3)
+
+    def test_batch_update_bucketitems(self):
+        # test update many bucketitems at once
+        token = self.get_token()
+        response = self.client.patch(
+            url_for('api_1.bucketitems_batch', bucketlist_id=1),
+            headers=self.get_api_headers(token, 'password'),
+            data=json.dumps({'items': [
+                {'id': 1, 'done': True, 'name': 'renamed in a batch'},
+                {'id': 99, 'done': True}
+            ]}))
+        self.assertTrue(response.status_code == 200)
+        results = json.loads(response.data)['items']
+        self.assertEqual([result['status'] for result in results], [200, 404])
+        item = BucketItem.query.get(1)
+        self.assertTrue(item.done)
+        self.assertEqual(item.name, 'renamed in a batch')
+
+    def test_batch_update_names(self):
+        # test names are only held by entries applied, and items of a batch
+        # may swap names
+        token = self.get_token()
+        self.add_bucketitems(token, 2)
+        response = self.client.patch(
+            url_for('api_1.bucketitems_batch', bucketlist_id=1),
+            headers=self.get_api_headers(token, 'password'),
+            data=json.dumps([
+                {'id': 1, 'name': 'wanted', 'done': 'yes'},
+                {'id': 2, 'name': 'wanted'},
+                {'id': 3, 'name': 'item 0'},
+                {'id': 1, 'name': 'item 1'}
+            ]))
+        results = json.loads(response.data)['items']
+        self.assertEqual([result['status'] for result in results],
+                         [400, 200, 200, 200])
+        self.assertTrue(results[1]['item']['last_modified'].endswith('GMT'))
+        self.assertEqual(
+            [BucketItem.query.get(item_id).name for item_id in (1, 2, 3)],
+            ['item 1', 'wanted', 'item 0'])
+
+        response = self.client.patch(
+            url_for('api_1.bucketitems_batch', bucketlist_id=1),
+            headers=self.get_api_headers(token, 'password'),
+            data=json.dumps([
+                {'id': 2, 'name': 'item 0'},
+                {'id': 3, 'name': 'wanted'},
+                {'id': 1, 'name': 'item 0'}
+            ]))
+        self.assertEqual([result['status'] for result in
+                          json.loads(response.data)['items']],
+                         [200, 200, 409])
+        self.assertEqual(
+            [BucketItem.query.get(item_id).name for item_id in (1, 2, 3)],
+            ['item 1', 'item 0', 'wanted'])
+
+    def test_batch_delete_bucketitems(self):
+        # test delete many bucketitems at once
+        token = self.get_token()
+        response = self.client.delete(
+            url_for('api_1.bucketitems_batch', bucketlist_id=1),
+            headers=self.get_api_headers(token, 'password'),
+            data=json.dumps([1, 2]))
+        self.assertTrue(response.status_code == 200)
+        results = json.loads(response.data)['items']
+        self.assertEqual([result['status'] for result in results], [200, 404])
+        self.assertEqual(BucketItem.query.count(), 0)
+
     # test errors
+    def add_bucketitems(self, token, count):
+        # adds count items named item 0.. to the default bucketlist
+        self.client.post(
+            url_for('api_1.bucketitems_batch', bucketlist_id=1),
+            headers=self.get_api_headers(token, 'password'),
+            data=json.dumps([{'name': 'item %d' % number}
+                             for number in range(count)]))
+
+    def test_get_bucketitems_with_cursor(self):
+        # test walking the items of a bucketlist page by page
+        token = self.get_token()
+        self.add_bucketitems(token, 4)
+        names = []
+        cursor = ''
+        while cursor is not None:
+            response = self.client.get(
+                url_for('api_1.bucketitems', bucketlist_id=1),
+                headers=self.get_api_headers(token, 'password'),
+                query_string={'cursor': cursor, 'limit': 2})
+            self.assertTrue(response.status_code == 200)
+            data = json.loads(response.data)
+            self.assertFalse('count' in data)
+            names.extend(item['name'] for item in data['items'])
+            cursor = data['next_cursor']
+            if cursor is not None:
+                self.assertTrue('limit=2' in data['next'])
+        self.assertEqual(len(names), 5)
+        self.assertEqual(names[0], self.default_bucketlistitem)
+
+    def test_get_bucketitems_filters(self):
+        # test filtering items by done, name and creation date
+        token = self.get_token()
+        self.add_bucketitems(token, 3)
+        self.client.put(
+            url_for('api_1.bucketitem', bucketlist_id=1, bucketitem_id=2),
+            headers=self.get_api_headers(token, 'password'),
+            data=json.dumps({'done': True}))
+
+        def names(**args):
+            response = self.client.get(
+                url_for('api_1.bucketitems', bucketlist_id=1),
+                headers=self.get_api_headers(token, 'password'),
+                query_string=args)
+            self.assertTrue(response.status_code == 200)
+            return [item['name'] for item in json.loads(response.data)['items']]
+
+        self.assertEqual(names(done='true'), ['item 0'])
+        self.assertEqual(len(names(done='false')), 3)
+        self.assertEqual(names(q='item 2'), ['item 2'])
+        self.assertEqual(len(names(created_after='2015-01-01')), 4)
+        self.assertEqual(names(created_before='2015-01-01T00:00:00'), [])
+        response = self.client.get(
+            url_for('api_1.bucketitems', bucketlist_id=1),
+            headers=self.get_api_headers(token, 'password'),
+            query_string={'done': 'false', 'count': 'true'})
+        self.assertEqual(json.loads(response.data)['count'], 3)
+
+    def test_get_bucketlists_caps_items(self):
+        # test embedded items stop at EMBEDDED_ITEMS_LIMIT with a next link
+        self.app.config['EMBEDDED_ITEMS_LIMIT'] = 2
+        token = self.get_token()
+        self.add_bucketitems(token, 3)
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            headers=self.get_api_headers(token, 'password'))
+        bucketlist = json.loads(response.data)['bucketlists'][0]
+        self.assertEqual(len(bucketlist['items']), 2)
+        self.assertEqual(
+            bucketlist['items_url'],
+            url_for('api_1.bucketitems', bucketlist_id=1, _external=True))
+        response = self.client.get(
+            bucketlist['items_next'],
+            headers=self.get_api_headers(token, 'password'),
+            query_string={'cursor': bucketlist['items_next'].split('=')[1]})
+        names = [item['name'] for item in json.loads(response.data)['items']]
+        self.assertEqual(names, ['item 1', 'item 2'])
+
+        # lists within the limit have no next link, asked with another
+        # query string as the previous page is cached
+        self.app.config['EMBEDDED_ITEMS_LIMIT'] = 4
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            headers=self.get_api_headers(token, 'password'),
+            query_string={'include_items': 'true'})
+        bucketlist = json.loads(response.data)['bucketlists'][0]
+        self.assertEqual(len(bucketlist['items']), 4)
+        self.assertTrue(bucketlist['items_next'] is None)
+
     def test_get_user_error(self):
         # test non-existing user
         response = self.client.get(
@@ -199,6 +629,22 @@ class TestAPI(unittest.TestCase):
             headers=self.get_api_headers('lade', 'password'))
         self.assertTrue(response.status_code == 400)
 
+    def test_unknown_fields_error(self):
+        # test unknown fields and expanding plain fields are rejected
+        token = self.get_token()
+        headers = self.get_api_headers(token, 'password')
+        for query_string in ({'fields': 'password_hash'},
+                             {'fields': 'name.id'},
+                             {'expand': 'name'}):
+            response = self.client.get(
+                url_for('api_1.bucketlists'), headers=headers,
+                query_string=query_string)
+            self.assertTrue(response.status_code == 400)
+        response = self.client.get(
+            url_for('api_1.get_user', username='lade'), headers=headers,
+            query_string={'fields': 'password_hash'})
+        self.assertTrue(response.status_code == 400)
+
     def test_get_bucketlist_error(self):
         # test get unauthorized access to bucketlist
         response = self.client.get(
@@ -223,6 +669,28 @@ class TestAPI(unittest.TestCase):
             headers=self.get_api_headers('dave', 'password'))
         self.assertTrue(response.status_code == 404)
 
+    def test_get_bucketlists_invalid_cursor_error(self):
+        # test tampered cursor
+        response = self.client.get(
+            url_for('api_1.bucketlists'),
+            headers=self.get_api_headers('lade', 'password'),
+            query_string={'cursor': 'not-a-cursor'})
+        self.assertTrue(response.status_code == 400)
+
+    def test_get_bucketitems_error(self):
+        # test malformed filters and other users' bucketlists
+        headers = self.get_api_headers('lade', 'password')
+        for args in ({'done': 'maybe'}, {'created_after': 'yesterday'},
+                     {'cursor': 'not-a-cursor'}, {'fields': 'colour'}):
+            response = self.client.get(
+                url_for('api_1.bucketitems', bucketlist_id=1),
+                headers=headers, query_string=args)
+            self.assertTrue(response.status_code == 400)
+        response = self.client.get(
+            url_for('api_1.bucketitems', bucketlist_id=1),
+            headers=self.get_api_headers(self.new_user, 'password'))
+        self.assertTrue(response.status_code == 404)
+
     def test_create_bucketitem_error(self):
         # test create bucketitem with unauthorized access to bucketlist
         response = self.client.post(
@@ -242,6 +710,14 @@ class TestAPI(unittest.TestCase):
             data=json.dumps({'done': True}))
         self.assertTrue(response.status_code == 404)
 
+    def test_batch_bucketitems_error(self):
+        # test batch on a bucketlist of another user
+        response = self.client.post(
+            url_for('api_1.bucketitems_batch', bucketlist_id=1),
+            headers=self.get_api_headers('dave', 'password'),
+            data=json.dumps([{'name': 'I should not be created'}]))
+        self.assertTrue(response.status_code == 404)
+
     def test_delete_bucketitem_error(self):
         # test delete bucketitem with unauthorized access to bucketlist
         response = self.client.delete(